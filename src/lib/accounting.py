@@ -0,0 +1,224 @@
+import ctypes
+import errno
+import os
+import subprocess
+import threading
+import time
+
+# waitid() from sys/wait.h, not exported by python 2
+P_PID = 1
+WNOHANG = 0x00000001
+WEXITED = 0x00000004
+WNOWAIT = 0x01000000
+
+class _SigFields(ctypes.Union):
+    # the union is aligned as a pointer, si_pid comes first
+    _fields_ = [("pid", ctypes.c_int),
+                ("_align", ctypes.c_void_p),
+                ("_pad", ctypes.c_int * 28)]
+
+class _SigInfo(ctypes.Structure):
+    _fields_ = [("signo", ctypes.c_int),
+                ("errno", ctypes.c_int),
+                ("code", ctypes.c_int),
+                ("fields", _SigFields)]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_waitid = getattr(_libc, "waitid", None)
+if _waitid is not None:
+    _waitid.restype = ctypes.c_int
+    _waitid.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_SigInfo), ctypes.c_int]
+
+# how often the peak RSS of running children is read
+SAMPLE_INTERVAL = 0.5
+
+_lock = threading.Lock()
+# None while the accounting is off
+_usage = None
+# pid -> the largest VmHWM seen in its process tree, None if not read yet
+_peaks = {}
+_sampler = None
+
+def start_accounting():
+    """Starts recording the resources used by children spawned by Popen."""
+    global _usage
+
+    with _lock:
+        _usage = []
+
+def stop_accounting():
+    """Stops the accounting and returns what has been recorded, a list of
+    {"command", "wall", "utime", "stime", "maxrss", "read_bytes",
+    "write_bytes", "returncode"} per child. Times are in seconds, sizes
+    in bytes. The values include the descendants the child waited for."""
+    global _usage
+
+    with _lock:
+        result, _usage = _usage, None
+
+    return result or []
+
+def _record(usage):
+    with _lock:
+        if _usage is not None:
+            _usage.append(usage)
+
+def _read_proc_io(pid):
+    result = {}
+    try:
+        with open("/proc/%d/io" % pid, "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                result[key.strip()] = int(value)
+    except (IOError, ValueError):
+        # setuid and setgid children (mock) are not readable
+        pass
+
+    return result
+
+def _read_peak_rss(pid):
+    """Returns VmHWM of pid in bytes or None. Unlike ru_maxrss it does not
+    include the memory of the worker the child has been forked from."""
+    try:
+        with open("/proc/%d/status" % pid, "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    # VmHWM:     1234 kB
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+
+    return None
+
+def _read_tree_peak_rss(pid):
+    """Returns the largest VmHWM in the process tree of pid (mock runs
+    crash as a grandchild), as ru_maxrss covers the descendants too."""
+    result = None
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        peak = _read_peak_rss(current)
+        if peak is not None:
+            result = max(result, peak)
+
+        try:
+            with open("/proc/%d/task/%d/children" % (current, current), "r") as f:
+                todo.extend(int(child) for child in f.read().split())
+        except (IOError, ValueError):
+            pass
+
+    return result
+
+def _sample():
+    """Reads the peak RSS of the running children until there are none.
+    A zombie has no memory anymore, so it can not be read at the exit."""
+    global _sampler
+
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        with _lock:
+            if not _peaks:
+                _sampler = None
+                return
+
+            pids = list(_peaks)
+
+        for pid in pids:
+            peak = _read_tree_peak_rss(pid)
+            with _lock:
+                # the child may have been reaped and its pid reused meanwhile
+                if peak is not None and pid in _peaks:
+                    _peaks[pid] = max(_peaks[pid], peak)
+
+def _watch(pid):
+    global _sampler
+
+    with _lock:
+        _peaks[pid] = None
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample, name="accounting")
+            _sampler.daemon = True
+            _sampler.start()
+
+def _unwatch(pid):
+    with _lock:
+        return _peaks.pop(pid, None)
+
+class Popen(subprocess.Popen):
+    """subprocess.Popen recording the CPU time, peak RSS and I/O of the
+    child once it exits, if the accounting is on. The child is left
+    a zombie for a moment, so that its /proc/<pid>/io can be read.
+    The peak RSS is sampled while the child runs."""
+
+    def __init__(self, args, *popenargs, **kwargs):
+        self._accounted = False
+        subprocess.Popen.__init__(self, args, *popenargs, **kwargs)
+
+        if isinstance(args, basestring):
+            command = args.split(None, 1)[0] if args.strip() else args
+        else:
+            command = args[0]
+
+        self._command = os.path.basename(kwargs.get("executable") or command)
+        self._started = time.time()
+        self._accounted = _usage is not None and _waitid is not None
+        if self._accounted:
+            _watch(self.pid)
+
+    def _reap(self, blocking):
+        info = _SigInfo()
+        options = WEXITED | WNOWAIT
+        if not blocking:
+            options |= WNOHANG
+
+        while _waitid(P_PID, self.pid, ctypes.byref(info), options) < 0:
+            if ctypes.get_errno() != errno.EINTR:
+                # leave it to subprocess
+                return
+
+        if info.fields.pid == 0:
+            # still running
+            return
+
+        io = _read_proc_io(self.pid)
+        peak_rss = _unwatch(self.pid)
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0)
+                break
+            except OSError as ex:
+                if ex.errno != errno.EINTR:
+                    return
+
+        self._handle_exitstatus(status)
+        self._accounted = False
+        _record({
+          "command": self._command,
+          "wall": time.time() - self._started,
+          "utime": rusage.ru_utime,
+          "stime": rusage.ru_stime,
+          # ru_maxrss (kilobytes on Linux) is only a fallback for children
+          # exiting before the first sample, it carries the RSS of the
+          # worker over fork and exec, so it is never below the worker size
+          "maxrss": peak_rss if peak_rss is not None else rusage.ru_maxrss * 1024,
+          # rusage counts 512 byte blocks, also for unreadable /proc/<pid>/io
+          "read_bytes": io.get("read_bytes", rusage.ru_inblock * 512),
+          "write_bytes": io.get("write_bytes", rusage.ru_oublock * 512),
+          "returncode": self.returncode,
+        })
+
+    def wait(self):
+        if self.returncode is None and self._accounted:
+            self._reap(True)
+
+        return subprocess.Popen.wait(self)
+
+    def poll(self):
+        if self.returncode is None and self._accounted:
+            self._reap(False)
+
+        return subprocess.Popen.poll(self)
+
+def call(*popenargs, **kwargs):
+    """subprocess.call using the accounted Popen."""
+    return Popen(*popenargs, **kwargs).wait()
@@ -0,0 +1,118 @@
+#
+#  Groups identical backtraces of crash's 'foreach bt' output.
+#  Based on bt_filter by Flavio Leitner <fleitner@redhat.com>
+#
+#  The vmcore usually shows many processes with the same backtrace.
+#  Backtraces are grouped as the output is read, so that only the
+#  distinct backtraces and the PIDs are kept in memory.
+#
+
+import json
+
+VERSION = "0.7"
+
+#PID: 373    TASK: d5874550  CPU: 7   COMMAND: "BBCU"
+def parse_proc_info(line):
+    """Returns (command, pid) from the line starting a backtrace."""
+    pid = int(line[len("PID:"):line.index("TASK:")])
+    cmd = line[line.index("COMMAND:") + len("COMMAND: "):].rstrip("\n").strip('"')
+    return cmd, pid
+
+#0 [e041ed40] schedule at c06076a4
+def clear_frame(line):
+    """Removes the stack address, which differs for every process."""
+    start = line.find("[")
+    end = line.find("]") + 1
+    return (line[:start] + line[end:]).strip()
+
+class BacktraceFilter(object):
+    """Consumes 'foreach bt' output line by line. Frames are interned,
+    a backtrace is a tuple of frame numbers and every distinct backtrace
+    is only stored once with the list of processes sharing it."""
+
+    def __init__(self):
+        # frame -> number, number -> frame
+        self._frame_ids = {}
+        self._frames = []
+        # backtrace -> index into self._groups
+        self._group_ids = {}
+        # [[backtrace, {command: [pid, ...]}, number of processes], ...]
+        self._groups = []
+        self._current = None
+        self._proc_info = None
+
+    def _intern(self, frame):
+        result = self._frame_ids.get(frame)
+        if result is None:
+            result = len(self._frames)
+            self._frame_ids[frame] = result
+            self._frames.append(frame)
+
+        return result
+
+    def _finish(self):
+        backtrace = tuple(self._current)
+        index = self._group_ids.get(backtrace)
+        if index is None:
+            index = len(self._groups)
+            self._group_ids[backtrace] = index
+            self._groups.append([backtrace, {}, 0])
+
+        cmd, pid = self._proc_info
+        group = self._groups[index]
+        group[1].setdefault(cmd, []).append(pid)
+        group[2] += 1
+
+        self._current = None
+        self._proc_info = None
+
+    def feed(self, line):
+        if self._current is not None:
+            if len(line) <= 2:
+                self._finish()
+            elif "#" in line:
+                self._current.append(self._intern(clear_frame(line)))
+        elif line.startswith("PID:") and line.find("CPU:") > 0:
+            self._current = []
+            self._proc_info = parse_proc_info(line)
+
+    def feed_lines(self, lines):
+        for line in lines:
+            self.feed(line)
+
+    def close(self):
+        """Finishes the last backtrace if the output
+        does not end with an empty line."""
+        if self._current is not None:
+            self._finish()
+
+    def groups(self):
+        """Yields (frames, {command: [pid, ...]}, number of processes)
+        in the order the backtraces first appeared."""
+        for backtrace, tasks, count in self._groups:
+            yield [self._frames[i] for i in backtrace], tasks, count
+
+    def write_report(self, out):
+        """Writes the report in the format of the bt_filter script."""
+        out.write("version: %s\n\n" % VERSION)
+        for frames, tasks, count in self.groups():
+            out.write("\nBacktrace:\n")
+            for frame in frames:
+                out.write("%s\n" % frame)
+
+            out.write("PID List:\n")
+            # group all PIDs of the same command
+            for cmd in sorted(tasks):
+                out.write("  %s *%d[%s]\n" % (cmd, len(tasks[cmd]),
+                                              " ".join("%d" % pid for pid in tasks[cmd])))
+
+            out.write("\nTotal of %d PIDs\n\n" % count)
+
+    def write_json(self, out):
+        result = {
+          "version": VERSION,
+          "backtraces": [{"frames": frames, "tasks": tasks, "total": count}
+                         for frames, tasks, count in self.groups()],
+        }
+        json.dump(result, out, indent=2)
+        out.write("\n")
@@ -0,0 +1,136 @@
+import os
+import random
+import threading
+from retrace import *
+
+# printed by crash's echo before and after every command
+MARKER_BEGIN = "RETRACE-BEGIN"
+MARKER_END = "RETRACE-END"
+
+class CrashBatch(object):
+    """Runs several crash commands in a single crash session, which saves
+    loading vmlinux and initializing the dump for every command. The output
+    is split back by markers echoed around each command. A command whose
+    end marker never appears is considered failed, remaining commands are
+    run in a new session."""
+
+    def __init__(self, cmdline, stderr=STDOUT):
+        """cmdline starts crash reading commands from stdin,
+        stderr is passed to Popen."""
+        self.cmdline = cmdline
+        self.stderr = stderr
+        self.commands = []
+        # index of command -> callable consuming its output
+        self._sinks = {}
+        # whether crash got to run any command in run()
+        self.started = False
+        # makes the markers unique, vmcore data may contain anything
+        self._token = "%08x" % random.getrandbits(32)
+
+    def add(self, name, command, sink=None):
+        """Queues command (one or more lines) whose output will be
+        available under name. If sink is given, it is called with every
+        line of the output as it comes instead, and the output of the
+        command is an empty string."""
+        if sink is not None:
+            self._sinks[len(self.commands)] = sink
+        self.commands.append((name, command))
+
+    def _marker(self, kind, index):
+        return "%s-%s-%d" % (kind, self._token, index)
+
+    def _session(self, commands):
+        """Runs commands (list of (index, name, command)) in one session.
+        Returns (exit code, whether any command started,
+        {index: output} of commands that finished)."""
+        script = []
+        for index, name, command in commands:
+            script.append("echo %s" % self._marker(MARKER_BEGIN, index))
+            script.append(command.rstrip("\n"))
+            script.append("echo %s" % self._marker(MARKER_END, index))
+        script.append("quit")
+
+        begin = dict((self._marker(MARKER_BEGIN, index), index) for index, name, command in commands)
+        end = dict((self._marker(MARKER_END, index), index) for index, name, command in commands)
+
+        result = {}
+        started = False
+        current = None
+        lines = []
+        child = Popen(self.cmdline, stdin=PIPE, stdout=PIPE, stderr=self.stderr)
+        try:
+            # the script is far smaller than the pipe buffer
+            child.stdin.write("%s\n" % "\n".join(script))
+            child.stdin.close()
+        except IOError:
+            # crash exited before reading the commands
+            pass
+
+        # the output may be huge (foreach bt), do not use .communicate()
+        for line in iter(child.stdout.readline, ""):
+            stripped = line.rstrip("\n")
+            if stripped in begin:
+                started = True
+                current = begin[stripped]
+                lines = []
+                sink = self._sinks.get(current, lines.append)
+            elif stripped in end and end[stripped] == current:
+                result[current] = "".join(lines)
+                current = None
+            elif current is not None:
+                sink(line)
+
+        child.stdout.close()
+        return child.wait(), started, result
+
+    def run(self):
+        """Runs all queued commands. Returns {name: output}, output
+        of failed commands is None."""
+        pending = [(index, name, command) for index, (name, command) in enumerate(self.commands)]
+        outputs = {}
+        while pending:
+            log_debug("Running crash with %d commands" % len(pending))
+            retcode, started, finished = self._session(pending)
+            outputs.update(finished)
+            self.started = self.started or started
+
+            # the first command without output killed the session
+            failed = [entry for entry in pending if not entry[0] in finished]
+            if not failed:
+                break
+
+            index, name, command = failed[0]
+            log_warn("crash '%s' failed, crash exited with %d" % (command.strip(), retcode))
+            if not started:
+                # crash did not even start, no point in trying again
+                break
+
+            pending = [entry for entry in pending if entry[0] > index and not entry[0] in finished]
+
+        return dict((name, outputs.get(index)) for index, (name, command) in enumerate(self.commands))
+
+def run_parallel(batches, max_sessions):
+    """Runs CrashBatch objects concurrently, at most max_sessions
+    at a time. Returns the merged {name: output} of all batches."""
+    queue = list(batches)
+    lock = threading.Lock()
+    results = {}
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                batch = queue.pop(0)
+
+            result = batch.run()
+            with lock:
+                results.update(result)
+
+    threads = [threading.Thread(target=worker) for i in xrange(max(1, min(max_sessions, len(queue))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
@@ -0,0 +1,215 @@
+import errno
+import os
+import shutil
+import tempfile
+import time
+from retrace import *
+
+# RepoDir/debuginfo/.build-id/xx/yyyy.debug
+CACHE_DIR_NAME = "debuginfo"
+
+# where the cache is bind-mounted in mock chroots
+CHROOT_DIR = "/var/cache/retrace-debuginfo"
+
+DEBUG_PREFIX = "/usr/lib/debug/"
+DWZ_PREFIX = "/usr/lib/debug/.dwz/"
+
+# files accessed recently may still be needed by running tasks,
+# cleanup kills tasks running for more than an hour
+EVICT_GRACE_PERIOD = 3600
+
+def parse_unstrip_buildids(unstrip):
+    """Returns the list of build-ids from eu-unstrip -n output."""
+    result = []
+    for line in unstrip.splitlines():
+        parts = line.split()
+        if len(parts) < 3:
+            continue
+
+        build_id = parts[1].split("@")[0]
+        if build_id != "-" and not build_id in result:
+            result.append(build_id)
+
+    return result
+
+class DebuginfoCache(object):
+    """Directory of .debug files extracted from debuginfo RPMs, laid out
+    like /usr/lib/debug/.build-id so that gdb can use it directly
+    as a debug-file-directory."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(CONFIG["RepoDir"], CACHE_DIR_NAME)
+
+        self.path = path
+
+    def entry_path(self, build_id):
+        return os.path.join(self.path, ".build-id", build_id[:2],
+                            "%s.debug" % build_id[2:])
+
+    def lookup(self, build_id):
+        """Verifies whether the build-id is cached. Marks the entry
+        as used, the file system may be mounted noatime."""
+        path = self.entry_path(build_id)
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+            return False
+
+        return True
+
+    def _extract(self, rpmpath, entries):
+        """Extracts (build-id, target) entries from the RPM into the cache.
+        Returns the set of build-ids that were added."""
+        tmpdir = tempfile.mkdtemp(prefix=".extract-", dir=self.path)
+        try:
+            files = list(set(".%s" % target for build_id, target in entries))
+            with open(os.devnull, "w") as null:
+                rpm2cpio = Popen(["rpm2cpio", rpmpath], stdout=PIPE, stderr=null)
+                cpio = Popen(["cpio", "-id", "--quiet"] + files, stdin=rpm2cpio.stdout,
+                             stdout=null, stderr=null, cwd=tmpdir)
+                rpm2cpio.stdout.close()
+                cpio.wait()
+                rpm2cpio.wait()
+
+            added = set()
+            # target -> cache entry it has been moved to
+            moved = {}
+            for build_id, target in entries:
+                dest = self.entry_path(build_id)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    try:
+                        os.makedirs(os.path.dirname(dest))
+                    except OSError as ex:
+                        if ex.errno != errno.EEXIST:
+                            raise
+
+                if target in moved:
+                    # the same file under several build-ids
+                    tmpdest = "%s.%d.tmp" % (dest, os.getpid())
+                    shutil.copy2(moved[target], tmpdest)
+                    os.rename(tmpdest, dest)
+                    added.add(build_id)
+                    continue
+
+                source = os.path.join(tmpdir, target.lstrip("/"))
+                if not os.path.isfile(source):
+                    continue
+
+                # gdb runs as mockbuild in the chroot
+                os.chmod(source, 0644)
+                # rename is atomic, concurrent workers never see partial files
+                os.rename(source, dest)
+                moved[target] = dest
+                added.add(build_id)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return added
+
+    def populate(self, index, repodir, build_ids):
+        """Makes sure the .debug files of given build-ids are cached,
+        extracting missing ones from debuginfo RPMs found in the package
+        index. dwz files of the extracted RPMs are cached as well.
+        Returns the set of debuginfo packages (as str) whose files
+        needed by build_ids are all in the cache."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # build-id -> debuginfo packages providing it
+        owners = {}
+        # RPM file name -> [build-id, ...] needed from it
+        wanted = {}
+        # RPM file name -> [(build-id, target), ...] to extract
+        missing = {}
+        for build_id in build_ids:
+            links = [l for l in index.search_buildid(build_id)
+                     if l[1].startswith(DEBUG_PREFIX)]
+            if not links:
+                continue
+
+            owners[build_id] = set(str(package) for package, path, target in links)
+            # the same build-id means the same file, any of the packages will do
+            package, path, target = links[0]
+            wanted.setdefault(package.filename, []).append(build_id)
+            if not self.lookup(build_id):
+                missing.setdefault(package.filename, []).append((build_id, target))
+
+        failed = set()
+        for filename in wanted:
+            entries = missing.get(filename, [])
+            # the .debug files are useless without their dwz file,
+            # which may have been evicted even if they are cached
+            dwz = []
+            for build_id, path, target in index.package_buildids(filename):
+                if target.startswith(DWZ_PREFIX) and not self.lookup(build_id):
+                    dwz.append(build_id)
+                    entries.append((build_id, target))
+
+            if not entries:
+                continue
+
+            rpmpath = os.path.join(repodir, "Packages", filename)
+            if not os.path.isfile(rpmpath):
+                rpmpath = os.path.join(repodir, filename)
+
+            try:
+                added = self._extract(rpmpath, entries)
+            except Exception as ex:
+                log_warn("Unable to extract '%s' into debuginfo cache: %s" % (filename, ex))
+                added = set()
+
+            log_debug("%d files of '%s' added to debuginfo cache" % (len(added), filename))
+            if any(not build_id in added for build_id in dwz):
+                log_warn("Unable to cache dwz file of '%s'" % filename)
+                failed.update(wanted[filename])
+            else:
+                failed.update(build_id for build_id, target in entries if not build_id in added)
+
+        complete = set()
+        for build_id, packages in owners.items():
+            complete.update(packages)
+
+        for build_id in failed:
+            complete.difference_update(owners[build_id])
+
+        return complete
+
+    def evict(self, max_size, grace=EVICT_GRACE_PERIOD):
+        """Removes least recently used files until the cache fits into
+        max_size bytes. Files used within the grace period are kept.
+        Returns a tuple (removed files, freed bytes)."""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(os.path.join(self.path, ".build-id")):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                size = st.st_blocks * 512
+                total += size
+                entries.append((st.st_atime, size, path))
+
+        removed = 0
+        freed = 0
+        deadline = time.time() - grace
+        for atime, size, path in sorted(entries):
+            if total - freed <= max_size or atime > deadline:
+                break
+
+            try:
+                os.unlink(path)
+            except OSError as ex:
+                log_warn("Unable to remove '%s': %s" % (path, ex))
+                continue
+
+            removed += 1
+            freed += size
+
+        return removed, freed
@@ -0,0 +1,348 @@
+import mmap
+import os
+import struct
+
+ELFMAG = "\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_DYN = 3
+ET_CORE = 4
+
+PT_LOAD = 1
+PT_NOTE = 4
+
+NT_PRSTATUS = 1
+NT_AUXV = 6
+NT_FILE = 0x46494c45
+NT_GNU_BUILD_ID = 3
+
+AT_NULL = 0
+AT_ENTRY = 9
+
+# e_machine -> canonical arch, matches what guess_arch reads from `file`
+MACHINE_ARCH = {
+  3: "i386",
+  21: "ppc64",
+  22: "s390x",
+  40: "armhfp",
+  62: "x86_64",
+  183: "aarch64",
+}
+
+# only the first pages of a core are needed to identify it
+HEADER_SIZE = 64
+
+class ElfCoreError(Exception):
+    pass
+
+def _parse_ident(ident):
+    """Returns (elfclass, struct byte order prefix) from e_ident."""
+    if len(ident) < 16 or not ident.startswith(ELFMAG):
+        raise ElfCoreError, "Not an ELF file"
+
+    elfclass = ord(ident[4])
+    if not elfclass in [ELFCLASS32, ELFCLASS64]:
+        raise ElfCoreError, "Unknown ELF class %d" % elfclass
+
+    data = ord(ident[5])
+    if data == ELFDATA2LSB:
+        order = "<"
+    elif data == ELFDATA2MSB:
+        order = ">"
+    else:
+        raise ElfCoreError, "Unknown ELF data encoding %d" % data
+
+    return elfclass, order
+
+def _machine_arch(machine, order):
+    arch = MACHINE_ARCH.get(machine)
+    if arch == "ppc64" and order == "<":
+        return "ppc64le"
+
+    return arch
+
+def read_elf_arch(path):
+    """Returns the canonical architecture from the ELF header of the given
+    coredump or None if the file is not an ELF core of a known machine."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+    except IOError:
+        return None
+
+    return header_arch(header)
+
+def header_arch(buf, offset=0):
+    """Same as read_elf_arch for a core read into buf at offset."""
+    try:
+        elf = ElfHeader(buf, offset)
+    except (ElfCoreError, struct.error):
+        return None
+
+    if elf.type != ET_CORE:
+        return None
+
+    return _machine_arch(elf.machine, elf.order)
+
+class ElfHeader(object):
+    """ELF header and program headers of an image in buf at offset."""
+
+    def __init__(self, buf, offset=0):
+        self.elfclass, self.order = _parse_ident(buf[offset:offset + 16])
+        if self.elfclass == ELFCLASS64:
+            fmt = "HHIQQQIHHHHHH"
+            self.word = "Q"
+        else:
+            fmt = "HHIIIIIHHHHHH"
+            self.word = "I"
+
+        fmt = self.order + fmt
+        (self.type, self.machine, _, self.entry, self.phoff, _, _, _,
+         self.phentsize, self.phnum, _, _, _) = \
+            struct.unpack_from(fmt, buf, offset + 16)
+
+    def program_headers(self, buf, offset=0):
+        """Returns the list of (type, offset, vaddr, filesz, memsz, align)."""
+        if self.elfclass == ELFCLASS64:
+            fmt = self.order + "IIQQQQQQ"
+        else:
+            fmt = self.order + "IIIIIIII"
+
+        result = []
+        for i in xrange(self.phnum):
+            entry = struct.unpack_from(fmt, buf, offset + self.phoff + i * self.phentsize)
+            if self.elfclass == ELFCLASS64:
+                p_type, _, p_offset, p_vaddr, _, p_filesz, p_memsz, p_align = entry
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, _, p_align = entry
+
+            result.append((p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align))
+
+        return result
+
+    def notes(self, buf, offset, size, align=4):
+        """Yields (name, type, desc offset, desc size) of all notes
+        in buf[offset:offset + size]."""
+        if align != 8:
+            align = 4
+
+        pad = lambda n: (n + align - 1) & ~(align - 1)
+        end = min(offset + size, len(buf))
+        while offset + 12 <= end:
+            namesz, descsz, ntype = struct.unpack_from(self.order + "III", buf, offset)
+            name = buf[offset + 12:offset + 12 + namesz].rstrip("\0")
+            descoff = offset + 12 + pad(namesz)
+            if descoff + descsz > end:
+                break
+
+            yield name, ntype, descoff, descsz
+            offset = descoff + pad(descsz)
+
+class ElfCore(object):
+    """Read-only view of an ELF coredump. The file is mmapped, only the
+    pages actually touched by the parser are read from disk."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < HEADER_SIZE:
+                raise ElfCoreError, "File is too small"
+
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+        try:
+            self.header = ElfHeader(self._map)
+            if self.header.type != ET_CORE:
+                raise ElfCoreError, "Not a coredump"
+
+            self.segments = self.header.program_headers(self._map)
+        except struct.error:
+            self.close()
+            raise ElfCoreError, "Truncated ELF header"
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def read(self, vaddr, size):
+        """Returns size bytes of the process memory at vaddr or None
+        if they are not present in the core."""
+        for p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align in self.segments:
+            if p_type != PT_LOAD or vaddr < p_vaddr or vaddr + size > p_vaddr + p_filesz:
+                continue
+
+            offset = p_offset + vaddr - p_vaddr
+            if offset + size > len(self._map):
+                return None
+
+            return self._map[offset:offset + size]
+
+        return None
+
+    def notes(self):
+        """Yields (name, type, desc) of all notes in the core."""
+        for p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align in self.segments:
+            if p_type != PT_NOTE:
+                continue
+
+            for name, ntype, descoff, descsz in \
+                self.header.notes(self._map, p_offset, p_filesz, p_align):
+                yield name, ntype, self._map[descoff:descoff + descsz]
+
+    def _parse_file_note(self, desc):
+        """Returns the list of (start, end, file offset, path) from NT_FILE."""
+        wordsize = struct.calcsize(self.header.order + self.header.word)
+        count, page_size = struct.unpack_from(self.header.order + self.header.word * 2, desc)
+        names = desc[wordsize * (2 + 3 * count):].split("\0")
+
+        result = []
+        for i in xrange(count):
+            start, end, pgoff = struct.unpack_from(self.header.order + self.header.word * 3,
+                                                   desc, wordsize * (2 + 3 * i))
+            path = names[i] if i < len(names) else ""
+            if path.endswith(" (deleted)"):
+                path = path[:-10]
+
+            result.append((start, end, pgoff * page_size, path))
+
+        return result
+
+    def _parse_auxv(self, desc):
+        word = self.header.order + self.header.word * 2
+        wordsize = struct.calcsize(word)
+        result = {}
+        for offset in xrange(0, len(desc) - wordsize + 1, wordsize):
+            key, value = struct.unpack_from(word, desc, offset)
+            if key == AT_NULL:
+                break
+
+            result[key] = value
+
+        return result
+
+    def _module_build_id(self, start):
+        """Returns (build-id, address of the build-id bits) of the ELF image
+        mapped at start or (None, None) if it is not present in the core."""
+        header = self.read(start, HEADER_SIZE)
+        if header is None:
+            return None, None
+
+        try:
+            module = ElfHeader(header)
+            phdrs = self.read(start + module.phoff, module.phnum * module.phentsize)
+            if phdrs is None:
+                return None, None
+
+            segments = module.program_headers(phdrs, -module.phoff)
+        except (ElfCoreError, struct.error):
+            return None, None
+
+        bias = 0
+        if module.type == ET_DYN:
+            loads = [s[2] for s in segments if s[0] == PT_LOAD]
+            if not loads:
+                return None, None
+
+            bias = start - (min(loads) & ~(mmap.PAGESIZE - 1))
+
+        for p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align in segments:
+            if p_type != PT_NOTE:
+                continue
+
+            notes = self.read(bias + p_vaddr, p_filesz)
+            if notes is None:
+                continue
+
+            for name, ntype, descoff, descsz in module.notes(notes, 0, p_filesz, p_align):
+                if name == "GNU" and ntype == NT_GNU_BUILD_ID:
+                    return notes[descoff:descoff + descsz].encode("hex"), \
+                           bias + p_vaddr + descoff
+
+        return None, None
+
+    def info(self):
+        """Returns a dictionary describing the coredump. "unstrip" is
+        the list of loaded modules in `eu-unstrip -n` format or None
+        if the core does not contain NT_FILE note."""
+        result = {
+            "arch": _machine_arch(self.header.machine, self.header.order),
+            "machine": self.header.machine,
+            "elfclass": 64 if self.header.elfclass == ELFCLASS64 else 32,
+            "endianness": "LSB" if self.header.order == "<" else "MSB",
+            "threads": 0,
+            "signal": None,
+            "mappings": None,
+            "unstrip": None,
+        }
+
+        auxv = {}
+        for name, ntype, desc in self.notes():
+            if name != "CORE":
+                continue
+
+            if ntype == NT_PRSTATUS:
+                # struct elf_siginfo is at the beginning, pr_cursig follows
+                if result["signal"] is None and len(desc) >= 14:
+                    result["signal"] = struct.unpack_from(self.header.order + "h",
+                                                          desc, 12)[0]
+                result["threads"] += 1
+            elif ntype == NT_FILE:
+                result["mappings"] = self._parse_file_note(desc)
+            elif ntype == NT_AUXV:
+                auxv = self._parse_auxv(desc)
+
+        if result["mappings"] is None:
+            return result
+
+        # group mappings by file, the image starts at the mapping of offset 0
+        modules = {}
+        for start, end, offset, path in result["mappings"]:
+            if path in modules:
+                modules[path][1] = max(modules[path][1], end)
+                if offset == 0 and start < modules[path][0]:
+                    modules[path][0] = start
+                continue
+
+            if offset == 0:
+                modules[path] = [start, end]
+
+        lines = []
+        entry = auxv.get(AT_ENTRY)
+        for path, (start, end) in sorted(modules.items(), key=lambda m: m[1][0]):
+            build_id, address = self._module_build_id(start)
+            if build_id is None:
+                # not an ELF file (locale-archive etc.) or its headers
+                # were not dumped
+                continue
+
+            if entry is not None and start <= entry < end:
+                name = "[exe]"
+            else:
+                name = os.path.basename(path)
+
+            lines.append("0x%x+0x%x %s@0x%x %s - %s" % (start, end - start, build_id,
+                                                         address, path, name))
+
+        result["unstrip"] = "".join("%s\n" % line for line in lines)
+
+        return result
+
+def read_core_info(path):
+    """Reads the description of an ELF coredump, see ElfCore.info."""
+    core = ElfCore(path)
+    try:
+        return core.info()
+    finally:
+        core.close()
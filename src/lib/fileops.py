@@ -0,0 +1,255 @@
+import ctypes
+import errno
+import fcntl
+import os
+from retrace import *
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# lseek whence, not exported by python 2
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# fallocate modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# copy_file_range/sendfile copy at most this in one call
+CHUNK_SIZE = 1 << 30
+BUFFER_SIZE = 1 << 20
+
+# errors meaning the way of copying is not available here
+UNSUPPORTED_ERRORS = [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                      errno.ENOTTY, errno.EBADF, errno.ETXTBSY]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t, ctypes.c_uint]
+
+_sendfile = getattr(_libc, "sendfile64", None)
+if _sendfile is not None:
+    _sendfile.restype = ctypes.c_ssize_t
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+
+_fallocate = getattr(_libc, "fallocate64", None)
+if _fallocate is not None:
+    _fallocate.restype = ctypes.c_int
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+class _Unsupported(Exception):
+    pass
+
+def _raise_errno(name):
+    err = ctypes.get_errno()
+    if err in UNSUPPORTED_ERRORS:
+        raise _Unsupported, "%s: %s" % (name, os.strerror(err))
+
+    raise OSError, (err, "%s: %s" % (name, os.strerror(err)))
+
+def data_segments(fd, size):
+    """Yields (start, end) of data in the file, holes are skipped.
+    The whole file is one segment if SEEK_DATA is not supported."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # only a hole follows
+                return
+            if ex.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+
+        end = min(end, size)
+        if start >= end:
+            return
+
+        yield start, end
+        offset = end
+
+def is_zero(data):
+    return data.count("\0") == len(data)
+
+def allocated_size(path):
+    """Returns the number of bytes path occupies on the disk,
+    which is less than its size if it is sparse."""
+    return os.stat(path).st_blocks * 512
+
+def _punch_hole(fd, offset, length):
+    if _fallocate is None:
+        raise _Unsupported, "fallocate is not available"
+
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) < 0:
+        _raise_errno("fallocate")
+
+def write_at(target, offset, data):
+    """Writes data into the file object target at offset. Zeros are
+    punched out as a hole instead if the filesystem supports it."""
+    target.seek(offset)
+    if is_zero(data):
+        try:
+            _punch_hole(target.fileno(), offset, len(data))
+            return
+        except _Unsupported:
+            pass
+
+    target.write(data)
+
+def punch_holes(path):
+    """Deallocates the blocks of path containing only zeros, as the tools
+    not aware of sparse files write them. Returns the number of bytes freed."""
+    before = allocated_size(path)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        for start, end in data_segments(fd, size):
+            # only whole blocks can be freed, BUFFER_SIZE is their multiple
+            offset = start - start % BUFFER_SIZE
+            while offset < end:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, BUFFER_SIZE)
+                if not data:
+                    break
+
+                if is_zero(data):
+                    _punch_hole(fd, offset, len(data))
+
+                offset += len(data)
+    except _Unsupported as ex:
+        log_debug("Unable to punch holes into '%s': %s" % (path, ex))
+    finally:
+        os.close(fd)
+
+    return max(0, before - allocated_size(path))
+
+def _copy_range_cfr(src, dst, start, end):
+    offset_in = ctypes.c_int64(start)
+    offset_out = ctypes.c_int64(start)
+    while offset_in.value < end:
+        copied = _copy_file_range(src, ctypes.byref(offset_in), dst, ctypes.byref(offset_out),
+                                  min(CHUNK_SIZE, end - offset_in.value), 0)
+        if copied < 0:
+            _raise_errno("copy_file_range")
+        if copied == 0:
+            raise OSError, (errno.EIO, "copy_file_range: unexpected end of file")
+
+def _copy_range_sendfile(src, dst, start, end):
+    offset = ctypes.c_int64(start)
+    os.lseek(dst, start, os.SEEK_SET)
+    while offset.value < end:
+        copied = _sendfile(dst, src, ctypes.byref(offset), min(CHUNK_SIZE, end - offset.value))
+        if copied < 0:
+            _raise_errno("sendfile")
+        if copied == 0:
+            raise OSError, (errno.EIO, "sendfile: unexpected end of file")
+
+def _copy_range_buffered(src, dst, start, end):
+    os.lseek(src, start, os.SEEK_SET)
+    offset = start
+    while offset < end:
+        data = os.read(src, min(BUFFER_SIZE, end - offset))
+        if not data:
+            raise OSError, (errno.EIO, "read: unexpected end of file")
+
+        # keep zero blocks sparse as well
+        if not is_zero(data):
+            os.lseek(dst, offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(dst, data[written:])
+
+        offset += len(data)
+
+def _reflink(src, dst, size):
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except IOError as ex:
+        if ex.errno in UNSUPPORTED_ERRORS:
+            raise _Unsupported, "FICLONE: %s" % os.strerror(ex.errno)
+        raise
+
+def _copy_by(copy_range):
+    def copy(src, dst, size):
+        for start, end in data_segments(src, size):
+            copy_range(src, dst, start, end)
+
+    return copy
+
+# the order in which the ways of copying are tried
+COPY_METHODS = [("reflink", _reflink)]
+if _copy_file_range is not None:
+    COPY_METHODS.append(("copy_file_range", _copy_by(_copy_range_cfr)))
+if _sendfile is not None:
+    COPY_METHODS.append(("sendfile", _copy_by(_copy_range_sendfile)))
+COPY_METHODS.append(("copy", _copy_by(_copy_range_buffered)))
+
+def copy_file(source, target):
+    """Copies source into target, which must not exist, the cheapest
+    possible way. Holes of sparse files are preserved. Returns the name
+    of the way used: reflink, copy_file_range, sendfile or copy."""
+    src = os.open(source, os.O_RDONLY)
+    try:
+        st = os.fstat(src)
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IMODE(st.st_mode))
+        try:
+            result = _copy_fd(source, src, dst, st.st_size)
+        except:
+            os.close(dst)
+            os.unlink(target)
+            raise
+
+        os.close(dst)
+        return result
+    finally:
+        os.close(src)
+
+def _copy_fd(source, src, dst, size):
+    for name, method in COPY_METHODS:
+        try:
+            method(src, dst, size)
+        except _Unsupported as ex:
+            log_debug("Unable to copy '%s' by %s: %s" % (source, name, ex))
+            os.ftruncate(dst, 0)
+            continue
+
+        # the length of a trailing hole
+        os.ftruncate(dst, size)
+        return name
+
+    raise Exception, "Unable to copy '%s'" % source
+
+def copy_tree(source, target):
+    """Copies the directory source into target, which must not exist,
+    files by copy_file, symlinks as symlinks."""
+    os.mkdir(target)
+    os.chmod(target, stat.S_IMODE(os.stat(source).st_mode))
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), os.path.join(target, name))
+        elif os.path.isdir(path):
+            copy_tree(path, os.path.join(target, name))
+        else:
+            copy_file(path, os.path.join(target, name))
+
+def ingest_file(source, target, link=True):
+    """Puts source at target, by a hardlink if link is True and it is
+    possible, by copy_file otherwise. Returns the way used."""
+    if link:
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError as ex:
+            log_debug("Unable to hardlink '%s': %s" % (source, ex))
+
+    return copy_file(source, target)
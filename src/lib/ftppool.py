@@ -0,0 +1,301 @@
+import ftplib
+import threading
+import time
+from retrace import *
+from fileops import write_at
+
+# servers drop idle sessions after a few minutes, do not reuse them so late
+MAX_IDLE_TIME = 180
+# idle connections older than this are checked by NOOP before reuse
+CHECK_IDLE_TIME = 15
+
+BLOCK_SIZE = 1 << 20
+# never split files smaller than this into several transfers
+MIN_PART_SIZE = 64 << 20
+
+class FtpPool(object):
+    """Keeps logged in FTP connections (in CONFIG["FTPDir"]) for reuse,
+    which saves the connection setup, TLS handshake and login."""
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        # [(ftp, time returned), ...]
+        self._idle = []
+
+    def get(self):
+        """Returns a working connection, idle or new."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                ftp, since = self._idle.pop()
+
+            idle = time.time() - since
+            if idle > MAX_IDLE_TIME:
+                ftp_close(ftp)
+                continue
+
+            if idle > CHECK_IDLE_TIME:
+                try:
+                    ftp.voidcmd("NOOP")
+                except ftplib.all_errors:
+                    ftp.close()
+                    continue
+
+            return ftp
+
+        return ftp_init()
+
+    def put(self, ftp):
+        """Returns a healthy connection into the pool."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((ftp, time.time()))
+                return
+
+        ftp_close(ftp)
+
+    def discard(self, ftp):
+        """Closes a connection in an unknown state."""
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    def connection(self):
+        return _PooledConnection(self)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for ftp, since in idle:
+            ftp_close(ftp)
+
+class _PooledConnection(object):
+    """with get_ftp_pool().connection() as ftp: ... returns the connection
+    into the pool, unless the block fails. Any error may leave a transfer
+    in progress, such a connection is closed."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._ftp = None
+
+    def __enter__(self):
+        self._ftp = self._pool.get()
+        return self._ftp
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._pool.put(self._ftp)
+        else:
+            self._pool.discard(self._ftp)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_ftp_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = FtpPool(CONFIG["FTPPoolSize"])
+
+        return _pool
+
+# ftpdir -> (time, {filename: size or None})
+_listings = {}
+_listings_lock = threading.Lock()
+
+def _parse_mlsd(line):
+    facts, name = line.split(" ", 1)
+    result = {}
+    for fact in facts.rstrip(";").split(";"):
+        if "=" in fact:
+            key, value = fact.split("=", 1)
+            result[key.lower()] = value
+
+    return name, result
+
+def _list_dir(ftp, ftpdir):
+    """Returns {filename: size} of files in ftpdir. The sizes come with
+    MLSD if the server supports it, they are None otherwise."""
+    try:
+        lines = []
+        ftp.retrlines("MLSD %s" % ftpdir, lines.append)
+    except ftplib.error_perm:
+        # 500/502 - MLSD not implemented
+        return dict((f.rsplit("/", 1)[-1], None) for f in ftp.nlst(ftpdir))
+
+    result = {}
+    for line in lines:
+        name, facts = _parse_mlsd(line)
+        if facts.get("type", "file").lower() != "file":
+            continue
+
+        try:
+            result[name] = int(facts["size"])
+        except (KeyError, ValueError):
+            result[name] = None
+
+    return result
+
+def ftp_listing(ftpdir=None, refresh=False):
+    """Returns {filename: size or None} of files in ftpdir (FTPDir by default).
+    The listing is cached for FTPListingCacheTime seconds."""
+    if ftpdir is None:
+        ftpdir = CONFIG["FTPDir"]
+
+    now = time.time()
+    with _listings_lock:
+        cached = _listings.get(ftpdir)
+        if not refresh and cached is not None and now - cached[0] < CONFIG["FTPListingCacheTime"]:
+            return dict(cached[1])
+
+    with get_ftp_pool().connection() as ftp:
+        listing = _list_dir(ftp, ftpdir)
+
+    with _listings_lock:
+        _listings[ftpdir] = (now, listing)
+
+    return dict(listing)
+
+def _size(ftp, filename):
+    # pooled connections may be left in ASCII mode by a listing,
+    # where some servers refuse SIZE
+    ftp.voidcmd("TYPE I")
+    return ftp.size(filename)
+
+def ftp_file_size(filename, ftp=None):
+    """Returns the size of a file in FTPDir, from the cached listing
+    if it is known. Raises an ftplib error if the file does not exist."""
+    size = ftp_listing().get(filename)
+    if size is not None:
+        return size
+
+    if ftp is not None:
+        return _size(ftp, filename)
+
+    with get_ftp_pool().connection() as ftp:
+        return _size(ftp, filename)
+
+def _retrieve(ftp, filename, offset, length, write):
+    """Passes length bytes of filename starting at offset to write.
+    Returns whether the control connection is still usable."""
+    ftp.voidcmd("TYPE I")
+    conn = ftp.transfercmd("RETR %s" % filename, rest=offset or None)
+    received = 0
+    try:
+        while received < length:
+            data = conn.recv(min(BLOCK_SIZE, length - received))
+            if not data:
+                break
+
+            write(data)
+            received += len(data)
+
+        at_end = not conn.recv(1) if received == length else True
+    finally:
+        conn.close()
+
+    if received != length:
+        raise ftplib.Error, "Received %d of %d bytes of '%s' at offset %d" \
+                            % (received, length, filename, offset)
+
+    if not at_end:
+        # the transfer has been interrupted, the server answers 426
+        # or 226 depending on timing, do not reuse the connection
+        return False
+
+    ftp.voidresp()
+    return True
+
+def ftp_retrieve(filename, write):
+    """Passes the whole filename from FTPDir to write
+    using a pooled connection."""
+    with get_ftp_pool().connection() as ftp:
+        # the files are expected to be huge (even hundreds of gigabytes)
+        # use a larger buffer - 16MB by default
+        ftp.retrbinary("RETR %s" % filename, write, CONFIG["FTPBufferSize"] * (1 << 20))
+
+class _PartWriter(object):
+    def __init__(self, target, offset, progress):
+        self._target = target
+        self.offset = offset
+        self._progress = progress
+
+    def __call__(self, data):
+        write_at(self._target, self.offset, data)
+        self.offset += len(data)
+        self._progress(len(data))
+
+def ftp_download(filename, path, connections=None, progress=None):
+    """Downloads filename from FTPDir into path. Large files are split
+    into parts retrieved in parallel by REST over several connections.
+    progress is called with (bytes downloaded, total bytes)."""
+    if connections is None:
+        connections = CONFIG["FTPConnections"]
+
+    pool = get_ftp_pool()
+    with pool.connection() as ftp:
+        # the listing may be older than the file
+        total = _size(ftp, filename)
+
+    lock = threading.Lock()
+    current = [0]
+
+    def report(size):
+        with lock:
+            current[0] += size
+            done = current[0]
+
+        if progress:
+            progress(done, total)
+
+    parts = max(1, min(connections, total / MIN_PART_SIZE))
+    report(0)
+    if parts == 1:
+        with open(path, "wb") as target:
+            writer = _PartWriter(target, 0, report)
+            ftp_retrieve(filename, writer)
+            # trailing zeros are left as a hole
+            target.truncate(writer.offset)
+        return
+
+    log_debug("Retrieving '%s' by %d connections" % (filename, parts))
+    with open(path, "wb") as target:
+        target.truncate(total)
+
+    partsize = (total + parts - 1) / parts
+    failed = []
+
+    def worker(offset, length):
+        try:
+            with open(path, "r+b") as target:
+                ftp = pool.get()
+                try:
+                    reusable = _retrieve(ftp, filename, offset, length,
+                                         _PartWriter(target, offset, report))
+                except:
+                    pool.discard(ftp)
+                    raise
+
+                if reusable:
+                    pool.put(ftp)
+                else:
+                    pool.discard(ftp)
+        except Exception as ex:
+            failed.append("%s: %s" % (filename, ex))
+
+    threads = []
+    for offset in xrange(0, total, partsize):
+        thread = threading.Thread(target=worker, args=(offset, min(partsize, total - offset)), name="ftp")
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if failed:
+        raise ftplib.Error, failed[0]
@@ -0,0 +1,289 @@
+import errno
+import httplib
+import json
+import os
+import re
+import threading
+import urlparse
+from retrace import *
+from fileops import write_at
+
+# every connection downloads one segment at a time
+SEGMENT_SIZE = 64 << 20
+BLOCK_SIZE = 1 << 20
+
+# attempts per segment before the download fails
+MAX_RETRIES = 5
+MAX_REDIRECTS = 5
+REDIRECTS = [301, 302, 303, 307, 308]
+TIMEOUT = 60
+
+# path.state keeps the finished segments while downloading
+STATE_SUFFIX = ".state"
+
+CONTENT_RANGE_PARSER = re.compile("^bytes ([0-9]+)-([0-9]+)/([0-9]+|\*)$")
+
+class HttpDownloadError(Exception):
+    pass
+
+def _connect(url):
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme == "https":
+        conn = httplib.HTTPSConnection(parsed.netloc, timeout=TIMEOUT)
+    elif parsed.scheme == "http":
+        conn = httplib.HTTPConnection(parsed.netloc, timeout=TIMEOUT)
+    else:
+        raise HttpDownloadError, "Unsupported URL scheme '%s'" % parsed.scheme
+
+    path = parsed.path or "/"
+    if parsed.query:
+        path = "%s?%s" % (path, parsed.query)
+
+    return conn, path
+
+class HttpDownloader(object):
+    """Downloads a file over HTTP(S) by parallel Range requests. Every
+    connection is kept alive and reused for further segments, which are
+    written at their offsets into a file preallocated to the full (sparse)
+    size. Finished segments are recorded next to the file, so a download
+    interrupted for any reason continues where it stopped. Servers not
+    supporting ranges are downloaded by a single request."""
+
+    def __init__(self, url, path, connections=4, progress=None):
+        """progress is called with (bytes downloaded, total bytes)."""
+        self.url = url
+        self.path = path
+        self.connections = max(1, connections)
+        self._progress = progress
+        self._statepath = "%s%s" % (path, STATE_SUFFIX)
+        self._lock = threading.Lock()
+        self._length = None
+        self._validator = None
+        self._done = set()
+        self._current = 0
+
+    def _probe(self):
+        """Follows redirects and reads the length of the resource.
+        Returns whether the server supports ranges."""
+        for i in xrange(MAX_REDIRECTS + 1):
+            conn, path = _connect(self.url)
+            try:
+                conn.request("GET", path, headers={"Range": "bytes=0-0"})
+                response = conn.getresponse()
+                if response.status == 206 or response.status in REDIRECTS:
+                    response.read()
+                else:
+                    # a server ignoring Range sends the whole resource
+                    response.close()
+            finally:
+                conn.close()
+
+            if response.status in REDIRECTS:
+                location = response.getheader("Location")
+                if not location:
+                    raise HttpDownloadError, "Redirect without location"
+
+                self.url = urlparse.urljoin(self.url, location)
+                log_debug("Redirected to '%s'" % self.url)
+                continue
+
+            break
+        else:
+            raise HttpDownloadError, "Too many redirects"
+
+        self._validator = response.getheader("ETag") or response.getheader("Last-Modified")
+        if response.status == 206:
+            match = CONTENT_RANGE_PARSER.match(response.getheader("Content-Range", ""))
+            if match and match.group(3) != "*":
+                self._length = int(match.group(3))
+                return True
+
+        if response.status not in [200, 206]:
+            raise HttpDownloadError, "Server returned %d %s" % (response.status, response.reason)
+
+        length = response.getheader("Content-Length")
+        if response.status == 200 and length is not None:
+            self._length = int(length)
+
+        return False
+
+    def _load_state(self):
+        """Returns the set of finished segments of an interrupted download
+        of the same resource."""
+        try:
+            with open(self._statepath, "r") as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return set()
+
+        if state.get("length") != self._length or state.get("validator") != self._validator or \
+           state.get("segment_size") != SEGMENT_SIZE or not os.path.isfile(self.path):
+            return set()
+
+        return set(state.get("done", []))
+
+    def _save_state(self):
+        tmppath = "%s.tmp" % self._statepath
+        with open(tmppath, "w") as f:
+            json.dump({"url": self.url, "length": self._length, "validator": self._validator,
+                       "segment_size": SEGMENT_SIZE, "done": sorted(self._done)}, f)
+        os.rename(tmppath, self._statepath)
+
+    def _report(self, size):
+        with self._lock:
+            self._current += size
+            current = self._current
+
+        if self._progress:
+            self._progress(current, self._length)
+
+    def _fetch_segment(self, conn, path, segment, target):
+        start = segment * SEGMENT_SIZE
+        end = min(start + SEGMENT_SIZE, self._length) - 1
+        conn.request("GET", path, headers={"Range": "bytes=%d-%d" % (start, end)})
+        response = conn.getresponse()
+        if response.status != 206:
+            response.read()
+            raise HttpDownloadError, "Range request returned %d %s" % (response.status, response.reason)
+
+        match = CONTENT_RANGE_PARSER.match(response.getheader("Content-Range", ""))
+        if not match or int(match.group(1)) != start or int(match.group(2)) != end:
+            raise HttpDownloadError, "Unexpected Content-Range '%s'" % response.getheader("Content-Range")
+
+        received = 0
+        try:
+            while received <= end - start:
+                data = response.read(min(BLOCK_SIZE, end - start + 1 - received))
+                if not data:
+                    break
+
+                # the file is sparse, keep holes of sparse cores as they are
+                write_at(target, start + received, data)
+                received += len(data)
+                self._report(len(data))
+        except:
+            self._report(-received)
+            raise
+
+        if received != end - start + 1:
+            self._report(-received)
+            raise HttpDownloadError, "Segment %d is incomplete (%d of %d bytes)" \
+                                     % (segment, received, end - start + 1)
+
+    def _worker(self, queue, failed):
+        conn, path = _connect(self.url)
+        try:
+            with open(self.path, "r+b") as target:
+                while not failed:
+                    with self._lock:
+                        if not queue:
+                            return
+                        segment = queue.pop(0)
+
+                    for attempt in xrange(MAX_RETRIES):
+                        try:
+                            self._fetch_segment(conn, path, segment, target)
+                            break
+                        except (EnvironmentError, httplib.HTTPException, HttpDownloadError) as ex:
+                            log_debug("Segment %d of '%s' failed: %s" % (segment, self.url, ex))
+                            # the connection is in an unknown state
+                            conn.close()
+                            conn, path = _connect(self.url)
+                    else:
+                        failed.append("Unable to download segment %d" % segment)
+                        return
+
+                    target.flush()
+                    with self._lock:
+                        self._done.add(segment)
+                        self._save_state()
+        except Exception as ex:
+            failed.append(str(ex))
+        finally:
+            conn.close()
+
+    def _download_single(self, write):
+        """Downloads the whole resource by one request,
+        passing the data to write as it comes."""
+        conn, path = _connect(self.url)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise HttpDownloadError, "Server returned %d %s" % (response.status, response.reason)
+
+            received = 0
+            for data in iter(lambda: response.read(BLOCK_SIZE), ""):
+                write(data)
+                received += len(data)
+                if self._length:
+                    self._report(len(data))
+        finally:
+            conn.close()
+
+        if self._length is not None and received != self._length:
+            raise HttpDownloadError, "Received %d bytes, expected %d" % (received, self._length)
+
+    def run(self):
+        """Downloads the file, raises HttpDownloadError on failure."""
+        if not self._probe() or not self._length:
+            log_debug("Server does not support ranges, downloading '%s' at once" % self.url)
+            with open(self.path, "wb") as target:
+                self._download_single(target.write)
+            return
+
+        segments = (self._length + SEGMENT_SIZE - 1) / SEGMENT_SIZE
+        self._done = self._load_state()
+        if self._done:
+            log_info("Resuming download of '%s', %d of %d segments finished"
+                     % (self.url, len(self._done), segments))
+        else:
+            # preallocated sparse, segments are written at their offsets
+            with open(self.path, "wb") as target:
+                target.truncate(self._length)
+
+        self._current = sum(min(SEGMENT_SIZE, self._length - s * SEGMENT_SIZE) for s in self._done)
+        self._report(0)
+
+        queue = [s for s in xrange(segments) if not s in self._done]
+        failed = []
+        threads = [threading.Thread(target=self._worker, args=(queue, failed), name="http")
+                   for i in xrange(min(self.connections, len(queue)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failed:
+            raise HttpDownloadError, failed[0]
+
+        if len(self._done) != segments or os.path.getsize(self.path) != self._length:
+            raise HttpDownloadError, "Downloaded file does not have the expected length %d" % self._length
+
+        try:
+            os.unlink(self._statepath)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def stream(self, write):
+        """Downloads the resource sequentially by a single connection
+        passing the data to write, path is not used."""
+        self._probe()
+        self._report(0)
+        self._download_single(write)
+
+def http_download(url, path, connections=4, progress=None):
+    """Downloads url into path, see HttpDownloader."""
+    HttpDownloader(url, path, connections, progress).run()
+
+def http_resource_size(url):
+    """Returns the length of url as learned by the range probe,
+    None if the server does not tell it."""
+    downloader = HttpDownloader(url, None)
+    downloader._probe()
+    return downloader._length
+
+def http_stream(url, write, progress=None):
+    """Downloads url passing the data to write, see HttpDownloader.stream."""
+    HttpDownloader(url, None, progress=progress).stream(write)
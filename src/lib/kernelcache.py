@@ -0,0 +1,148 @@
+import errno
+import os
+import shutil
+import time
+from retrace import *
+
+# RepoDir/kernel/<arch>/usr/lib/debug/lib/modules/<kernel>
+MODULES_DIR = "usr/lib/debug/lib/modules"
+
+# touched in the kernel tree whenever a task uses it, the tree
+# directory itself is read by os.walk and its atime is not reliable
+STAMP_FILE = ".used"
+
+# see debugcache.EVICT_GRACE_PERIOD
+EVICT_GRACE_PERIOD = 3600
+
+def _du(path):
+    result = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                result += os.lstat(os.path.join(root, filename)).st_blocks * 512
+            except OSError:
+                continue
+
+    return result
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+class KernelCache(object):
+    """Kernel trees extracted from kernel-debuginfo packages under
+    RepoDir/kernel and kernel-debuginfo packages downloaded into
+    RepoDir/download. Trees and packages are evicted independently,
+    both are marked as used by prepare_debuginfo."""
+
+    def __init__(self, repodir=None):
+        if repodir is None:
+            repodir = CONFIG["RepoDir"]
+
+        self.kerneldir = os.path.join(repodir, "kernel")
+        self.downloaddir = os.path.join(repodir, "download")
+
+    def tree_path(self, path):
+        """Returns the kernel tree containing path (vmlinux or a module)
+        or None if path is not in the cache."""
+        path = os.path.abspath(path)
+        prefix = os.path.join(self.kerneldir, "")
+        if not path.startswith(prefix):
+            return None
+
+        parts = path[len(prefix):].split("/")
+        if len(parts) < 8 or "/".join(parts[1:6]) != MODULES_DIR:
+            return None
+
+        return os.path.join(self.kerneldir, *parts[:7])
+
+    def touch(self, path):
+        """Marks the kernel tree containing path or the downloaded
+        package path as used."""
+        now = time.time()
+        tree = self.tree_path(path)
+        if tree is not None:
+            with open(os.path.join(tree, STAMP_FILE), "a"):
+                pass
+            os.utime(os.path.join(tree, STAMP_FILE), (now, now))
+        elif os.path.dirname(os.path.abspath(path)) == self.downloaddir:
+            # keep mtime, the payload index validates packages by it
+            os.utime(path, (now, os.path.getmtime(path)))
+
+    def entries(self):
+        """Returns a list of (last used, size, path, kernel) tuples."""
+        result = []
+        # RepoDir/kernel contains the kernel and payload indices as well
+        for arch in _listdir(self.kerneldir):
+            modulesdir = os.path.join(self.kerneldir, arch, MODULES_DIR)
+            if not os.path.isdir(modulesdir):
+                continue
+
+            for kernel in _listdir(modulesdir):
+                path = os.path.join(modulesdir, kernel)
+                try:
+                    lastused = os.path.getmtime(os.path.join(path, STAMP_FILE))
+                except OSError:
+                    # extracted before stamps were introduced
+                    try:
+                        lastused = os.path.getmtime(path)
+                    except OSError:
+                        continue
+
+                result.append((lastused, _du(path), path, kernel))
+
+        for filename in _listdir(self.downloaddir):
+            # interrupted downloads are only resumed by the next task
+            if not filename.endswith(".rpm") and not filename.endswith(".rpm.part"):
+                continue
+
+            path = os.path.join(self.downloaddir, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            result.append((max(st.st_atime, st.st_mtime), st.st_blocks * 512, path, filename))
+
+        return result
+
+    def evict(self, max_size, keep=[], grace=EVICT_GRACE_PERIOD):
+        """Removes least recently used kernel trees and packages until
+        the cache fits into max_size bytes. Entries used within the grace
+        period and entries of kernels in keep (KernelVer) are kept.
+        Returns a tuple (removed entries, freed bytes)."""
+        protected = ["%s-%s" % (kernelver.version, kernelver.release) for kernelver in keep]
+
+        entries = self.entries()
+        total = sum(size for lastused, size, path, kernel in entries)
+
+        removed = 0
+        freed = 0
+        deadline = time.time() - grace
+        for lastused, size, path, kernel in sorted(entries):
+            if total - freed <= max_size or lastused > deadline:
+                break
+
+            if any(kernel.startswith(p) or "-%s." % p in kernel for p in protected):
+                log_debug("Keeping '%s', used by a running task" % path)
+                continue
+
+            try:
+                if os.path.isdir(path):
+                    # hide the tree first so that no task picks up a partial one
+                    trash = os.path.join(os.path.dirname(path), ".evict-%s" % kernel)
+                    os.rename(path, trash)
+                    shutil.rmtree(trash)
+                else:
+                    os.unlink(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    log_warn("Unable to remove '%s': %s" % (path, ex))
+                continue
+
+            removed += 1
+            freed += size
+
+        return removed, freed
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+
+# RepoDir/kernel/kernels.db
+INDEX_FILE = "kernels.db"
+
+# lower is preferred, matches the order find_kernel_debuginfo probes in
+SOURCE_REPO = 0
+SOURCE_DOWNLOAD = 1
+SOURCE_KOJI = 2
+
+KOJI_BASENAMES = ["kernel", "kernel-rt"]
+
+def is_kernel_debuginfo(filename):
+    """Verifies whether the file name is a kernel debuginfo RPM
+    (kernel-debuginfo, kernel-rt-debuginfo, kernel-PAE-debuginfo...)."""
+    return filename.startswith("kernel") and filename.endswith(".rpm") and \
+           "-debuginfo-" in filename and not "-debuginfo-common-" in filename
+
+def _listdir(path):
+    # listing a file fails as well, saves a stat per entry on NFS
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+class KernelDebuginfoIndex(object):
+    """Maps kernel debuginfo RPM file names (NVRA) to their locations
+    in RepoDir, the download directory and KojiRoot."""
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path, timeout=60)
+        self._con.text_factory = str
+        query = self._con.cursor()
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          kernels(filename NOT NULL, path NOT NULL UNIQUE, source NOT NULL)
+        """)
+        query.execute("CREATE INDEX IF NOT EXISTS kernels_filename ON kernels(filename)")
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+    def lookup(self, filenames):
+        """Returns the path of the first of filenames found in the index
+        or None. Entries of files that no longer exist are dropped."""
+        query = self._con.cursor()
+        for filename in filenames:
+            query.execute("SELECT path FROM kernels WHERE filename = ? "
+                          "ORDER BY source", (filename,))
+            for (path,) in query.fetchall():
+                if os.path.isfile(path):
+                    return path
+
+                query.execute("DELETE FROM kernels WHERE path = ?", (path,))
+                self._con.commit()
+
+        return None
+
+    def add(self, path, source):
+        query = self._con.cursor()
+        query.execute("INSERT OR REPLACE INTO kernels (filename, path, source) "
+                      "VALUES (?, ?, ?)", (os.path.basename(path), path, source))
+        self._con.commit()
+
+    def _replace(self, prefix, source, paths):
+        """Replaces all entries of source under prefix by paths.
+        Returns the number of entries added and removed."""
+        query = self._con.cursor()
+        query.execute("SELECT path FROM kernels WHERE source = ? AND substr(path, 1, ?) = ?",
+                      (source, len(prefix), prefix))
+        old = set(row[0] for row in query.fetchall())
+        new = set(paths)
+
+        for path in old - new:
+            query.execute("DELETE FROM kernels WHERE path = ?", (path,))
+
+        for path in new - old:
+            query.execute("INSERT OR REPLACE INTO kernels (filename, path, source) "
+                          "VALUES (?, ?, ?)", (os.path.basename(path), path, source))
+
+        self._con.commit()
+        return len(new - old), len(old - new)
+
+    def update_dir(self, directory, source):
+        """Indexes kernel debuginfo RPMs in directory and its Packages
+        subdirectory. Returns the number of entries added and removed."""
+        paths = []
+        for subdir in [directory, os.path.join(directory, "Packages")]:
+            if not os.path.isdir(subdir):
+                continue
+
+            for filename in os.listdir(subdir):
+                if is_kernel_debuginfo(filename):
+                    paths.append(os.path.join(subdir, filename))
+
+        return self._replace(os.path.join(directory, ""), source, paths)
+
+    def update_koji(self, kojiroot):
+        """Indexes KojiRoot/packages/<basename>/<version>/<release>/<arch>.
+        Returns the number of entries added and removed."""
+        paths = []
+        for basename in KOJI_BASENAMES:
+            basedir = os.path.join(kojiroot, "packages", basename)
+            for version in _listdir(basedir):
+                versiondir = os.path.join(basedir, version)
+                for release in _listdir(versiondir):
+                    releasedir = os.path.join(versiondir, release)
+                    for arch in _listdir(releasedir):
+                        archdir = os.path.join(releasedir, arch)
+                        for filename in _listdir(archdir):
+                            if is_kernel_debuginfo(filename):
+                                paths.append(os.path.join(archdir, filename))
+
+        return self._replace(os.path.join(kojiroot, "packages", ""), SOURCE_KOJI, paths)
@@ -0,0 +1,263 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib2
+from retrace import *
+from elfcore import ELFMAG, header_arch
+from vmcoreheader import KDUMP_SIGNATURE, KDUMP_UTSNAME_OFFSET, UTSNAME_FIELD_LENGTH
+
+# RepoDir/kernel/prefetch.db
+INDEX_FILE = "prefetch.db"
+
+# the kdump header and the ELF notes carrying VMCOREINFO
+# are at the very beginning of a vmcore
+HEAD_SIZE = 4 << 20
+
+# vmcores compress well, never keep more than this in memory
+DECOMPRESSED_HEAD_SIZE = 16 << 20
+
+# tar puts the file after a 512 byte header, be a bit more generous
+SIGNATURE_RANGE = 1 << 16
+
+# how often to look at a vmcore being downloaded
+POLL_INTERVAL = 5
+
+# forget remote vmcores after 30 days
+RECORD_EXPIRATION = 30 * 24 * 3600
+
+# file name suffix -> command decompressing stdin to stdout
+HEAD_DECOMPRESSORS = [
+  (".gz", [GZIP_BIN, "-dc"]),
+  (".tgz", [GZIP_BIN, "-dc"]),
+  (".tarz", [GZIP_BIN, "-dc"]),
+  (".Z", [GZIP_BIN, "-dc"]),
+  (".bz2", ["bzip2", "-dc"]),
+  (".xz", [XZ_BIN, "-dc"]),
+]
+
+HEAD_OSRELEASE_PARSER = re.compile("OSRELEASE=([^%\0\n]+)")
+
+def _feed(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except IOError:
+        # the decompressor has been killed, enough data has been read
+        pass
+
+def decompress_head(data, filename):
+    """Returns the beginning of the uncompressed data if filename
+    denotes a compressed file, data itself otherwise."""
+    for suffix, cmd in HEAD_DECOMPRESSORS:
+        if not filename.endswith(suffix):
+            continue
+
+        with open(os.devnull, "w") as null:
+            child = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=null)
+        # the head is truncated, the decompressor fails at its end
+        feeder = threading.Thread(target=_feed, args=(child.stdin, data))
+        feeder.daemon = True
+        feeder.start()
+        result = child.stdout.read(DECOMPRESSED_HEAD_SIZE)
+        if child.poll() is None:
+            child.kill()
+        child.stdout.close()
+        child.wait()
+        feeder.join()
+        return result
+
+    return data
+
+def kernel_release_from_head(data):
+    """Reads the kernel release from the beginning of a vmcore.
+    Returns KernelVer or None if it can not be determined."""
+    release = None
+    machine = None
+
+    start = data.find(KDUMP_SIGNATURE, 0, SIGNATURE_RANGE)
+    if start >= 0:
+        # sysname, nodename, release, version, machine, domainname
+        offset = start + KDUMP_UTSNAME_OFFSET
+        fields = [data[offset + i * UTSNAME_FIELD_LENGTH:
+                       offset + (i + 1) * UTSNAME_FIELD_LENGTH].split("\0", 1)[0]
+                  for i in xrange(6)]
+        release = fields[2]
+        machine = fields[4]
+
+    if not release:
+        match = HEAD_OSRELEASE_PARSER.search(data)
+        if match:
+            release = match.group(1)
+
+    if not release:
+        return None
+
+    try:
+        result = KernelVer(release)
+    except Exception as ex:
+        log_debug("Unable to parse kernel release '%s': %s" % (release, ex))
+        return None
+
+    if result.arch is None and machine:
+        result.arch = get_canon_arch(machine)
+
+    if result.arch is None:
+        start = data.find(ELFMAG, 0, SIGNATURE_RANGE)
+        if start >= 0:
+            result.arch = header_arch(data, start)
+
+    if result.arch is None:
+        log_debug("Unable to determine architecture of '%s'" % release)
+        return None
+
+    return result
+
+def read_ftp_head(filename, size=HEAD_SIZE):
+    """Reads the first size bytes of a file on the FTP server."""
+    from ftppool import get_ftp_pool
+
+    pool = get_ftp_pool()
+    ftp = pool.get()
+    try:
+        ftp.voidcmd("TYPE I")
+        conn = ftp.transfercmd("RETR %s" % filename)
+        result = []
+        received = 0
+        while received < size:
+            data = conn.recv(min(size - received, 1 << 16))
+            if not data:
+                break
+
+            result.append(data)
+            received += len(data)
+
+        conn.close()
+    finally:
+        # the aborted transfer leaves the connection in an unknown state
+        pool.discard(ftp)
+
+    return "".join(result)
+
+def read_head(url, size=HEAD_SIZE):
+    """Reads the first size bytes of a remote resource as stored
+    by RetraceTask.add_remote."""
+    if url.startswith("FTP "):
+        return read_ftp_head(url[4:].strip(), size)
+
+    if url.startswith("file://"):
+        url = url[7:]
+
+    if url.startswith("/"):
+        with open(url, "rb") as f:
+            return f.read(size)
+
+    request = urllib2.Request(url, headers={"Range": "bytes=0-%d" % (size - 1)})
+    response = urllib2.urlopen(request, timeout=60)
+    try:
+        # the server may ignore Range and send everything
+        return response.read(size)
+    finally:
+        response.close()
+
+def prefetch_kernel(kernelver):
+    """Downloads the kernel debuginfo and extracts vmlinux so that
+    the task processing the vmcore finds them ready. Returns True
+    on success."""
+    log_info("Prefetching debuginfo of kernel %s" % kernelver)
+    try:
+        vmlinux = cache_vmlinux(kernelver)[0]
+    except Exception as ex:
+        log_warn("Unable to prefetch debuginfo of kernel %s: %s" % (kernelver, ex))
+        return False
+
+    log_debug("Prefetched %s" % vmlinux)
+    return True
+
+class PrefetchIndex(object):
+    """Remembers remote vmcores whose kernel has been prefetched."""
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path, timeout=60)
+        self._con.text_factory = str
+        query = self._con.cursor()
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          vmcores(url NOT NULL, size NOT NULL, release, time NOT NULL,
+                  PRIMARY KEY (url, size))
+        """)
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+    def seen(self, url, size):
+        query = self._con.cursor()
+        query.execute("SELECT 1 FROM vmcores WHERE url = ? AND size = ?", (url, size))
+        return query.fetchone() is not None
+
+    def add(self, url, size, release):
+        query = self._con.cursor()
+        query.execute("INSERT OR REPLACE INTO vmcores (url, size, release, time) "
+                      "VALUES (?, ?, ?, ?)", (url, size, release, int(time.time())))
+        query.execute("DELETE FROM vmcores WHERE time < ?",
+                      (int(time.time()) - RECORD_EXPIRATION,))
+        self._con.commit()
+
+def get_prefetch_index():
+    kerneldir = os.path.join(CONFIG["RepoDir"], "kernel")
+    if not os.path.isdir(kerneldir):
+        os.makedirs(kerneldir)
+
+    return PrefetchIndex(os.path.join(kerneldir, INDEX_FILE))
+
+class DownloadPrefetcher(threading.Thread):
+    """Waits until the head of a vmcore being downloaded into path
+    is on the disk and prefetches its kernel while the download
+    continues. Call finish() when the download is over."""
+
+    def __init__(self, path, filename=None):
+        threading.Thread.__init__(self, name="prefetch")
+        self.daemon = True
+        self.path = path
+        self.filename = filename or os.path.basename(path)
+        self.kernelver = None
+        self._finished = threading.Event()
+
+    def finish(self):
+        self._finished.set()
+
+    def run(self):
+        while True:
+            finished = self._finished.is_set()
+            try:
+                size = os.path.getsize(self.path)
+                if size >= HEAD_SIZE or (finished and size > 0):
+                    with open(self.path, "rb") as f:
+                        head = f.read(HEAD_SIZE)
+
+                    # segmented downloads preallocate the file,
+                    # wait until the beginning is written
+                    if finished or head[:SIGNATURE_RANGE].strip("\0"):
+                        break
+            except EnvironmentError:
+                pass
+
+            if finished:
+                return
+
+            self._finished.wait(POLL_INTERVAL)
+
+        try:
+            self.kernelver = kernel_release_from_head(decompress_head(head, self.filename))
+        except Exception as ex:
+            log_debug("Unable to read the head of '%s': %s" % (self.path, ex))
+            return
+
+        if self.kernelver is None:
+            log_debug("Unable to determine kernel release of '%s'" % self.path)
+            return
+
+        log_info("Kernel release read from the head of the vmcore: %s" % self.kernelver)
+        prefetch_kernel(self.kernelver)
@@ -0,0 +1,326 @@
+import os
+import sqlite3
+import stat
+
+# the index lives next to repodata in RepoDir/<releaseid>
+INDEX_FILE = "repoindex.db"
+
+BUILDID_DIRS = ["/usr/lib/debug/.build-id/", "/usr/lib/.build-id/"]
+
+# files rarely asked for, left out not to bloat the index,
+# RepoIndex.searchFiles asks yum for them (build-id links are indexed)
+SKIP_PREFIXES = ["/usr/share/", "/usr/include/", "/usr/src/debug/",
+                 "/usr/lib/debug/"]
+
+
+class IndexedEVR(object):
+    """Mimics yum's PackageEVR so that indexed packages can be
+    compared the same way as the packages from yum sack."""
+
+    def __init__(self, epoch, ver, rel):
+        self.epoch = epoch
+        self.ver = ver
+        self.rel = rel
+
+    def compare(self, other):
+        from rpmUtils.miscutils import compareEVR
+        return compareEVR((self.epoch, self.ver, self.rel),
+                          (other.epoch, other.ver, other.rel))
+
+
+class IndexedPackage(object):
+    """A package loaded from the index. Provides the subset of yum's
+    package object interface used by coredump2packages."""
+
+    def __init__(self, filename, name, epoch, ver, rel, arch, base):
+        self.filename = filename
+        self.name = name
+        self.epoch = epoch
+        self.ver = ver
+        self.rel = rel
+        self.arch = arch
+        self.base_package_name = base
+
+    def returnEVR(self):
+        return IndexedEVR(self.epoch, self.ver, self.rel)
+
+    def __str__(self):
+        if self.epoch == "0":
+            return "%s-%s-%s.%s" % (self.name, self.ver, self.rel, self.arch)
+
+        return "%s:%s-%s-%s.%s" % (self.epoch, self.name, self.ver,
+                                   self.rel, self.arch)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __cmp__(self, other):
+        result = cmp(self.name, other.name)
+        if result == 0:
+            result = self.returnEVR().compare(other.returnEVR())
+        if result == 0:
+            result = cmp(self.arch, other.arch)
+
+        return result
+
+
+class RepoIndex(object):
+    """Read access to the index of a single release. Implements
+    searchFiles and searchNevra so that it can be used instead
+    of yum's pkgSack. Files under SKIP_PREFIXES are not indexed,
+    searchFiles looks them up in the sack returned by fallback,
+    which returns (handle with close(), sack) and is only called
+    when such a file is asked for. Without fallback they are
+    never found."""
+
+    PACKAGE_COLUMNS = "rpms.filename, rpms.name, rpms.epoch, rpms.version, " \
+                      "rpms.release, rpms.arch, rpms.base"
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self._con = sqlite3.connect(path)
+        # yum returns plain strings, so do we
+        self._con.text_factory = str
+        self._fallback = fallback
+        self._fallback_handle = None
+        self._fallback_sack = None
+
+    def close(self):
+        self._con.close()
+        if self._fallback_handle is not None:
+            self._fallback_handle.close()
+            self._fallback_handle = None
+            self._fallback_sack = None
+
+    def _packages(self, query, params):
+        cursor = self._con.cursor()
+        cursor.execute(query, params)
+        return [IndexedPackage(*row) for row in cursor.fetchall()]
+
+    def searchFiles(self, path):
+        """Returns the list of packages containing the given file."""
+        for buildid_dir in BUILDID_DIRS:
+            if path.startswith(buildid_dir):
+                return self._packages("SELECT DISTINCT %s FROM rpms, buildids "
+                                      "WHERE buildids.path = ? AND "
+                                      "buildids.rpmid = rpms.id"
+                                      % RepoIndex.PACKAGE_COLUMNS, (path,))
+
+        if any(path.startswith(prefix) for prefix in SKIP_PREFIXES):
+            if self._fallback is None:
+                return []
+
+            if self._fallback_sack is None:
+                self._fallback_handle, self._fallback_sack = self._fallback()
+
+            return self._fallback_sack.searchFiles(path)
+
+        return self._packages("SELECT DISTINCT %s FROM rpms, files "
+                              "WHERE files.path = ? AND files.rpmid = rpms.id"
+                              % RepoIndex.PACKAGE_COLUMNS, (path,))
+
+    def searchNevra(self, name=None, epoch=None, ver=None, rel=None, arch=None):
+        """Returns the list of packages matching all given attributes."""
+        conditions = []
+        params = []
+        for column, value in [("name", name), ("epoch", epoch),
+                              ("version", ver), ("release", rel),
+                              ("arch", arch)]:
+            if value is None:
+                continue
+
+            conditions.append("%s = ?" % column)
+            params.append(value)
+
+        query = "SELECT %s FROM rpms" % RepoIndex.PACKAGE_COLUMNS
+        if conditions:
+            query = "%s WHERE %s" % (query, " AND ".join(conditions))
+
+        return self._packages(query, params)
+
+    def search_buildid(self, build_id):
+        """Returns the list of (package, path, target) tuples for
+        all build-id links pointing to the given build-id."""
+        cursor = self._con.cursor()
+        cursor.execute("SELECT %s, buildids.path, buildids.target "
+                       "FROM rpms, buildids WHERE buildids.buildid = ? "
+                       "AND buildids.rpmid = rpms.id"
+                       % RepoIndex.PACKAGE_COLUMNS, (build_id,))
+
+        return [(IndexedPackage(*row[:7]), row[7], row[8])
+                for row in cursor.fetchall()]
+
+    def package_buildids(self, filename):
+        """Returns the list of (build-id, path, target) tuples for
+        all build-id links in the RPM with the given file name."""
+        cursor = self._con.cursor()
+        cursor.execute("SELECT buildids.buildid, buildids.path, buildids.target "
+                       "FROM rpms, buildids WHERE rpms.filename = ? "
+                       "AND buildids.rpmid = rpms.id", (filename,))
+
+        return cursor.fetchall()
+
+    def has_package(self, filename):
+        """Verifies whether an RPM with the given file name is indexed."""
+        cursor = self._con.cursor()
+        cursor.execute("SELECT id FROM rpms WHERE filename = ?", (filename,))
+        return cursor.fetchone() is not None
+
+
+def _open_index_db(path):
+    con = sqlite3.connect(path)
+    query = con.cursor()
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      rpms(id INTEGER PRIMARY KEY AUTOINCREMENT, filename NOT NULL UNIQUE,
+           size NOT NULL, mtime NOT NULL, name NOT NULL, epoch NOT NULL,
+           version NOT NULL, release NOT NULL, arch NOT NULL, base NOT NULL)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      buildids(buildid NOT NULL, rpmid REFERENCES rpms(id),
+               path NOT NULL, target)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      files(path NOT NULL, rpmid REFERENCES rpms(id))
+    """)
+    query.execute("CREATE INDEX IF NOT EXISTS rpms_nevra ON rpms(name, version, release, arch)")
+    query.execute("CREATE INDEX IF NOT EXISTS buildids_buildid ON buildids(buildid)")
+    query.execute("CREATE INDEX IF NOT EXISTS buildids_path ON buildids(path)")
+    query.execute("CREATE INDEX IF NOT EXISTS buildids_rpmid ON buildids(rpmid)")
+    query.execute("CREATE INDEX IF NOT EXISTS files_path ON files(path)")
+    query.execute("CREATE INDEX IF NOT EXISTS files_rpmid ON files(rpmid)")
+    con.commit()
+
+    return con
+
+def _read_header(ts, path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return ts.hdrFromFdno(fd)
+    finally:
+        os.close(fd)
+
+def _index_rpm(query, ts, path, st):
+    import rpm
+    from rpmUtils.miscutils import splitFilename
+
+    hdr = _read_header(ts, path)
+    name = hdr[rpm.RPMTAG_NAME]
+    epoch = hdr[rpm.RPMTAG_EPOCH]
+    if epoch is None:
+        epoch = "0"
+
+    # the same as yum's base_package_name
+    base = name
+    sourcerpm = hdr[rpm.RPMTAG_SOURCERPM]
+    if sourcerpm:
+        base = splitFilename(sourcerpm)[0]
+
+    query.execute("""
+      INSERT INTO rpms (filename, size, mtime, name, epoch,
+                        version, release, arch, base)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+      """,
+      (os.path.basename(path), st.st_size, int(st.st_mtime), name,
+       str(epoch), hdr[rpm.RPMTAG_VERSION], hdr[rpm.RPMTAG_RELEASE],
+       hdr[rpm.RPMTAG_ARCH], base))
+    rpmid = query.lastrowid
+
+    filenames = hdr[rpm.RPMTAG_FILENAMES]
+    modes = hdr[rpm.RPMTAG_FILEMODES]
+    linktos = hdr[rpm.RPMTAG_FILELINKTOS]
+    for i in xrange(len(filenames)):
+        filename = filenames[i]
+        mode = modes[i] & 0xFFFF
+
+        buildid_dir = None
+        for candidate in BUILDID_DIRS:
+            if filename.startswith(candidate):
+                buildid_dir = candidate
+                break
+
+        if buildid_dir is not None:
+            if not stat.S_ISLNK(mode):
+                continue
+
+            # /usr/lib/debug/.build-id/xx/yyyy[.debug] -> ../../../target
+            buildid = filename[len(buildid_dir):].replace("/", "")
+            if buildid.endswith(".debug"):
+                buildid = buildid[:-6]
+
+            target = os.path.normpath(os.path.join(os.path.dirname(filename),
+                                                   linktos[i]))
+            query.execute("""
+              INSERT INTO buildids (buildid, rpmid, path, target)
+              VALUES (?, ?, ?, ?)
+              """, (buildid, rpmid, filename, target))
+            continue
+
+        if stat.S_ISDIR(mode) or \
+           any(filename.startswith(p) for p in SKIP_PREFIXES):
+            continue
+
+        query.execute("INSERT INTO files (path, rpmid) VALUES (?, ?)",
+                      (filename, rpmid))
+
+def update_repo_index(repodir, log=None):
+    """Incrementally (re)indexes all RPMs in repodir. Only packages
+    that were added or changed since the last run are read.
+    Returns a tuple (added, removed)."""
+    import rpm
+
+    packages = {}
+    for subdir in [os.path.join(repodir, "Packages"), repodir]:
+        if not os.path.isdir(subdir):
+            continue
+
+        for filename in os.listdir(subdir):
+            if filename.endswith(".rpm"):
+                packages[filename] = os.path.join(subdir, filename)
+
+    con = _open_index_db(os.path.join(repodir, INDEX_FILE))
+    query = con.cursor()
+
+    indexed = {}
+    query.execute("SELECT id, filename, size, mtime FROM rpms")
+    for rpmid, filename, size, mtime in query.fetchall():
+        indexed[filename] = (rpmid, size, mtime)
+
+    removed = 0
+    for filename, (rpmid, size, mtime) in indexed.items():
+        if filename in packages:
+            st = os.stat(packages[filename])
+            if st.st_size == size and int(st.st_mtime) == mtime:
+                continue
+
+        query.execute("DELETE FROM files WHERE rpmid = ?", (rpmid,))
+        query.execute("DELETE FROM buildids WHERE rpmid = ?", (rpmid,))
+        query.execute("DELETE FROM rpms WHERE id = ?", (rpmid,))
+        del indexed[filename]
+        removed += 1
+
+    ts = rpm.TransactionSet()
+    # signatures are verified by yum/mock at install time
+    ts.setVSFlags(-1)
+
+    added = 0
+    for filename in sorted(packages):
+        if filename in indexed:
+            continue
+
+        path = packages[filename]
+        try:
+            _index_rpm(query, ts, path, os.stat(path))
+        except Exception as ex:
+            if log:
+                log("Unable to index '%s': %s" % (path, ex))
+            continue
+
+        added += 1
+
+    con.commit()
+    con.close()
+
+    return added, removed
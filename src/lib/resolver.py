@@ -0,0 +1,417 @@
+import json
+import os
+import socket
+import SocketServer
+import sys
+import tempfile
+from retrace import *
+from StringIO import StringIO
+
+def get_unstrip_output(coredump, coreinfo=None):
+    """Returns eu-unstrip output, which contains build-ids
+    and binary object paths. The list of modules read by elfcore
+    is used instead of running eu-unstrip if coreinfo contains one."""
+    if coreinfo is not None and coreinfo.get("unstrip"):
+        return coreinfo["unstrip"].encode("utf-8")
+
+    unstrip_args = ["eu-unstrip", "--core={0}".format(coredump), "-n"]
+    unstrip_proc = Popen(unstrip_args, stdout=PIPE)
+    return unstrip_proc.communicate()[0]
+
+def load_yum(repos="*", config=None, log=None):
+    """Initializes yum, enables only repositories matching repos.
+    Returns YumBase, its pkgSack is only valid as long as YumBase lives."""
+    import yum
+
+    if log is None:
+        log = open(os.devnull, "w")
+
+    stdout = sys.stdout
+    sys.stdout = log
+    try:
+        yumbase = yum.YumBase()
+        if config:
+            yumbase.doConfigSetup(config)
+        else:
+            yumbase.doConfigSetup()
+        if not yumbase.setCacheDir():
+            raise Exception, "Unable to initialize yum cache"
+        log.write("Closing all enabled repositories...\n")
+        for repo in yumbase.repos.listEnabled():
+            log.write(" - {0}\n".format(repo.name))
+            repo.close()
+            yumbase.repos.disableRepo(repo.id)
+        log.write("Enabling repositories matching \'{0}\'...\n".format(repos))
+        for repo in yumbase.repos.findRepos(repos):
+            log.write(" - {0}\n".format(repo.name))
+            repo.enable()
+            repo.skip_if_unavailable = True
+        yumbase.repos.doSetup()
+        yumbase.repos.populateSack(mdtype='metadata', cacheonly=1)
+        yumbase.repos.populateSack(mdtype='filelists', cacheonly=1)
+    finally:
+        sys.stdout = stdout
+
+    return yumbase
+
+def load_release_yum(releaseid, log=None):
+    """Initializes yum with the repository of the release in RepoDir only.
+    Returns YumBase, its pkgSack is only valid as long as YumBase lives."""
+    repoid = "%s%s" % (REPO_PREFIX, releaseid)
+    yumcfg = tempfile.NamedTemporaryFile(mode="w", delete=False,
+                                         prefix="resolver", suffix=".conf")
+    try:
+        yumcfg.write("[%s]\n" % repoid)
+        yumcfg.write("name=%s\n" % releaseid)
+        yumcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
+        yumcfg.write("failovermethod=priority\n")
+        yumcfg.close()
+
+        return load_yum(repoid, yumcfg.name, log)
+    finally:
+        os.unlink(yumcfg.name)
+
+def binary_packages_from_debuginfo_package(sack, debuginfo_package, binobj_path, log):
+    """
+    Returns a list of packages corresponding to the provided debuginfo
+    package. One of the packages in the list contains the binary
+    specified in binobj_path; this is a list because if binobj_patch
+    is not specified (and sometimes it is not, binobj_path might
+    contain just '-'), we do not know which package contains the
+    binary, we know only packages from the same SRPM as the debuginfo
+    package.
+    """
+    package_list = []
+    if binobj_path == '-': # [exe] without binary name
+        log.write("   Yum search for [exe] without binary name, "
+                  "packages with NVR {0}:{1}-{2}.{3}...\n".format(debuginfo_package.epoch,
+                                                                  debuginfo_package.ver,
+                                                                  debuginfo_package.rel,
+                                                                  debuginfo_package.arch))
+        # Append all packages with the same base package name.
+        # Other possibility is to download the debuginfo RPM,
+        # unpack it, and get the name of the binary from the
+        # /usr/lib/debug/.build-id/xx/yyyyyy symlink.
+        evra_list = sack.searchNevra(epoch=debuginfo_package.epoch,
+                                     ver=debuginfo_package.ver,
+                                     rel=debuginfo_package.rel,
+                                     arch=debuginfo_package.arch)
+        for package in evra_list:
+            log.write("    - {0}: base name \"{1}\"\n".format(str(package), package.base_package_name))
+            if package.base_package_name != debuginfo_package.base_package_name:
+                continue
+            package_list.append(package)
+    else:
+        log.write("   Yum search for {0}...\n".format(binobj_path))
+        binobj_package_list = sack.searchFiles(binobj_path)
+        for binobj_package in binobj_package_list:
+            log.write("    - {0}".format(str(binobj_package)))
+            if 0 != binobj_package.returnEVR().compare(debuginfo_package.returnEVR()):
+                log.write(": NVR doesn't match\n")
+                continue
+            log.write(": NVR matches\n")
+            package_list.append(binobj_package)
+    return package_list
+
+def process_unstrip_entry(sack, build_id, binobj_path, log):
+    """
+    Returns a tuple of two items.
+
+    First item is a list of packages which we found to be associated
+    with the unstrip entry defined by build_id and binobj_path.
+
+    Second item is a list of package versions (same package name,
+    different epoch-version-release), which contain the binary object
+    (an executable or shared library) corresponding to this unstrip
+    entry. If this method failed to find an unique package name (with
+    only different versions), this list contains the list of base
+    package names. This item can be used to associate a coredump with
+    some crashing package.
+    """
+    package_list = []
+    coredump_package_list = []
+    coredump_base_package_list = []
+    # Ask for a known path from debuginfo package.
+    debuginfo_path = "/usr/lib/debug/.build-id/{0}/{1}.debug".format(build_id[:2], build_id[2:])
+    log.write("Yum search for {0}...\n".format(debuginfo_path))
+    debuginfo_package_list = sack.searchFiles(debuginfo_path)
+
+    # A problem here is that some libraries lack debuginfo. Either
+    # they were stripped during build, or they were not stripped by
+    # /usr/lib/rpm/find-debuginfo.sh because of wrong permissions or
+    # something. The proper solution is to detect such libraries and
+    # fix the packages.
+    for debuginfo_package in debuginfo_package_list:
+        log.write(" - {0}\n".format(str(debuginfo_package)))
+        package_list.append(debuginfo_package)
+        binary_packages = binary_packages_from_debuginfo_package(sack, debuginfo_package, binobj_path, log)
+        coredump_base_package_list.append(debuginfo_package.base_package_name)
+        if len(binary_packages) == 1:
+            coredump_package_list.append(str(binary_packages[0]))
+        package_list.extend(binary_packages)
+    if len(coredump_package_list) == len(coredump_base_package_list):
+        return package_list, coredump_package_list
+    else:
+        return package_list, coredump_base_package_list
+
+def process_unstrip_output(sack, unstrip, log):
+    """
+    Parse the eu-unstrip output, and search for packages via yum.
+
+    Returns a tuple containing three items:
+      - a list of package objects
+      - a list of missing buildid entries
+      - a list of coredump package adepts
+    """
+    # List of packages found in yum repositories and matching the
+    # coredump.
+    package_list = []
+    # str() of every package in package_list
+    seen = set()
+    # List of pairs (library/executable path, build id) which were not
+    # found via yum.
+    missing_buildid_list = []
+    # coredump package adepts
+    coredump_package_list = []
+    first_entry = True
+    for line in unstrip.split('\n'):
+        parts = line.split()
+        if not parts or len(parts) < 3:
+            continue
+        build_id = parts[1].split('@')[0]
+        binobj_path = parts[2]
+        # try/except to handle malformed eu-unstrip output
+        # e.g. for X.org cores
+        try:
+            if binobj_path[0] != '/' and parts[4] != '[exe]':
+                continue
+        except:
+            continue
+        entry_package_list, entry_coredump_package_list = \
+            process_unstrip_entry(sack, build_id, binobj_path, log)
+        if first_entry:
+            coredump_package_list = entry_coredump_package_list
+            first_entry = False
+        if len(entry_package_list) == 0:
+            missing_buildid_list.append([binobj_path, build_id])
+        else:
+            for entry_package in entry_package_list:
+                if str(entry_package) not in seen:
+                    seen.add(str(entry_package))
+                    package_list.append(entry_package)
+    return package_list, missing_buildid_list, coredump_package_list
+
+def _build_key(package):
+    return (package.base_package_name, package.epoch, package.ver, package.rel)
+
+def remove_duplicates(package_list, log):
+    """
+    The package list might contain multiple packages with the same name,
+    but different version. This happens because some binary had the same
+    build id over multiple package releases.
+
+    For every such name keeps the build (base package name + EVR) that
+    the most packages in the list come from, newer one on a tie, and
+    removes all packages of the other builds. Returns the new list.
+    """
+    # number of packages coming from the same build and arch
+    counts = {}
+    for package in package_list:
+        key = _build_key(package) + (package.arch,)
+        counts[key] = counts.get(key, 0) + 1
+
+    # one representative package of each build, grouped by name
+    builds = {}
+    for package in package_list:
+        group = builds.setdefault(package.name, {})
+        group.setdefault(_build_key(package), package)
+
+    log.write("Checking for duplicates...\n")
+    removed = set()
+    for name in sorted(builds):
+        candidates = [p for k, p in builds[name].items() if k not in removed]
+        if len(candidates) < 2:
+            continue
+
+        def count(package):
+            return counts[_build_key(package) + (package.arch,)]
+
+        best = candidates[0]
+        for package in candidates[1:]:
+            if count(package) > count(best) or \
+               (count(package) == count(best) and \
+                package.returnEVR().compare(best.returnEVR()) > 0):
+                best = package
+
+        log.write(" - {0}\n".format(name))
+        for package in candidates:
+            log.write("   - {0}:{1}-{2}.{3} ({4} dependent packages)\n".format(package.epoch,
+                                                                               package.ver,
+                                                                               package.rel,
+                                                                               package.arch,
+                                                                               count(package)))
+        for package in candidates:
+            if package is best:
+                continue
+
+            if count(package) == count(best):
+                reason = "it's older"
+            else:
+                reason = "has fewer dependencies"
+            log.write("   - decided to remove {0}:{1}-{2}.{3} because {4}\n".format(package.epoch,
+                                                                                  package.ver,
+                                                                                  package.rel,
+                                                                                  package.arch,
+                                                                                  reason))
+            removed.add(_build_key(package))
+
+    return [p for p in package_list if _build_key(p) not in removed]
+
+def resolve_packages(sack, unstrip, log):
+    """
+    Finds packages necessary for processing of a coredump
+    described by eu-unstrip output.
+
+    Returns a tuple containing three items:
+      - the crashing package or None if it is not unique
+      - a sorted list of package objects
+      - a list of missing buildid entries
+    """
+    package_list, missing_buildid_list, coredump_package_list = \
+        process_unstrip_output(sack, unstrip, log)
+    package_list = remove_duplicates(package_list, log)
+
+    # Clean coredump_package_list
+    names = set(str(p) for p in package_list)
+    base_names = set(p.base_package_name for p in package_list)
+    coredump_package_list = [p for p in coredump_package_list
+                             if p in names or p in base_names]
+
+    crash_package = None
+    if len(coredump_package_list) == 1:
+        crash_package = coredump_package_list[0]
+
+    return crash_package, sorted(package_list), missing_buildid_list
+
+def format_result(crash_package, package_list, missing_buildid_list):
+    """
+    Names of found packages first, then a newline separator, and
+    then objects for which the packages were not found.
+    """
+    lines = [crash_package or "-", ""]
+    lines.extend(str(package) for package in package_list)
+    lines.append("")
+    lines.extend("{0} {1}".format(path, build_id)
+                 for path, build_id in missing_buildid_list)
+
+    return "\n".join(lines) + "\n"
+
+class SackCache(object):
+    """Keeps one sack per release loaded. A sack is reloaded when
+    createrepo or the package index rewrites the release's metadata."""
+
+    def __init__(self):
+        self._sacks = {}
+
+    def _stamp(self, releaseid):
+        from repoindex import INDEX_FILE
+
+        repodir = os.path.join(CONFIG["RepoDir"], releaseid)
+        stamp = []
+        for path in [os.path.join(repodir, "repodata", "repomd.xml"),
+                     os.path.join(repodir, INDEX_FILE)]:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+
+        return tuple(stamp)
+
+    def _load(self, releaseid, log):
+        index = get_repo_index(releaseid)
+        if index is not None:
+            log.write("Using package index {0}\n".format(index.path))
+            return index, index
+
+        yumbase = load_release_yum(releaseid, log)
+        return yumbase, yumbase.pkgSack
+
+    def get(self, releaseid, log=None):
+        if log is None:
+            log = open(os.devnull, "w")
+
+        stamp = self._stamp(releaseid)
+        if releaseid in self._sacks:
+            if self._sacks[releaseid][0] == stamp:
+                return self._sacks[releaseid][2]
+
+            log_info("Metadata of '%s' changed, reloading" % releaseid)
+            self.drop(releaseid)
+
+        handle, sack = self._load(releaseid, log)
+        self._sacks[releaseid] = (stamp, handle, sack)
+
+        return sack
+
+    def drop(self, releaseid):
+        if releaseid not in self._sacks:
+            return
+
+        handle = self._sacks.pop(releaseid)[1]
+        try:
+            handle.close()
+        except Exception as ex:
+            log_warn("Unable to close sack of '%s': %s" % (releaseid, ex))
+
+class ResolverHandler(SocketServer.StreamRequestHandler):
+    """Reads a single JSON line {"releaseid": ..., "unstrip": ...}
+    and replies with {"output": ..., "log": ...} or {"error": ...}."""
+
+    def handle(self):
+        log = StringIO()
+        try:
+            request = json.loads(self.rfile.readline())
+            releaseid = request["releaseid"].encode("utf-8")
+            unstrip = request["unstrip"].encode("utf-8")
+            if not releaseid in get_supported_releases():
+                raise Exception, "Unsupported release '%s'" % releaseid
+
+            sack = self.server.sacks.get(releaseid, log)
+            result = resolve_packages(sack, unstrip, log)
+            response = {"output": format_result(*result), "log": log.getvalue()}
+        except Exception as ex:
+            log_error("Unable to resolve packages: %s" % ex)
+            response = {"error": str(ex)}
+
+        self.wfile.write("%s\n" % json.dumps(response))
+
+class ResolverServer(SocketServer.UnixStreamServer):
+    """Serves the requests one by one, the sacks are not thread-safe
+    and a single lookup is cheap once the sack is loaded."""
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        SocketServer.UnixStreamServer.__init__(self, path, ResolverHandler)
+        os.chmod(path, 0660)
+        self.sacks = SackCache()
+
+def query_resolver(releaseid, unstrip):
+    """Asks retrace-server-resolver for packages of the coredump described
+    by eu-unstrip output. Returns a tuple (output, log), output is
+    the same as coredump2packages prints."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONFIG["ResolverTimeout"])
+    try:
+        sock.connect(CONFIG["ResolverSocket"])
+        sock.sendall("%s\n" % json.dumps({"releaseid": releaseid,
+                                          "unstrip": unstrip}))
+        response = json.loads(sock.makefile("r").readline())
+    finally:
+        sock.close()
+
+    if "error" in response:
+        raise Exception, response["error"]
+
+    return response["output"].encode("utf-8"), response["log"].encode("utf-8")
@@ -1,8 +1,10 @@
 import ConfigParser
 import datetime
 import errno
+import fcntl
 import ftplib
 import gettext
+import json
 import logging
 import magic
 import os
@@ -12,12 +14,16 @@ import shutil
 import smtplib
 import sqlite3
 import stat
+import threading
 import time
 import urllib
+import urlparse
 from argparser import *
 from webob import Request
 from yum import YumBase
 from subprocess import *
+# children are accounted, see RetraceWorker.start
+from accounting import Popen, call, start_accounting, stop_accounting
 from config import *
 
 GETTEXT_DOMAIN = "retrace-server"
@@ -128,9 +134,19 @@ FTP_SUPPORTED_EXTENSIONS = [".tar.gz", ".tgz", ".tarz", ".tar.bz2", ".tar.xz",
                             ".tar", ".gz", ".bz2", ".xz", ".Z", ".zip"]
 
 REPO_PREFIX = "retrace-"
+PAYLOAD_INDEX_FILE = "payloads.db"
 EXPLOITABLE_PLUGIN_PATH = "/usr/libexec/abrt-gdb-exploitable"
 EXPLOITABLE_SEPARATOR = "== EXPLOITABLE ==\n"
 
+# crash/download-N is where the N-th remote resource is downloaded
+DOWNLOAD_PART_PREFIX = "download-"
+
+# FastTierDir/<taskid>.reserved keeps the number of bytes
+# the task is expected to need on the fast tier
+FAST_TIER_RESERVED_SUFFIX = ".reserved"
+# compressed files are expected to unpack into this many times their size
+UNPACKED_SIZE_RATIO = 8
+
 TASKPASS_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
 CONFIG_FILE = "/etc/retrace-server.conf"
@@ -152,6 +168,9 @@ CONFIG = {
   "SaveDir": "/var/spool/retrace-server",
   "WorkDir": "/tmp/retrace-server",
   "UseWorkDir": False,
+  "UseFastTier": False,
+  "FastTierDir": "/dev/shm/retrace-server",
+  "FastTierSize": 4096,
   "RequireHTTPS": True,
   "AllowAPIDelete": False,
   "AllowExternalDir": False,
@@ -168,12 +187,31 @@ CONFIG = {
   "FTPPass": "",
   "FTPDir": "/",
   "FTPBufferSize": 16,
+  "FTPConnections": 4,
+  "FTPPoolSize": 4,
+  "FTPListingCacheTime": 60,
+  "MaxParallelDownloads": 4,
+  "HTTPConnections": 4,
+  "UseStreamUnpack": False,
   "WgetKernelDebuginfos": False,
   "KernelDebuginfoURL": "http://kojipkgs.fedoraproject.org/packages/kernel/$VERSION/$RELEASE/$ARCH/",
   "VmcoreDumpLevel": 0,
+  "VmcoreStripThreads": 0,
   "VmcoreRunKmem": 0,
+  "VmcoreCrashGroups": "",
+  "VmcoreCrashSessions": 0,
+  "MaxDebuggerOutput": 256,
   "RequireGPGCheck": True,
   "UseCreaterepoUpdate": False,
+  "UseRepoIndex": False,
+  "UseResolver": False,
+  "ResolverSocket": "/var/run/retrace-server/resolver.sock",
+  "ResolverTimeout": 600,
+  "UseDebuginfoCache": False,
+  "UseKernelIndex": False,
+  "DebuginfoCacheSize": 10240,
+  "KernelCacheSize": 0,
+  "UseDebuginfoPrefetch": False,
   "DBFile": "stats.db",
   "KernelChrootRepo": "http://dl.fedoraproject.org/pub/fedora/linux/releases/16/Everything/$ARCH/os/",
   "UseFafPackages": False,
@@ -188,6 +226,9 @@ CONFIG = {
 ARCH_HOSTS = {}
 HOOK_SCRIPTS = {}
 
+# see get_faf_db
+_faf_db = None
+
 STATUS_ANALYZE, STATUS_INIT, STATUS_BACKTRACE, STATUS_CLEANUP, \
 STATUS_STATS, STATUS_FINISHING, STATUS_SUCCESS, STATUS_FAIL, \
 STATUS_DOWNLOADING, STATUS_POSTPROCESS = xrange(10)
@@ -278,6 +319,179 @@ def unlock(lockfile):
 
     return True
 
+class FileLock(object):
+    """Exclusive lock held while in the with block, blocks until
+    the lock is acquired. Unlike lock(), it is released automatically
+    when the process dies, so it can be waited on."""
+
+    def __init__(self, lockfile):
+        self.lockfile = lockfile
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except:
+            os.close(self._fd)
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+class AtomicFile(object):
+    """File written as path.tmp and renamed to path by close(),
+    discard() removes it instead."""
+
+    def __init__(self, path):
+        self.path = path
+        self._tmppath = "%s.tmp" % path
+        self._file = open(self._tmppath, "w")
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            os.rename(self._tmppath, self.path)
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+            os.unlink(self._tmppath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+class PhaseTimer(object):
+    """Measures how long the phases of a task take. switch(name) ends
+    the current phase and starts the next one, a phase entered more
+    than once accumulates its time. add() records work done in parallel
+    with the current phase, such as unpacking while downloading."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = []
+        self._durations = {}
+        self._current = None
+        self._since = None
+
+    def _record(self, name, seconds):
+        if not name in self._durations:
+            self._names.append(name)
+            self._durations[name] = 0.0
+
+        self._durations[name] += seconds
+
+    def switch(self, name):
+        """Starts phase name, None just ends the current one."""
+        now = time.time()
+        with self._lock:
+            if self._current is not None:
+                self._record(self._current, now - self._since)
+
+            if name is not None:
+                # keep the phases in the order they are entered
+                self._record(name, 0.0)
+
+            self._current = name
+            self._since = now
+
+    def stop(self):
+        self.switch(None)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._record(name, seconds)
+
+    def items(self):
+        """Returns [(name, seconds), ...] in the order the phases
+        have been entered, including the current one."""
+        now = time.time()
+        with self._lock:
+            durations = dict(self._durations)
+            if self._current is not None:
+                durations[self._current] += now - self._since
+
+            return [(name, durations[name]) for name in self._names]
+
+    def format(self):
+        return "".join("%-16s %10.1f s\n" % (name, seconds) for (name, seconds) in self.items())
+
+class CappedOutput(object):
+    """Writes debugger output into a file as it comes. The file is
+    obtained by calling opener once there is something to write,
+    so nothing is created for empty output. Leading and trailing
+    whitespace is dropped like str.strip() would do and no more
+    than limit bytes are written, the rest is replaced by a note."""
+
+    def __init__(self, opener, limit=None):
+        self._opener = opener
+        self._file = None
+        self._limit = limit
+        # trailing whitespace, written only if more data follows
+        self._pending = ""
+        self.written = 0
+        self.truncated = False
+
+    def write(self, data):
+        if self.truncated:
+            return
+
+        if not self.written:
+            data = data.lstrip()
+            if not data:
+                return
+
+        stripped = data.rstrip()
+        if not stripped:
+            self._pending += data
+            return
+
+        self._write(self._pending + stripped)
+        self._pending = data[len(stripped):]
+
+    def _write(self, data):
+        if self._file is None:
+            self._file = self._opener()
+
+        if self._limit is not None and self.written + len(data) > self._limit:
+            data = data[:self._limit - self.written]
+            self.truncated = True
+
+        self._file.write(data)
+        self.written += len(data)
+        if self.truncated:
+            self._file.write("\n\n... output truncated, the limit of %d bytes "
+                             "has been exceeded\n" % self._limit)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def discard(self):
+        """Removes the output if the file supports it, closes it otherwise."""
+        if self._file is not None:
+            getattr(self._file, "discard", self._file.close)()
+
+def get_debugger_output_limit():
+    """Returns MaxDebuggerOutput in bytes, None if unlimited."""
+    if CONFIG["MaxDebuggerOutput"] <= 0:
+        return None
+
+    return CONFIG["MaxDebuggerOutput"] << 20
+
 def get_canon_arch(arch):
     for canon_arch, derived_archs in ARCH_MAP.items():
         if arch in derived_archs:
@@ -338,6 +552,70 @@ def dir_size(path):
 
     return 0
 
+def _fast_tier_usage(fastdir):
+    """Returns the number of bytes used or reserved by tasks on the fast tier."""
+    result = 0
+    for f in os.listdir(fastdir):
+        path = os.path.join(fastdir, f)
+        if not os.path.isdir(path):
+            continue
+
+        try:
+            # sparse cores take less than their size out of FastTierSize
+            used = sum(item[2] for item in get_files_sizes(path, allocated=True))
+        except OSError:
+            # being removed
+            used = 0
+
+        try:
+            with open("%s%s" % (path, FAST_TIER_RESERVED_SUFFIX), "r") as reserved:
+                used = max(used, int(reserved.read()))
+        except (IOError, ValueError):
+            pass
+
+        result += used
+
+    return result
+
+def reserve_fast_tier(taskid, size):
+    """Creates FastTierDir/<taskid> for the crash data of the task if size
+    bytes fit into FastTierSize together with the other tasks there.
+    Returns the directory or None if the task does not fit."""
+    if not CONFIG["UseFastTier"] or size is None:
+        return None
+
+    fastdir = CONFIG["FastTierDir"]
+    taskdir = os.path.join(fastdir, "%d" % taskid)
+    try:
+        if not os.path.isdir(fastdir):
+            os.makedirs(fastdir)
+
+        with FileLock(os.path.join(fastdir, ".lock")):
+            used = _fast_tier_usage(fastdir)
+            space = free_space(fastdir)
+            if used + size > CONFIG["FastTierSize"] << 20 or space is None or space < size:
+                log_debug("%s do not fit into the fast tier, %s used"
+                          % (human_readable_size(size), human_readable_size(used)))
+                return None
+
+            os.mkdir(taskdir)
+            with open("%s%s" % (taskdir, FAST_TIER_RESERVED_SUFFIX), "w") as reserved:
+                reserved.write("%d" % size)
+    except EnvironmentError as ex:
+        log_warn("Unable to use the fast tier: %s" % ex)
+        return None
+
+    return taskdir
+
+def release_fast_tier(taskdir):
+    """Removes a directory created by reserve_fast_tier."""
+    shutil.rmtree(taskdir, ignore_errors=True)
+    try:
+        os.unlink("%s%s" % (taskdir, FAST_TIER_RESERVED_SUFFIX))
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
 def unpacked_size(archive, mime):
     command, parser = HANDLE_ARCHIVE[mime]["size"]
     child = Popen(command + [archive], stdout=PIPE)
@@ -350,6 +628,13 @@ def unpacked_size(archive, mime):
     return None
 
 def guess_arch(coredump_path):
+    # ELF header is enough unless the machine is unknown
+    # or the file is not an ELF core at all (kdump-compressed vmcore)
+    from elfcore import read_elf_arch
+    result = read_elf_arch(coredump_path)
+    if result is not None:
+        return result
+
     child = Popen(["file", coredump_path], stdout=PIPE)
     output = child.communicate()[0]
     match = CORE_ARCH_PARSER.search(output)
@@ -433,7 +718,10 @@ def parse_http_gettext(lang, charset):
 
     return result
 
-def run_gdb(savedir):
+def run_gdb(savedir, backtrace, exploitable):
+    """Runs GDB on the coredump in the mock chroot. The output is written
+    into backtrace, the output of abrt-exploitable into exploitable
+    (file-like objects, usually CappedOutput) as it comes."""
     #exception is caught on the higher level
     exec_file = open(os.path.join(savedir, "crash", "executable"), "r")
     executable = exec_file.read(ALLOWED_FILES["executable"])
@@ -465,6 +753,9 @@ def run_gdb(savedir):
         batfile = os.path.join(savedir, "gdb.sh")
         with open(batfile, "w") as gdbfile:
             gdbfile.write("gdb -batch ")
+            if CONFIG["UseDebuginfoCache"]:
+                from debugcache import CHROOT_DIR
+                gdbfile.write("-ex 'set debug-file-directory /usr/lib/debug:%s' " % CHROOT_DIR)
             if add_exploitable:
                 gdbfile.write("-ex 'python execfile(\"/usr/libexec/abrt-gdb-exploitable\")' ")
             gdbfile.write("-ex 'file %s' "
@@ -496,25 +787,27 @@ def run_gdb(savedir):
                        # redirect GDB's stderr, ignore mock's stderr
                        "2>&1"], stdout=PIPE, stderr=null)
 
-    backtrace = child.communicate()[0].strip()
+    # a backtrace of thousands of threads does not fit into memory
+    output = backtrace
+    for line in iter(child.stdout.readline, ""):
+        if output is backtrace and line.endswith(EXPLOITABLE_SEPARATOR):
+            output.write(line[:-len(EXPLOITABLE_SEPARATOR)])
+            output = exploitable
+        else:
+            output.write(line)
+
+    child.stdout.close()
     if child.wait():
         raise Exception("Running GDB failed")
 
-    exploitable = None
-    if EXPLOITABLE_SEPARATOR in backtrace:
-        backtrace, exploitable = backtrace.rsplit(EXPLOITABLE_SEPARATOR, 1)
-
-    if not backtrace:
+    if not backtrace.written:
         raise Exception("An unusable backtrace has been generated")
 
-    return backtrace, exploitable
-
 def is_package_known(package_nvr, arch, releaseid=None):
     if CONFIG["UseFafPackages"]:
-        from pyfaf.storage import getDatabase
         from pyfaf.queries import get_package_by_nevra
         from rpmUtils.miscutils import splitFilename
-        db = getDatabase()
+        db = get_faf_db()
         (n, v, r, e, _a) = splitFilename(package_nvr+".mockarch.rpm")
         for derived_archs in ARCH_MAP.values():
             if arch not in derived_archs:
@@ -531,26 +824,57 @@ def is_package_known(package_nvr, arch, releaseid=None):
     else:
         releases = [releaseid]
 
+    filenames = []
+    for derived_archs in ARCH_MAP.values():
+        if arch not in derived_archs:
+            continue
+
+        for a in derived_archs:
+            filenames.append("%s.%s.rpm" % (package_nvr, a))
+        break
+    else:
+        filenames.append("%s.%s.rpm" % (package_nvr, arch))
+
     candidates = []
     for releaseid in releases:
-        for derived_archs in ARCH_MAP.values():
-            if arch not in derived_archs:
-                continue
+        index = get_repo_index(releaseid)
+        if index is not None:
+            try:
+                if any([index.has_package(f) for f in filenames]):
+                    return True
+            finally:
+                index.close()
 
-            for a in derived_archs:
-                candidates.append(os.path.join(CONFIG["RepoDir"], releaseid, "Packages",
-                                               "%s.%s.rpm" % (package_nvr, a)))
-                candidates.append(os.path.join(CONFIG["RepoDir"], releaseid,
-                                               "%s.%s.rpm" % (package_nvr, a)))
-            break
-        else:
-            candidates.append(os.path.join(CONFIG["RepoDir"], releaseid, "Packages",
-                                           "%s.%s.rpm" % (package_nvr, arch)))
-            candidates.append(os.path.join(CONFIG["RepoDir"], releaseid,
-                                           "%s.%s.rpm" % (package_nvr, arch)))
+        # the index may be older than the repository, check the files
+        for filename in filenames:
+            candidates.append(os.path.join(CONFIG["RepoDir"], releaseid, "Packages", filename))
+            candidates.append(os.path.join(CONFIG["RepoDir"], releaseid, filename))
 
     return any([os.path.isfile(f) for f in candidates])
 
+def get_repo_index(releaseid):
+    """Returns RepoIndex of the given release or None if the index
+    is disabled or has not been built by retrace-server-reposync yet."""
+    if not CONFIG["UseRepoIndex"]:
+        return None
+
+    from repoindex import RepoIndex, INDEX_FILE
+    path = os.path.join(CONFIG["RepoDir"], releaseid, INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    def load_sack():
+        from resolver import load_release_yum
+        yumbase = load_release_yum(releaseid)
+        return yumbase, yumbase.pkgSack
+
+    return RepoIndex(path, load_sack)
+
+def update_repo_index(releaseid):
+    """Indexes packages added to the release since the last run."""
+    from repoindex import update_repo_index as update_index
+    return update_index(os.path.join(CONFIG["RepoDir"], releaseid), log=log_warn)
+
 # tricky
 # crash is not able to process the vmcore from different arch
 # (not even x86_64 and x86). In addition, there are several
@@ -560,42 +884,30 @@ def is_package_known(package_nvr, arch, releaseid=None):
 # the OSRELEASE in the vmcore sometimes contains architecture
 # and sometimes it does not.
 def get_kernel_release(vmcore, crash_cmd=["crash"]):
-    child = Popen(crash_cmd + ["--osrelease", vmcore], stdout=PIPE, stderr=STDOUT)
-    release = child.communicate()[0].strip()
-
-    if child.wait() != 0 or \
-       not release or \
-       "\n" in release or \
-       release == "unknown":
-        release = None
-        # crash error, let's search the vmcore on our own
-        vers = {}
-        child = Popen(["strings", "-n", "10", vmcore], stdout=PIPE, stderr=STDOUT)
-        # lots! of output, do not use .communicate()
-        line = child.stdout.readline()
-        while line:
-            line = line.strip()
-
-            # OSRELEASE variable is defined in the vmcore,
-            # but crash was not able to find it (cross-arch)
-            match = OSRELEASE_VAR_PARSER.match(line)
-            if match:
-                release = match.group(1)
-                break
+    from vmcoreheader import read_vmcore_header, scan_kernel_release, VmcoreHeaderError
 
+    # kdump-compressed and ELF vmcores carry the release in the header
+    release = None
+    machine = None
+    try:
+        header = read_vmcore_header(vmcore)
+        release = header["release"]
+        machine = header["machine"]
+    except (EnvironmentError, VmcoreHeaderError) as ex:
+        log_debug("Unable to read vmcore header: %s" % ex)
+
+    if not release:
+        child = Popen(crash_cmd + ["--osrelease", vmcore], stdout=PIPE, stderr=STDOUT)
+        release = child.communicate()[0].strip()
+
+        if child.wait() != 0 or \
+           not release or \
+           "\n" in release or \
+           release == "unknown":
+            # crash error, let's search the vmcore on our own
             # assuming the kernel version will sooner or later
-            # appear in the list of strings contained in the
-            # vmcore
-            match = KERNEL_RELEASE_PARSER.match(line)
-            if match:
-                release = line
-                break
-
-            line = child.stdout.readline()
-
-        # much more output is available, but we don't need any more
-        child.stdout.close()
-        child.kill()
+            # appear in the strings contained in the vmcore
+            release = scan_kernel_release(vmcore)
 
     if release is None or release == "unknown":
         return None
@@ -607,6 +919,9 @@ def get_kernel_release(vmcore, crash_cmd=["crash"]):
         log_error(str(ex))
         return None
 
+    if result.arch is None and machine:
+        result.arch = get_canon_arch(machine)
+
     if result.arch is None:
         result.arch = guess_arch(vmcore)
         if not result.arch:
@@ -615,7 +930,53 @@ def get_kernel_release(vmcore, crash_cmd=["crash"]):
 
     return result
 
+def get_faf_db():
+    """Returns FAF database session shared by all lookups of the process."""
+    global _faf_db
+    if _faf_db is None:
+        from pyfaf.storage import getDatabase
+        _faf_db = getDatabase()
+
+    return _faf_db
+
+def get_kernel_index():
+    """Returns KernelDebuginfoIndex or None if the index is disabled."""
+    if not CONFIG["UseKernelIndex"]:
+        return None
+
+    from kernelindex import KernelDebuginfoIndex, INDEX_FILE
+    kerneldir = os.path.join(CONFIG["RepoDir"], "kernel")
+    if not os.path.isdir(kerneldir):
+        os.makedirs(kerneldir)
+
+    return KernelDebuginfoIndex(os.path.join(kerneldir, INDEX_FILE))
+
+def update_kernel_index(releaseid):
+    """Indexes kernel debuginfo packages of the release."""
+    from kernelindex import SOURCE_REPO
+    index = get_kernel_index()
+    if index is None:
+        return 0, 0
+
+    try:
+        return index.update_dir(os.path.join(CONFIG["RepoDir"], releaseid), SOURCE_REPO)
+    finally:
+        index.close()
+
+def _index_kernel_debuginfo(path, source):
+    """Adds a debuginfo found outside of the index, so that the next
+    lookup does not need to wait for the rescan."""
+    index = get_kernel_index()
+    if index is None:
+        return
+
+    try:
+        index.add(path, source)
+    finally:
+        index.close()
+
 def find_kernel_debuginfo(kernelver):
+    from kernelindex import SOURCE_DOWNLOAD, SOURCE_KOJI, SOURCE_REPO
     vers = [kernelver]
 
     for canon_arch, derived_archs in ARCH_MAP.items():
@@ -627,9 +988,8 @@ def find_kernel_debuginfo(kernelver):
                 vers.append(cand)
 
     if CONFIG["UseFafPackages"]:
-        from pyfaf.storage import getDatabase
         from pyfaf.queries import get_package_by_nevra
-        db = getDatabase()
+        db = get_faf_db()
         for ver in vers:
             p = get_package_by_nevra(db, ver.package_name_base(debug=True),
                                      0, ver.version, ver.release, ver._arch)
@@ -643,22 +1003,42 @@ def find_kernel_debuginfo(kernelver):
                 else:
                     log_debug("LOB not found {0}".format(p.get_lob_path("package")))
 
+    # RepoDir and KojiRoot are only probed if the index misses,
+    # packages added since the last rescan are indexed then
+    index = get_kernel_index()
+    if index is not None:
+        try:
+            result = index.lookup([ver.package_name(debug=True) for ver in vers])
+        finally:
+            index.close()
+
+        if result is not None:
+            log_debug("Debuginfo file found in the index: %s" % result)
+            return result
+
     # search for the debuginfo RPM
     ver = None
     for release in os.listdir(CONFIG["RepoDir"]):
+        if release == "download":
+            source = SOURCE_DOWNLOAD
+        else:
+            source = SOURCE_REPO
+
         for ver in vers:
             testfile = os.path.join(CONFIG["RepoDir"], release, "Packages", ver.package_name(debug=True))
             log_debug("Trying debuginfo file: %s" % testfile)
             if os.path.isfile(testfile):
+                _index_kernel_debuginfo(testfile, source)
                 return testfile
 
             # should not happen, but anyway...
             testfile = os.path.join(CONFIG["RepoDir"], release, ver.package_name(debug=True))
             log_debug("Trying debuginfo file: %s" % testfile)
             if os.path.isfile(testfile):
+                _index_kernel_debuginfo(testfile, source)
                 return testfile
 
-    if ver is not None and ver.rt:
+    if vers[0].rt:
         basename = "kernel-rt"
     else:
         basename = "kernel"
@@ -668,6 +1048,7 @@ def find_kernel_debuginfo(kernelver):
         testfile = os.path.join(CONFIG["KojiRoot"], "packages", basename, ver.version, ver.release, ver._arch, ver.package_name(debug=True))
         log_debug("Trying debuginfo file: %s" % testfile)
         if os.path.isfile(testfile):
+            _index_kernel_debuginfo(testfile, SOURCE_KOJI)
             return testfile
 
     if CONFIG["WgetKernelDebuginfos"]:
@@ -684,15 +1065,54 @@ def find_kernel_debuginfo(kernelver):
                 url += "/"
             url += pkgname
 
-            log_debug("Trying debuginfo URL: %s" % url)
-            with open(os.devnull, "w") as null:
-                retcode = call(["wget", "-nv", "-P", downloaddir, url], stdout=null, stderr=null)
+            result = os.path.join(downloaddir, pkgname)
+            # only one task downloads, the others wait for the result
+            with FileLock("%s.lock" % result):
+                if os.path.isfile(result):
+                    log_debug("Debuginfo file downloaded by another task: %s" % result)
+                    return result
+
+                # continue where an interrupted download stopped
+                partfile = "%s.part" % result
+                log_debug("Trying debuginfo URL: %s" % url)
+                with open(os.devnull, "w") as null:
+                    retcode = call(["wget", "-nv", "-c", "-O", partfile, url], stdout=null, stderr=null)
+
+                if retcode == 0:
+                    os.rename(partfile, result)
+                elif os.path.isfile(partfile) and os.path.getsize(partfile) == 0:
+                    os.unlink(partfile)
 
             if retcode == 0:
-                return os.path.join(downloaddir, pkgname)
+                _index_kernel_debuginfo(result, SOURCE_DOWNLOAD)
+
+                return result
 
     return None
 
+def get_payload_index():
+    """Returns PayloadIndex of debuginfo RPMs used for vmcores."""
+    from rpmindex import PayloadIndex
+    kerneldir = os.path.join(CONFIG["RepoDir"], "kernel")
+    if not os.path.isdir(kerneldir):
+        os.makedirs(kerneldir)
+
+    return PayloadIndex(os.path.join(kerneldir, PAYLOAD_INDEX_FILE))
+
+def list_debuginfo_files(debuginfo):
+    """Returns the list of files in the debuginfo RPM."""
+    try:
+        index = get_payload_index()
+        try:
+            return index.list_files(debuginfo)
+        finally:
+            index.close()
+    except Exception as ex:
+        log_warn("Unable to list '%s' using payload index: %s" % (debuginfo, ex))
+
+    child = Popen(["rpm", "-qpl", debuginfo], stdout=PIPE)
+    return child.communicate()[0].splitlines()
+
 def cache_files_from_debuginfo(debuginfo, basedir, files):
     # important! if empty list is specified, the whole debuginfo would be unpacked
     if not files:
@@ -701,6 +1121,16 @@ def cache_files_from_debuginfo(debuginfo, basedir, files):
     if not os.path.isfile(debuginfo):
         raise Exception, "Given debuginfo file does not exist"
 
+    try:
+        index = get_payload_index()
+        try:
+            index.extract(debuginfo, basedir, files)
+            return
+        finally:
+            index.close()
+    except Exception as ex:
+        log_warn("Unable to extract from '%s' using payload index: %s" % (debuginfo, ex))
+
     # prepend absolute path /usr/lib/debug/... with dot, so that cpio can match it
     for i in xrange(len(files)):
         if files[i][0] == "/":
@@ -713,14 +1143,14 @@ def cache_files_from_debuginfo(debuginfo, basedir, files):
         cpio.wait()
         rpm2cpio.stdout.close()
 
-def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
-    log_info("Calling prepare_debuginfo with crash_cmd = " + str(crash_cmd))
-    if kernelver is None:
-        kernelver = get_kernel_release(vmcore, crash_cmd)
-
-    if kernelver is None:
-        raise Exception, "Unable to determine kernel version"
+def _kernel_extract_lock(debugdir_base, debuginfo):
+    # tasks of the same kernel extract one at a time,
+    # the ones waiting find the files already cached
+    return os.path.join(debugdir_base, ".%s.lock" % os.path.basename(debuginfo))
 
+def cache_vmlinux(kernelver):
+    """Makes sure vmlinux of the kernel is extracted in RepoDir/kernel.
+    Returns a tuple (vmlinux, debuginfo package, {module: .ko.debug path})."""
     debuginfo = find_kernel_debuginfo(kernelver)
     if not debuginfo:
         raise Exception, "Unable to find debuginfo package"
@@ -735,9 +1165,7 @@ def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
 
     vmlinux_path = None
     debugfiles = {}
-    child = Popen(["rpm", "-qpl", debuginfo], stdout=PIPE)
-    lines = child.communicate()[0].splitlines()
-    for line in lines:
+    for line in list_debuginfo_files(debuginfo):
         if line.endswith(pattern):
             vmlinux_path = line
             continue
@@ -765,10 +1193,32 @@ def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
 
     vmlinux = os.path.join(debugdir_base, vmlinux_path.lstrip("/"))
     if not os.path.isfile(vmlinux):
-        cache_files_from_debuginfo(debuginfo, debugdir_base, [vmlinux_path])
+        with FileLock(_kernel_extract_lock(debugdir_base, debuginfo)):
+            if not os.path.isfile(vmlinux):
+                cache_files_from_debuginfo(debuginfo, debugdir_base, [vmlinux_path])
         if not os.path.isfile(vmlinux):
             raise Exception, "Caching vmlinux failed"
 
+    from kernelcache import KernelCache
+    kernelcache = KernelCache()
+    for path in [vmlinux, debuginfo]:
+        try:
+            kernelcache.touch(path)
+        except (IOError, OSError) as ex:
+            log_warn("Unable to mark '%s' as used: %s" % (path, ex))
+
+    return vmlinux, debuginfo, debugfiles
+
+def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
+    log_info("Calling prepare_debuginfo with crash_cmd = " + str(crash_cmd))
+    if kernelver is None:
+        kernelver = get_kernel_release(vmcore, crash_cmd)
+
+    if kernelver is None:
+        raise Exception, "Unable to determine kernel version"
+
+    vmlinux, debuginfo, debugfiles = cache_vmlinux(kernelver)
+
     if chroot:
         with open(os.devnull, "w") as null:
             child = Popen(["/usr/bin/mock", "--configdir", chroot, "shell",
@@ -789,8 +1239,17 @@ def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
         log_warn("Unable to list modules: crash exited with %d:\n%s" % (child.returncode, stdout))
         return vmlinux
 
+    cache_modules_debuginfo(kernelver, debuginfo, debugfiles, stdout)
+
+    return vmlinux
+
+def cache_modules_debuginfo(kernelver, debuginfo, debugfiles, mod_output):
+    """Extracts .ko.debug files of modules listed in the output of crash's
+    'mod' command. debuginfo and debugfiles are as returned by cache_vmlinux."""
+    debugdir_base = os.path.join(CONFIG["RepoDir"], "kernel", kernelver.arch)
+
     modules = []
-    for line in stdout.splitlines():
+    for line in mod_output.splitlines():
         # skip header
         if "NAME" in line:
             continue
@@ -798,21 +1257,29 @@ def prepare_debuginfo(vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
         if " " in line:
             modules.append(line.split()[1])
 
-    todo = []
-    for module in modules:
-        if module in debugfiles and \
-           not os.path.isfile(os.path.join(debugdir_base, debugfiles[module].lstrip("/"))):
-            todo.append(debugfiles[module])
+    with FileLock(_kernel_extract_lock(debugdir_base, debuginfo)):
+        todo = []
+        for module in modules:
+            if module in debugfiles and \
+               not os.path.isfile(os.path.join(debugdir_base, debugfiles[module].lstrip("/"))):
+                todo.append(debugfiles[module])
 
-    cache_files_from_debuginfo(debuginfo, debugdir_base, todo)
-
-    return vmlinux
+        cache_files_from_debuginfo(debuginfo, debugdir_base, todo)
 
 def get_vmcore_dump_level(task, vmlinux=None):
     vmcore_path = os.path.join(task.get_savedir(), "crash", "vmcore")
     if not os.path.isfile(vmcore_path):
         return None
 
+    # kdump-compressed vmcores record the dump level in the header
+    from vmcoreheader import read_vmcore_header, VmcoreHeaderError
+    try:
+        dump_level = read_vmcore_header(vmcore_path)["dump_level"]
+        if dump_level is not None:
+            return dump_level
+    except (EnvironmentError, VmcoreHeaderError) as ex:
+        log_debug("Unable to read vmcore header: %s" % ex)
+
     dmesg_path = os.path.join(task.get_savedir(), RetraceTask.MISC_DIR, "dmesg")
     if os.path.isfile(dmesg_path):
         os.unlink(dmesg_path)
@@ -839,17 +1306,25 @@ def get_vmcore_dump_level(task, vmlinux=None):
         child.wait()
         return result
 
-def get_files_sizes(directory):
+def get_files_sizes(directory, allocated=False):
+    """Returns [(path, size), ...] of files in directory, the largest first.
+    With allocated=True the items are (path, size, allocated size), the
+    allocated size being the blocks the file occupies on the disk, less
+    than its apparent size if it is sparse."""
     result = []
 
     for f in os.listdir(directory):
         fullpath = os.path.join(directory, f)
         if os.path.isfile(fullpath):
-            result.append((fullpath, os.path.getsize(fullpath)))
+            if allocated:
+                st = os.stat(fullpath)
+                result.append((fullpath, st.st_size, st.st_blocks * 512))
+            else:
+                result.append((fullpath, os.path.getsize(fullpath)))
         elif os.path.isdir(fullpath):
-            result += get_files_sizes(fullpath)
+            result += get_files_sizes(fullpath, allocated)
 
-    return sorted(result, key=lambda (f, s): s, reverse=True)
+    return sorted(result, key=lambda item: item[1], reverse=True)
 
 def get_archive_type(path):
     ms = magic.open(magic.MAGIC_NONE)
@@ -893,7 +1368,15 @@ def rename_with_suffix(frompath, topath):
     return topath
 
 def unpack_vmcore(path):
+    from unpacker import extract_vmcore, UnsupportedArchive
+
     parentdir = os.path.dirname(path)
+    try:
+        extract_vmcore(path, os.path.join(parentdir, "vmcore"))
+        return
+    except UnsupportedArchive as ex:
+        log_info("%s, unpacking by external tools" % ex)
+
     archivebase = os.path.join(parentdir, "archive")
     archive = rename_with_suffix(path, archivebase)
     filetype = get_archive_type(archive)
@@ -955,6 +1438,8 @@ def unpack_vmcore(path):
 
 
 def unpack_coredump(path):
+    from unpacker import decompress_file
+
     processed = set()
     parentdir = os.path.dirname(path)
     files = set(f for (f, s) in get_files_sizes(parentdir))
@@ -962,20 +1447,20 @@ def unpack_coredump(path):
     while len(files - processed) > 0:
         archive = list(files - processed)[0]
         filetype = get_archive_type(archive)
-        if filetype == ARCHIVE_GZ:
-            check_run(["gunzip", archive])
-        elif filetype == ARCHIVE_BZ2:
-            check_run(["bunzip2", archive])
-        elif filetype == ARCHIVE_XZ:
-            check_run(["unxz", archive])
+        if filetype in [ARCHIVE_GZ, ARCHIVE_BZ2, ARCHIVE_XZ, ARCHIVE_LZOP]:
+            # unlike gunzip & co. keeps the holes of sparse coredumps
+            suffix = SUFFIX_MAP[filetype]
+            if archive.endswith(suffix):
+                target = archive[:-len(suffix)]
+            else:
+                target = "%s.unpacked" % archive
+            decompress_file(archive, target)
         elif filetype == ARCHIVE_ZIP:
             check_run(["unzip", archive, "-d", parentdir])
         elif filetype == ARCHIVE_7Z:
             check_run(["7za", "e", "-o%s" % parentdir, archive])
         elif filetype == ARCHIVE_TAR:
             check_run(["tar", "-C", parentdir, "-xf", archive])
-        elif filetype == ARCHIVE_LZOP:
-            check_run(["lzop", "-d", archive])
 
         if os.path.isfile(archive) and filetype != ARCHIVE_UNKNOWN:
             os.unlink(archive)
@@ -1138,6 +1623,16 @@ def init_crashstats_db():
       CREATE TABLE IF NOT EXISTS
       reportfull(requesttime NOT NULL, ip NOT NULL)
     """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      phases(taskid REFERENCES tasks(id), name NOT NULL, duration NOT NULL)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      processes(taskid REFERENCES tasks(id), command NOT NULL, wall NOT NULL,
+                utime NOT NULL, stime NOT NULL, maxrss NOT NULL,
+                read_bytes NOT NULL, write_bytes NOT NULL, returncode)
+    """)
     con.commit()
 
     return con
@@ -1230,6 +1725,45 @@ def save_crashstats_build_ids(statsid, buildids, con=None):
     if close:
         con.close()
 
+def save_crashstats_phases(statsid, phases, con=None):
+    close = False
+    if con is None:
+        con = init_crashstats_db()
+        close = True
+
+    query = con.cursor()
+    for name, duration in phases:
+        query.execute("""
+          INSERT INTO phases (taskid, name, duration)
+          VALUES (?, ?, ?)
+          """,
+          (statsid, name, duration))
+
+    con.commit()
+    if close:
+        con.close()
+
+def save_crashstats_processes(statsid, processes, con=None):
+    close = False
+    if con is None:
+        con = init_crashstats_db()
+        close = True
+
+    query = con.cursor()
+    for process in processes:
+        query.execute("""
+          INSERT INTO processes (taskid, command, wall, utime, stime,
+          maxrss, read_bytes, write_bytes, returncode)
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+          """,
+          (statsid, process["command"], process["wall"], process["utime"],
+           process["stime"], process["maxrss"], process["read_bytes"],
+           process["write_bytes"], process["returncode"]))
+
+    con.commit()
+    if close:
+        con.close()
+
 def save_crashstats_reportfull(ip, con=None):
     close = False
     if con is None:
@@ -1283,17 +1817,13 @@ def ftp_close(ftp):
         ftp.close()
 
 def ftp_list_dir(ftpdir="/", ftp=None):
-    close = False
+    """Lists ftpdir by the given connection, or from the listing
+    cached by ftppool if no connection is given."""
     if ftp is None:
-        ftp = ftp_init()
-        close = True
-
-    result = [f.lstrip("/") for f in ftp.nlst(ftpdir)]
-
-    if close:
-        ftp_close(ftp)
+        from ftppool import ftp_listing
+        return ftp_listing(ftpdir).keys()
 
-    return result
+    return [f.lstrip("/") for f in ftp.nlst(ftpdir)]
 
 def cmp_vmcores_first(str1, str2):
     vmcore1 = "vmcore" in str1.lower()
@@ -1314,20 +1844,33 @@ def check_run(cmd):
 
 def strip_vmcore(vmcore, kernelver=None, crash_cmd=["crash"]):
     try:
-        vmlinux = prepare_debuginfo(vmcore, kernelver=kernelver, crash_cmd=crash_cmd)
+        if kernelver is None:
+            kernelver = get_kernel_release(vmcore, crash_cmd)
+
+        if kernelver is None:
+            raise Exception, "Unable to determine kernel version"
+
+        # makedumpfile does not need modules
+        vmlinux = cache_vmlinux(kernelver)[0]
     except Exception as ex:
-        log_warn("prepare_debuginfo failed: %s" % ex)
-        return
+        log_warn("Unable to cache vmlinux: %s" % ex)
+        return False
 
     newvmcore = "%s.stripped" % vmcore
-    retcode = call(["makedumpfile", "-c", "-d", "%d" % CONFIG["VmcoreDumpLevel"],
-                    "-x", vmlinux, "--message-level", "0", vmcore, newvmcore])
+    cmd = ["makedumpfile", "-c", "-d", "%d" % CONFIG["VmcoreDumpLevel"],
+           "-x", vmlinux, "--message-level", "0"]
+    if CONFIG["VmcoreStripThreads"] > 0:
+        cmd += ["--num-threads", "%d" % CONFIG["VmcoreStripThreads"]]
+
+    retcode = call(cmd + [vmcore, newvmcore])
     if retcode:
         log_warn("makedumpfile exited with %d" % retcode)
         if os.path.isfile(newvmcore):
             os.unlink(newvmcore)
-    else:
-        os.rename(newvmcore, vmcore)
+        return False
+
+    os.rename(newvmcore, vmcore)
+    return True
 
 def move_dir_contents(source, dest):
     for filename in os.listdir(source):
@@ -1449,6 +1992,7 @@ class RetraceTask:
 
     BACKTRACE_FILE = "retrace_backtrace"
     CASENO_FILE = "caseno"
+    COREINFO_FILE = "coreinfo"
     CRASHRC_FILE = "crashrc"
     CRASH_CMD_FILE = "crash_cmd"
     DOWNLOADED_FILE = "downloaded"
@@ -1533,6 +2077,89 @@ class RetraceTask:
         key_sanitized = key.replace("/", "_").replace(" ", "_")
         return os.path.join(self._savedir, key_sanitized)
 
+    def create_crashdir(self, expected_size=None):
+        """Creates the crash directory of the task and returns its path.
+        If the crash data are expected to take expected_size bytes and
+        these fit into the fast tier, the directory is placed there and
+        crash is a symlink to it, transparent to anything using the path."""
+        crashdir = os.path.join(self._savedir, "crash")
+        if os.path.islink(crashdir):
+            # the fast tier has been lost (tmpfs after a reboot)
+            os.unlink(crashdir)
+
+        fastdir = reserve_fast_tier(self._taskid, expected_size)
+        if fastdir is None:
+            os.mkdir(crashdir)
+            return crashdir
+
+        try:
+            os.symlink(fastdir, crashdir)
+        except:
+            release_fast_tier(fastdir)
+            raise
+
+        log_debug("Crash data (%s expected) placed on the fast tier" % human_readable_size(expected_size))
+        return crashdir
+
+    def migrate_crashdir(self):
+        """Moves the crash directory from the fast tier to SaveDir, where
+        the data are kept after the task has finished."""
+        from fileops import copy_tree
+
+        crashdir = os.path.join(self._savedir, "crash")
+        if not os.path.islink(crashdir):
+            return
+
+        fastdir = os.path.realpath(crashdir)
+        if not os.path.isdir(fastdir):
+            log_warn("Crash data on the fast tier have been lost")
+            os.unlink(crashdir)
+            return
+
+        tmpdir = "%s.migrate" % crashdir
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+
+        start = time.time()
+        copy_tree(fastdir, tmpdir)
+        os.unlink(crashdir)
+        os.rename(tmpdir, crashdir)
+        release_fast_tier(fastdir)
+        log_debug("Crash data moved off the fast tier in %d seconds" % int(time.time() - start))
+
+    def _estimate_remote_size(self):
+        """Returns the number of bytes the remote resources are expected
+        to take when downloaded and unpacked, None if it is not known."""
+        result = 0
+        for url in self.get_remote():
+            try:
+                if url.startswith("FTP "):
+                    from ftppool import ftp_file_size
+                    filename = url[4:].strip()
+                    size = ftp_file_size(filename)
+                elif url.startswith("/"):
+                    filename = url
+                    size = os.path.getsize(url)
+                elif url.startswith("http://") or url.startswith("https://"):
+                    from httpdownload import http_resource_size
+                    filename = urlparse.urlsplit(url).path
+                    size = http_resource_size(url)
+                    if size is None:
+                        return None
+                else:
+                    return None
+            except Exception as ex:
+                log_debug("Unable to determine the size of '%s': %s" % (url, ex))
+                return None
+
+            if any(filename.endswith(ext) for ext in FTP_SUPPORTED_EXTENSIONS):
+                # the archive and its contents
+                size *= 1 + UNPACKED_SIZE_RATIO
+
+            result += size
+
+        return result
+
     def _start_local(self, debug=False, kernelver=None, arch=None):
         cmdline = ["/usr/bin/retrace-server-worker", "%d" % self._taskid]
         if debug:
@@ -1586,12 +2213,17 @@ class RetraceTask:
     def start(self, debug=False, kernelver=None, arch=None):
         crashdir = os.path.join(self._savedir, "crash")
         if arch is None:
+            task_arch = None
             if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
                 filename = os.path.join(crashdir, "vmcore")
             else:
                 filename = os.path.join(crashdir, "coredump")
+                coreinfo = self.get_coreinfo()
+                if coreinfo is not None:
+                    task_arch = coreinfo["arch"]
 
-            task_arch = guess_arch(filename)
+            if task_arch is None:
+                task_arch = guess_arch(filename)
         else:
             task_arch = arch
 
@@ -1701,6 +2333,10 @@ class RetraceTask:
         """Atomically writes given string into BACKTRACE_FILE."""
         self.set_atomic(RetraceTask.BACKTRACE_FILE, backtrace)
 
+    def open_backtrace(self):
+        """Returns AtomicFile replacing BACKTRACE_FILE when closed."""
+        return AtomicFile(self._get_file_path(RetraceTask.BACKTRACE_FILE))
+
     def has_log(self):
         """Verifies whether LOG_FILE is present in the task directory."""
         return self.has(RetraceTask.LOG_FILE)
@@ -1767,6 +2403,48 @@ class RetraceTask:
         """Atomically writes given value into KERNELVER_FILE."""
         self.set_atomic(RetraceTask.KERNELVER_FILE, value)
 
+    def has_coreinfo(self):
+        """Verifies whether COREINFO_FILE is present in the task directory."""
+        return self.has(RetraceTask.COREINFO_FILE)
+
+    def get_coreinfo(self):
+        """Returns the description of the task's coredump (see elfcore.ElfCore.info).
+        The coredump is only read on the first call, the result is cached
+        in COREINFO_FILE. Returns None if the coredump is not an ELF core."""
+        from elfcore import read_core_info, ElfCoreError
+
+        corepath = os.path.join(self._savedir, "crash", "coredump")
+        try:
+            coresize = os.path.getsize(corepath)
+        except OSError:
+            return None
+
+        if self.has_coreinfo():
+            try:
+                result = json.loads(self.get(RetraceTask.COREINFO_FILE, maxlen=1 << 24))
+                if result["coresize"] == coresize:
+                    return result
+            except (ValueError, KeyError) as ex:
+                log_warn("Ignoring invalid %s: %s" % (RetraceTask.COREINFO_FILE, ex))
+
+        try:
+            result = read_core_info(corepath)
+        except (EnvironmentError, ElfCoreError) as ex:
+            log_debug("Unable to read coredump: %s" % ex)
+            return None
+
+        result["coresize"] = coresize
+        try:
+            self.set_coreinfo(result)
+        except EnvironmentError as ex:
+            log_warn("Unable to save %s: %s" % (RetraceTask.COREINFO_FILE, ex))
+
+        return result
+
+    def set_coreinfo(self, value):
+        """Atomically writes given dictionary into COREINFO_FILE."""
+        self.set_atomic(RetraceTask.COREINFO_FILE, json.dumps(value))
+
     def has_notes(self):
         return self.has(RetraceTask.NOTES_FILE)
 
@@ -1799,117 +2477,245 @@ class RetraceTask:
     def set_url(self, value):
         self.set(RetraceTask.URL_FILE, value)
 
-    def download_block(self, data):
-        self._progress_write_func(data)
-        self._progress_current += len(data)
-        progress = "%d%% (%s / %s)" % ((100 * self._progress_current) / self._progress_total,
-                                       human_readable_size(self._progress_current),
-                                       self._progress_total_str)
-        self.set_atomic(RetraceTask.PROGRESS_FILE, progress)
-
-    def download_remote(self, unpack=True, timeout=0, kernelver=None):
-        """Downloads all remote resources and returns a list of errors."""
-        downloaded = []
-        errors = []
+    def _download_progress(self, part, current, total):
+        """Records progress of one part and writes the progress
+        of all parts downloaded in parallel into PROGRESS_FILE."""
+        with self._progress_lock:
+            self._progress[part] = (current, total)
+            current = sum(c for c, t in self._progress.values())
+            total = sum(t for c, t in self._progress.values())
+            if total <= 0:
+                return
+
+            progress = "%d%% (%s / %s)" % ((100 * current) / total,
+                                           human_readable_size(current),
+                                           human_readable_size(total))
+            self.set_atomic(RetraceTask.PROGRESS_FILE, progress)
+
+    def _start_prefetch(self, path, kernelver=None):
+        """Starts prefetching kernel debuginfo of the vmcore being
+        downloaded into path. Returns the thread or None."""
+        if not CONFIG["UseDebuginfoPrefetch"] or kernelver is not None or \
+           not self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+            return None
 
-        crashdir = os.path.join(self._savedir, "crash")
-        if not os.path.isdir(crashdir):
-            oldmask = os.umask(0007)
-            os.makedirs(crashdir)
-            os.umask(oldmask)
+        from prefetch import DownloadPrefetcher
+        result = DownloadPrefetcher(path)
+        result.start()
+        return result
 
-        for url in self.get_remote():
-            self.set_status(STATUS_DOWNLOADING)
-            log_info(STATUS[STATUS_DOWNLOADING])
+    def _open_part(self, partdir, filename, outname=None):
+        """Returns the object receiving downloaded data. That is the file
+        partdir/filename or StreamUnpacker if outname is given."""
+        if outname is None:
+            return open(os.path.join(partdir, filename), "wb")
+
+        from streamunpack import StreamUnpacker
+        return StreamUnpacker(partdir, filename, outname)
+
+    def _download_part(self, part, url, partdir, kernelver=None, outname=None):
+        """Downloads a single remote resource into partdir. If outname
+        is given, the data is decompressed into partdir/outname while
+        being downloaded. Returns (path of the file, value recorded
+        in DOWNLOADED_FILE), raises an exception on failure."""
+        if url.startswith("FTP "):
+            filename = url[4:].strip()
+            log_info("Retrieving FTP file '%s'" % filename)
+        elif url.startswith("/") or url.startswith("file:///"):
+            if url.startswith("file://"):
+                url = url[7:]
+
+            log_info("Retrieving local file '%s'" % url)
+
+            if not os.path.isfile(url):
+                raise Exception, "File not found"
+
+            from streamunpack import SNIFF_SIZE, get_stream_decompressor
+            with open(url, "rb") as f:
+                compressed = get_stream_decompressor(f.read(SNIFF_SIZE)) is not None
+
+            filename = os.path.basename(url)
+            # only decompression is worth streaming, the rest is ingested
+            # without copying the data and unpacked in place
+            if outname is None or not compressed:
+                from fileops import ingest_file
+
+                targetfile = os.path.join(partdir, filename)
+                # archives are unpacked in place, gunzip & co. refuse hardlinks
+                method = ingest_file(url, targetfile, link=get_archive_type(url) == ARCHIVE_UNKNOWN)
+                log_debug("Retrieved by %s" % method)
+                return targetfile, url
+        else:
+            log_info("Retrieving remote file '%s'" % url)
+
+            if "/" not in url:
+                raise Exception, "malformed URL"
 
+            filename = url.rsplit("/", 1)[1]
+
+        targetfile = os.path.join(partdir, outname or filename)
+        prefetcher = self._start_prefetch(targetfile, kernelver)
+        http = CONFIG["HTTPConnections"] > 0 and (url.startswith("http://") or url.startswith("https://"))
+        try:
+            if outname is None and url.startswith("FTP "):
+                from ftppool import ftp_download
+                ftp_download(filename, targetfile, CONFIG["FTPConnections"],
+                             lambda current, total: self._download_progress(part, current, total))
+            elif outname is None and http:
+                from httpdownload import http_download
+                http_download(url, targetfile, CONFIG["HTTPConnections"],
+                              lambda current, total: self._download_progress(part, current, total))
+            elif outname is None:
+                child = Popen(["wget", "-nv", "-P", partdir, url], stdout=PIPE, stderr=STDOUT)
+                stdout = child.communicate()[0]
+                if child.wait():
+                    raise Exception, "wget exitted with %d: %s" % (child.returncode, stdout)
+            else:
+                targetfile = self._download_into(part, url, self._open_part(partdir, filename, outname),
+                                                 http) or targetfile
+        finally:
+            if prefetcher:
+                prefetcher.finish()
+
+        if url.startswith("FTP "):
+            return targetfile, filename
+
+        return targetfile, url
+
+    def _download_into(self, part, url, target, http=False):
+        """Passes the remote resource to target sequentially.
+        Returns what target.close() returns."""
+        try:
             if url.startswith("FTP "):
-                filename = url[4:].strip()
-                log_info("Retrieving FTP file '%s'" % filename)
+                self._download_ftp(part, url[4:].strip(), target)
+            elif url.startswith("/"):
+                with open(url, "rb") as source:
+                    shutil.copyfileobj(source, target, 1 << 20)
+            elif http:
+                from httpdownload import http_stream
+                http_stream(url, target.write,
+                            lambda current, total: self._download_progress(part, current, total))
+            else:
+                with open(os.devnull, "w") as null:
+                    child = Popen(["wget", "-nv", "-O", "-", url], stdout=PIPE, stderr=null)
+                shutil.copyfileobj(child.stdout, target, 1 << 20)
+                child.stdout.close()
+                if child.wait():
+                    raise Exception, "wget exitted with %d" % child.returncode
 
-                ftp = None
-                try:
-                    ftp = ftp_init()
-                    with open(os.path.join(crashdir, filename), "wb") as target_file:
-                        self._progress_write_func = target_file.write
-                        self._progress_total = ftp.size(filename)
-                        self._progress_total_str = human_readable_size(self._progress_total)
-                        self._progress_current = 0
-
-                        # the files are expected to be huge (even hundreds of gigabytes)
-                        # use a larger buffer - 16MB by default
-                        ftp.retrbinary("RETR %s" % filename, self.download_block,
-                                       CONFIG["FTPBufferSize"] * (1 << 20))
-
-                    downloaded.append(filename)
-                except Exception as ex:
-                    errors.append((url, str(ex)))
-                    continue
-                finally:
-                    if ftp:
-                        ftp_close(ftp)
-            elif url.startswith("/") or url.startswith("file:///"):
-                if url.startswith("file://"):
-                    url = url[7:]
+            # StreamUnpacker returns where the data ended up
+            return target.close()
+        except:
+            getattr(target, "abort", target.close)()
+            raise
 
-                log_info("Retrieving local file '%s'" % url)
+    def _download_ftp(self, part, filename, target):
+        from ftppool import ftp_file_size, ftp_retrieve
 
-                if not os.path.isfile(url):
-                    errors.append((url, "File not found"))
-                    continue
+        total = ftp_file_size(filename)
+        current = [0]
+        self._download_progress(part, 0, total)
 
-                filename = os.path.basename(url)
-                targetfile = os.path.join(crashdir, filename)
+        def download_block(data):
+            target.write(data)
+            current[0] += len(data)
+            self._download_progress(part, current[0], total)
 
-                copy = True
-                if get_archive_type(url) == ARCHIVE_UNKNOWN:
-                    try:
-                        log_debug("Trying hardlink")
-                        os.link(url, targetfile)
-                        copy = False
-                        log_debug("Succeeded")
-                    except:
-                        log_debug("Failed")
-
-                if copy:
-                    try:
-                        log_debug("Copying")
-                        shutil.copy(url, targetfile)
-                    except Exception as ex:
-                        errors.append((url, str(ex)))
-                        continue
+        ftp_retrieve(filename, download_block)
 
-                downloaded.append(url)
-            else:
-                log_info("Retrieving remote file '%s'" % url)
+    def _unpack_part(self, fullpath):
+        """Unpacks a downloaded file in its directory. Returns a list of errors."""
+        errors = []
+        if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+            try:
+                unpack_vmcore(fullpath)
+            except Exception as ex:
+                errors.append((fullpath, str(ex)))
+        if self.get_type() in [TASK_RETRACE, TASK_RETRACE_INTERACTIVE]:
+            try:
+                unpack_coredump(fullpath)
+            except Exception as ex:
+                errors.append((fullpath, str(ex)))
 
-                if "/" not in url:
-                    errors.append((url, "malformed URL"))
-                    continue
+        return errors
 
-                child = Popen(["wget", "-nv", "-P", crashdir, url], stdout=PIPE, stderr=STDOUT)
-                stdout = child.communicate()[0]
-                if child.wait():
-                    errors.append((url, "wget exitted with %d: %s" % (child.returncode, stdout)))
-                    continue
+    def download_remote(self, unpack=True, timeout=0, kernelver=None, phases=None):
+        """Downloads all remote resources and returns a list of errors.
+        Up to MaxParallelDownloads resources are downloaded at a time,
+        each into its own directory, where it is unpacked as soon as
+        it is complete. The directories are merged into crash/ at the end.
+        The time spent unpacking is added to the PhaseTimer phases."""
+        errors = []
 
-                filename = url.rsplit("/", 1)[1]
-                downloaded.append(url)
+        crashdir = os.path.join(self._savedir, "crash")
+        if not os.path.isdir(crashdir):
+            oldmask = os.umask(0007)
+            self.create_crashdir(self._estimate_remote_size())
+            os.umask(oldmask)
 
-            self.set_status(STATUS_POSTPROCESS)
-            log_info(STATUS[STATUS_POSTPROCESS])
+        remote = self.get_remote()
+        downloaded = [None] * len(remote)
+        queue = list(enumerate(remote))
+        remaining = [len(remote)]
+        lock = threading.Lock()
+        self._progress = {}
+        self._progress_lock = threading.Lock()
+
+        # compressed files are decompressed while being downloaded
+        outname = None
+        if unpack and CONFIG["UseStreamUnpack"]:
+            if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+                outname = "vmcore"
+            elif self.get_type() in [TASK_RETRACE, TASK_RETRACE_INTERACTIVE]:
+                outname = "coredump"
 
-            if unpack:
-                fullpath = os.path.join(crashdir, filename)
-                if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
-                    try:
-                        unpack_vmcore(fullpath)
-                    except Exception as ex:
-                        errors.append((fullpath, str(ex)))
-                if self.get_type() in [TASK_RETRACE, TASK_RETRACE_INTERACTIVE]:
-                    try:
-                        unpack_coredump(fullpath)
-                    except Exception as ex:
-                        errors.append((fullpath, str(ex)))
+        self.set_status(STATUS_DOWNLOADING)
+        log_info(STATUS[STATUS_DOWNLOADING])
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    part, url = queue.pop(0)
+
+                partdir = os.path.join(crashdir, "%s%d" % (DOWNLOAD_PART_PREFIX, part))
+                try:
+                    if not os.path.isdir(partdir):
+                        os.mkdir(partdir)
+                    fullpath, downloaded[part] = self._download_part(part, url, partdir, kernelver, outname)
+                except Exception as ex:
+                    fullpath = None
+                    with lock:
+                        errors.append((url, str(ex)))
+
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        self.set_status(STATUS_POSTPROCESS)
+                        log_info(STATUS[STATUS_POSTPROCESS])
+
+                if unpack and fullpath is not None:
+                    start = time.time()
+                    unpack_errors = self._unpack_part(fullpath)
+                    if phases is not None:
+                        phases.add("unpack", time.time() - start)
+                    with lock:
+                        errors.extend(unpack_errors)
+
+        threads = [threading.Thread(target=worker, name="download")
+                   for i in xrange(max(1, min(CONFIG["MaxParallelDownloads"], len(remote))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for part in xrange(len(remote)):
+            partdir = os.path.join(crashdir, "%s%d" % (DOWNLOAD_PART_PREFIX, part))
+            if os.path.isdir(partdir):
+                move_dir_contents(partdir, crashdir)
+
+        downloaded = [value for value in downloaded if value is not None]
 
         if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
             vmcore = os.path.join(crashdir, "vmcore")
@@ -1956,30 +2762,11 @@ class RetraceTask:
                 os.unlink(os.path.join(crashdir, filename))
 
             if os.path.isfile(vmcore):
-                oldsize = os.path.getsize(vmcore)
-                log_info("Vmcore size: %s" % human_readable_size(oldsize))
-
-                dump_level = get_vmcore_dump_level(self)
-                if dump_level is None:
-                    log_warn("Unable to determine vmcore dump level")
-                else:
-                    log_debug("Vmcore dump level is %d" % dump_level)
-
-                skip_makedumpfile = CONFIG["VmcoreDumpLevel"] <= 0 or CONFIG["VmcoreDumpLevel"] >= 32
-                if (dump_level is not None and
-                    (dump_level & CONFIG["VmcoreDumpLevel"]) == CONFIG["VmcoreDumpLevel"]):
-                    log_info("Stripping to %d would have no effect" % CONFIG["VmcoreDumpLevel"])
-                    skip_makedumpfile = True
-
-                if not skip_makedumpfile:
-                    log_debug("Executing makedumpfile")
-                    start = time.time()
-                    crash_cmd = self.get_crash_cmd().split()
-                    strip_vmcore(vmcore, kernelver, crash_cmd)
-                    self.set_crash_cmd(' '.join(crash_cmd))
-                    dur = int(time.time() - start)
-
                 st = os.stat(vmcore)
+                log_info("Vmcore size: %s (%s allocated)" % (human_readable_size(st.st_size),
+                                                             human_readable_size(st.st_blocks * 512)))
+
+                # stripping is done by the worker, see RetraceWorker.strip_vmcore
                 if (st.st_mode & stat.S_IRGRP) == 0:
                     try:
                         os.chmod(vmcore, st.st_mode | stat.S_IRGRP)
@@ -1988,9 +2775,6 @@ class RetraceTask:
                                  " failed. The process will continue but if"
                                  " it fails this is the likely cause."
                                  % vmcore)
-                if not skip_makedumpfile:
-                    log_info("Stripped size: %s" % human_readable_size(st.st_size))
-                    log_info("Makedumpfile took %d seconds and saved %s" % (dur, human_readable_size(oldsize - st.st_size)))
 
         if self.get_type() in [TASK_RETRACE, TASK_RETRACE_INTERACTIVE]:
             coredump = os.path.join(crashdir, "coredump")
@@ -2037,10 +2821,10 @@ class RetraceTask:
                 os.unlink(os.path.join(crashdir, filename))
 
             if os.path.isfile(coredump):
-                oldsize = os.path.getsize(coredump)
-                log_info("Coredump size: %s" % human_readable_size(oldsize))
-
                 st = os.stat(coredump)
+                log_info("Coredump size: %s (%s allocated)" % (human_readable_size(st.st_size),
+                                                               human_readable_size(st.st_blocks * 512)))
+
                 if (st.st_mode & stat.S_IRGRP) == 0:
                     try:
                         os.chmod(coredump, st.st_mode | stat.S_IRGRP)
@@ -2089,6 +2873,12 @@ class RetraceTask:
 
     def add_misc(self, name, value, overwrite=False):
         """Adds a file named 'name' into MISC_DIR and writes 'value' into it."""
+        with self.open_misc(name, overwrite) as misc_file:
+            misc_file.write(value)
+
+    def open_misc(self, name, overwrite=False):
+        """Returns AtomicFile creating a file named 'name' in MISC_DIR,
+        for records too large to be built in memory."""
         if "/" in name:
             raise Exception, "name may not contain the '/' character"
 
@@ -2099,12 +2889,16 @@ class RetraceTask:
         miscdir = os.path.join(self._savedir, RetraceTask.MISC_DIR)
         if not os.path.isdir(miscdir):
             oldmask = os.umask(0007)
-            os.makedirs(miscdir)
-            os.umask(oldmask)
+            try:
+                os.makedirs(miscdir)
+            except OSError as ex:
+                # parallel crash sessions open their outputs at once
+                if ex.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.umask(oldmask)
 
-        miscpath = os.path.join(miscdir, name)
-        with open(miscpath, "w") as misc_file:
-            misc_file.write(value)
+        return AtomicFile(os.path.join(miscdir, name))
 
     def del_misc(self, name):
         """Deletes the file named 'name' from MISC_DIR."""
@@ -2259,7 +3053,11 @@ class RetraceTask:
 
                 path = os.path.join(self._savedir, f)
                 try:
-                    if os.path.isdir(path):
+                    if f == "crash" and os.path.islink(path):
+                        # see create_crashdir
+                        release_fast_tier(os.path.realpath(path))
+                        os.unlink(path)
+                    elif os.path.isdir(path):
                         shutil.rmtree(path)
                     else:
                         os.remove(path)
@@ -135,13 +135,18 @@ class RetraceWorker(object):
         task.set_finished_time(int(time.time()))
 
         self.stats["duration"] = int(time.time()) - self.stats["starttime"]
+        statsid = None
         try:
-            save_crashstats(self.stats)
+            statsid = save_crashstats(self.stats)
         except Exception as ex:
             log_warn("Failed to save crash statistics: %s" % str(ex))
 
+        self.phases.switch("cleanup")
         if not task.get_type() in [TASK_DEBUG, TASK_RETRACE_INTERACTIVE, TASK_VMCORE_INTERACTIVE]:
             self.clean_task()
+        self.migrate_crashdir()
+        self._save_phases(statsid)
+        self._save_resources(statsid)
 
         self.hook_fail(errorcode)
 
@@ -162,12 +167,57 @@ class RetraceWorker(object):
 
         return output
 
+    def _query_resolver(self, releaseid, coredump):
+        """Returns coredump2packages output obtained from retrace-server-resolver
+        or None if the resolver is not available."""
+        from resolver import get_unstrip_output, query_resolver
+
+        try:
+            unstrip = get_unstrip_output(coredump, self.task.get_coreinfo())
+            output, c2plog = query_resolver(releaseid, unstrip)
+        except Exception as ex:
+            log_warn("Unable to query resolver, running coredump2packages: %s" % ex)
+            return None
+
+        with open(os.path.join(self.task.get_savedir(), "c2p_log"), "w") as f:
+            f.write(c2plog)
+
+        return output
+
+    def _use_debuginfo_cache(self, releaseid, coredump, packages):
+        """Makes sure the .debug files needed by the coredump are in the shared
+        debuginfo cache. Returns packages without the debuginfo packages
+        that do not need to be installed into the chroot anymore."""
+        from debugcache import DebuginfoCache, parse_unstrip_buildids
+        from resolver import get_unstrip_output
+
+        index = get_repo_index(releaseid)
+        if index is None:
+            log_warn("Debuginfo cache needs the package index of '%s'" % releaseid)
+            return packages
+
+        try:
+            unstrip = get_unstrip_output(coredump, self.task.get_coreinfo())
+            cached = DebuginfoCache().populate(index, os.path.join(CONFIG["RepoDir"], releaseid),
+                                               parse_unstrip_buildids(unstrip))
+        except Exception as ex:
+            log_warn("Unable to use debuginfo cache: %s" % ex)
+            return packages
+        finally:
+            index.close()
+
+        result = [p for p in packages if not p in cached]
+        log_info("%d debuginfo packages provided by debuginfo cache" % (len(packages) - len(result)))
+
+        return result
+
     def start_retrace(self, custom_arch=None):
         self.hook_start()
 
         task = self.task
         crashdir = os.path.join(task.get_savedir(), "crash")
         corepath = os.path.join(crashdir, "coredump")
+        self.phases.switch("analyze")
 
         try:
             self.stats["coresize"] = os.path.getsize(corepath)
@@ -179,7 +229,13 @@ class RetraceWorker(object):
             arch = custom_arch
         else:
             # read architecture from coredump
-            arch = guess_arch(corepath)
+            arch = None
+            coreinfo = task.get_coreinfo()
+            if coreinfo is not None:
+                arch = coreinfo["arch"]
+
+            if arch is None:
+                arch = guess_arch(corepath)
 
             if not arch:
                 log_error("Unable to determine architecture from coredump")
@@ -277,6 +333,7 @@ class RetraceWorker(object):
                       "official %s repositories?" % (crash_package, arch, release))
             self._fail()
 
+        self.phases.switch("packages")
         self.hook_pre_prepare_debuginfo()
 
         packages = [crash_package]
@@ -303,21 +360,30 @@ class RetraceWorker(object):
         else:
             # read required packages from coredump
             try:
-                repoid = "%s%s" % (REPO_PREFIX, releaseid)
-                yumcfgpath = os.path.join(task.get_savedir(), "yum.conf")
-                with open(yumcfgpath, "w") as yumcfg:
-                    yumcfg.write("[%s]\n" % repoid)
-                    yumcfg.write("name=%s\n" % releaseid)
-                    yumcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
-                    yumcfg.write("failovermethod=priority\n")
-
-                child = Popen(["coredump2packages", os.path.join(crashdir, "coredump"),
-                               "--repos=%s" % repoid, "--config=%s" % yumcfgpath,
-                               "--log=%s" % os.path.join(task.get_savedir(), "c2p_log")],
-                              stdout=PIPE, stderr=PIPE)
+                stdout = None
+                stderr = None
+                if CONFIG["UseResolver"]:
+                    stdout = self._query_resolver(releaseid, os.path.join(crashdir, "coredump"))
+
+                if stdout is None:
+                    repoid = "%s%s" % (REPO_PREFIX, releaseid)
+                    yumcfgpath = os.path.join(task.get_savedir(), "yum.conf")
+                    with open(yumcfgpath, "w") as yumcfg:
+                        yumcfg.write("[%s]\n" % repoid)
+                        yumcfg.write("name=%s\n" % releaseid)
+                        yumcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
+                        yumcfg.write("failovermethod=priority\n")
+
+                    child = Popen(["coredump2packages", os.path.join(crashdir, "coredump"),
+                                   "--repos=%s" % repoid, "--config=%s" % yumcfgpath,
+                                   "--releaseid=%s" % releaseid,
+                                   "--coreinfo=%s" % task._get_file_path(RetraceTask.COREINFO_FILE),
+                                   "--log=%s" % os.path.join(task.get_savedir(), "c2p_log")],
+                                  stdout=PIPE, stderr=PIPE)
+                    stdout, stderr = child.communicate()
+
                 section = 0
                 crash_package_or_component = None
-                stdout, stderr = child.communicate()
                 lines = stdout.split("\n")
                 libdb = False
                 for line in lines:
@@ -356,7 +422,11 @@ class RetraceWorker(object):
                 log_error("Unable to obtain packages from 'coredump' file: %s" % ex)
                 self._fail()
 
+        if CONFIG["UseDebuginfoCache"] and not CONFIG["UseFafPackages"]:
+            packages = self._use_debuginfo_cache(releaseid, os.path.join(crashdir, "coredump"), packages)
+
         self.hook_post_prepare_debuginfo()
+        self.phases.switch("mock_init")
         self.hook_pre_prepare_mock()
 
         # create mock config file
@@ -374,6 +444,11 @@ class RetraceWorker(object):
                 mockcfg.write("              ('%s', '/var/spool/abrt/crash'),\n" % crashdir)
                 if CONFIG["UseFafPackages"]:
                     mockcfg.write("              ('%s', '/packages'),\n" % fafrepo)
+                if CONFIG["UseDebuginfoCache"]:
+                    from debugcache import DebuginfoCache, CHROOT_DIR
+                    cachedir = DebuginfoCache().path
+                    if os.path.isdir(cachedir):
+                        mockcfg.write("              ('%s', '%s'),\n" % (cachedir, CHROOT_DIR))
                 mockcfg.write("            ] }\n")
                 mockcfg.write("\n")
                 mockcfg.write("config_opts['yum.conf'] = \"\"\"\n")
@@ -428,24 +503,32 @@ class RetraceWorker(object):
                          "--", "chgrp -R mockbuild /var/spool/abrt/crash"])
 
         # generate backtrace
+        self.phases.switch("gdb")
         task.set_status(STATUS_BACKTRACE)
         log_info(STATUS[STATUS_BACKTRACE])
 
+        limit = get_debugger_output_limit()
+        backtrace = CappedOutput(task.open_backtrace, limit)
+        exploitable = CappedOutput(lambda: task.open_misc("exploitable"), limit)
         try:
-            backtrace, exploitable = run_gdb(task.get_savedir())
+            run_gdb(task.get_savedir(), backtrace, exploitable)
         except Exception as ex:
+            backtrace.discard()
+            exploitable.discard()
             log_error(str(ex))
             self._fail()
 
-        task.set_backtrace(backtrace)
-        if exploitable is not None:
-            task.add_misc("exploitable", exploitable)
+        backtrace.close()
+        exploitable.close()
+        if backtrace.truncated:
+            log_warn("The backtrace has been truncated to %d bytes" % backtrace.written)
 
         self.hook_post_retrace()
 
         # does not work at the moment
         rootsize = 0
 
+        self.phases.switch("cleanup")
         if not task.get_type() in [TASK_DEBUG, TASK_RETRACE_INTERACTIVE]:
             # clean up temporary data
             task.set_status(STATUS_CLEANUP)
@@ -462,7 +545,10 @@ class RetraceWorker(object):
                 except:
                     pass
 
+        self.migrate_crashdir()
+
         # save crash statistics
+        self.phases.switch("stats")
         task.set_status(STATUS_STATS)
         log_info(STATUS[STATUS_STATS])
 
@@ -470,6 +556,7 @@ class RetraceWorker(object):
         self.stats["duration"] = int(time.time()) - self.stats["starttime"]
         self.stats["status"] = STATUS_SUCCESS
 
+        statsid = None
         try:
             con = init_crashstats_db()
             statsid = save_crashstats(self.stats, con)
@@ -481,6 +568,9 @@ class RetraceWorker(object):
         except Exception as ex:
             log_warn(str(ex))
 
+        self._save_phases(statsid)
+        self._save_resources(statsid)
+
         # publish log => finish task
         log_info("Retrace took %d seconds" % self.stats["duration"])
 
@@ -503,12 +593,53 @@ class RetraceWorker(object):
 
         return None
 
+    def _run_crash_commands(self, cmdline, sinks, stderr=STDOUT):
+        """Runs all vmcore analysis commands in crash sessions as configured
+        by VmcoreCrashGroups and VmcoreCrashSessions. Output of commands
+        present in sinks ({name: callable}) is passed there line by line.
+        Returns {name: output} or None if crash was unable to start."""
+        from crashbatch import CrashBatch, run_parallel
+
+        # the list of modules is needed to cache their debuginfo
+        commands = [("mod", "mod"), ("log", "log"), ("bt-a", "bt -a")]
+        if CONFIG["VmcoreRunKmem"] == 1:
+            commands.append(("kmem-f", "kmem -f"))
+        elif CONFIG["VmcoreRunKmem"] == 2:
+            commands.append(("kmem-f", "set hash off\nkmem -f\nset hash on"))
+        elif CONFIG["VmcoreRunKmem"] == 3:
+            commands.append(("kmem-z", "kmem -z"))
+        commands.extend([("sys", "sys"), ("sys-c", "sys -c"), ("foreach-bt", "foreach bt")])
+
+        # commands not mentioned in any group run in the first session
+        groups = [group.split() for group in CONFIG["VmcoreCrashGroups"].split(",")]
+        batches = [CrashBatch(cmdline, stderr=stderr) for group in groups]
+        for name, command in commands:
+            for i, group in enumerate(groups):
+                if name in group:
+                    batches[i].add(name, command, sinks.get(name))
+                    break
+            else:
+                batches[0].add(name, command, sinks.get(name))
+
+        batches = [batch for batch in batches if batch.commands]
+        sessions = CONFIG["VmcoreCrashSessions"]
+        if sessions <= 0:
+            sessions = len(batches)
+
+        log_debug("Running %d crash sessions, %d at a time" % (len(batches), sessions))
+        result = run_parallel(batches, sessions)
+        if not any(batch.started for batch in batches):
+            return None
+
+        return result
+
     def start_vmcore(self, custom_kernelver=None):
         self.hook_start()
 
         task = self.task
 
         vmcore = os.path.join(task.get_savedir(), "crash", "vmcore")
+        self.phases.switch("kernelver")
 
         if custom_kernelver is not None:
             kernelver = custom_kernelver
@@ -536,7 +667,19 @@ class RetraceWorker(object):
         task.set_status(STATUS_INIT)
         vmlinux = ""
 
-        if task.use_mock(kernelver):
+        # crash output goes directly into misc files, backtraces
+        # are grouped as crash prints them
+        from btfilter import BacktraceFilter
+        btfilter = BacktraceFilter()
+        limit = get_debugger_output_limit()
+        outputs = dict((name, CappedOutput(lambda name=name: task.open_misc(name), limit))
+                       for name in ["bt-a", "kmem-f", "kmem-z", "sys", "sys-c"])
+        sinks = dict((name, output.write) for name, output in outputs.items())
+        sinks["foreach-bt"] = btfilter.feed
+
+        use_mock = task.use_mock(kernelver)
+        if use_mock:
+            self.phases.switch("mock_init")
             self.hook_post_prepare_mock()
 
             # we don't save config into task.get_savedir() because it is only
@@ -567,7 +710,13 @@ class RetraceWorker(object):
                     mockcfg.write("config_opts['plugin_conf']['bind_mount_enable'] = True\n")
                     mockcfg.write("config_opts['plugin_conf']['bind_mount_opts'] = { \n")
                     mockcfg.write("    'dirs': [('%s', '%s'),\n" % (CONFIG["RepoDir"], CONFIG["RepoDir"]))
-                    mockcfg.write("             ('%s', '%s'),],\n" % (task.get_savedir(), task.get_savedir()))
+                    mockcfg.write("             ('%s', '%s'),\n" % (task.get_savedir(), task.get_savedir()))
+                    crashdir = os.path.join(task.get_savedir(), "crash")
+                    if os.path.islink(crashdir):
+                        # crash data on the fast tier
+                        fastdir = os.path.realpath(crashdir)
+                        mockcfg.write("             ('%s', '%s'),\n" % (fastdir, fastdir))
+                    mockcfg.write("            ],\n")
                     mockcfg.write("    'create_dirs': True, }\n")
                     mockcfg.write("\n")
                     mockcfg.write("config_opts['yum.conf'] = \"\"\"\n")
@@ -612,164 +761,85 @@ class RetraceWorker(object):
             self.hook_post_prepare_mock()
 
             # no locks required, mock locks itself
+            self.phases.switch("debuginfo")
             try:
                 self.hook_pre_prepare_debuginfo()
-                vmlinux = prepare_debuginfo(vmcore, cfgdir, kernelver=kernelver, crash_cmd=task.get_crash_cmd().split())
+                vmlinux, debuginfo, debugfiles = cache_vmlinux(kernelver)
                 self.hook_post_prepare_debuginfo()
-
-                self.hook_pre_retrace()
-                # generate the log
-                with open(os.devnull, "w") as null:
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash --minimal -s %s %s" % (vmcore, vmlinux)],
-                                  stdin=PIPE, stdout=PIPE, stderr=null)
-                    kernellog = child.communicate("log\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'log' exitted with %d" % child.returncode)
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_bt_a = child.communicate("bt -a\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'bt -a' exitted with %d" % child.returncode)
-                        crash_bt_a = None
-
-                    crash_kmem_f = None
-                    if CONFIG["VmcoreRunKmem"] == 1:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_f = child.communicate("kmem -f\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -f' exitted with %d" % child.returncode)
-                            crash_kmem_f = None
-
-                    if CONFIG["VmcoreRunKmem"] == 2:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_f = child.communicate("set hash off\nkmem -f\nset hash on\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -f' exitted with %d" % child.returncode)
-                            crash_kmem_f = None
-
-                    crash_kmem_z = None
-                    if CONFIG["VmcoreRunKmem"] == 3:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_z = child.communicate("kmem -z\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -z' exitted with %d" % child.returncode)
-                            crash_kmem_z = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_sys = child.communicate("sys\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'sys' exitted with %d" % child.returncode)
-                        crash_sys = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_sys_c = child.communicate("sys -c\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'sys -c' exitted with %d" % child.returncode)
-                        crash_sys_c = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_foreach_bt = child.communicate("foreach bt\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'foreach bt' exitted with %d" % child.returncode)
-                        crash_foreach_bt = None
-
             except Exception as ex:
                 log_error(str(ex))
                 self._fail()
 
+            self.hook_pre_retrace()
+            self.phases.switch("crash")
+            crash_cmdline = ["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
+                             "crash -s %s %s" % (vmcore, vmlinux)]
+            minimal_cmdline = ["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
+                               "crash --minimal -s %s %s" % (vmcore, vmlinux)]
+            with open(os.devnull, "w") as null:
+                results = self._run_crash_commands(crash_cmdline, sinks, stderr=null)
+
         else:
+            self.phases.switch("debuginfo")
             try:
                 self.hook_pre_prepare_debuginfo()
-                crash_cmd = task.get_crash_cmd().split()
-                vmlinux = prepare_debuginfo(vmcore, kernelver=kernelver, crash_cmd=crash_cmd)
-                task.set_crash_cmd(' '.join(crash_cmd))
+                vmlinux, debuginfo, debugfiles = cache_vmlinux(kernelver)
                 self.hook_post_prepare_debuginfo()
             except Exception as ex:
                 log_error("prepare_debuginfo failed: %s" % str(ex))
                 self._fail()
 
             self.hook_pre_retrace()
+            self.phases.switch("crash")
             task.set_status(STATUS_BACKTRACE)
             log_info(STATUS[STATUS_BACKTRACE])
 
-            child = Popen(task.get_crash_cmd().split() + ["--minimal", "-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            kernellog = child.communicate("log\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'log' exited with %d" % child.returncode)
+            crash_cmd = task.get_crash_cmd().split()
+            results = self._run_crash_commands(crash_cmd + ["-s", vmcore, vmlinux], sinks)
+            if results is None and "el5" in kernelver.release:
+                log_info("Unable to run crash but el5 detected, trying crash fixup for vmss files")
+                crash_cmd.append("--machdep")
+                crash_cmd.append("phys_base=0x200000")
+                results = self._run_crash_commands(crash_cmd + ["-s", vmcore, vmlinux], sinks)
+                if results is not None:
+                    task.set_crash_cmd(" ".join(crash_cmd))
 
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_bt_a = child.communicate("bt -a\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'bt -a' exited with %d" % child.returncode)
-                crash_bt_a = None
-
-            crash_kmem_f = None
-            if CONFIG["VmcoreRunKmem"] == 1:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_f = child.communicate("kmem -f\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -f' exited with %d" % child.returncode)
-                    crash_kmem_f = None
-
-            if CONFIG["VmcoreRunKmem"] == 2:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_f = child.communicate("set hash off\nkmem -f\nset hash on\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -f' exited with %d" % child.returncode)
-                    crash_kmem_f = None
-
-            crash_kmem_z = None
-            if CONFIG["VmcoreRunKmem"] == 3:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_z = child.communicate("kmem -z\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -z' exited with %d" % child.returncode)
-                    crash_kmem_z = None
-
-            child = Popen(task.get_crash_cmd().split() +  ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_sys = child.communicate("sys\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'sys' exited with %d" % child.returncode)
-                crash_sys = None
+            minimal_cmdline = crash_cmd + ["--minimal", "-s", vmcore, vmlinux]
 
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_sys_c = child.communicate("sys -c\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'sys -c' exited with %d" % child.returncode)
-                crash_sys_c = None
+        if results is None:
+            results = {}
 
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_foreach_bt = child.communicate("foreach bt\nquit\n")[0]
+        if results.get("mod") is not None:
+            try:
+                cache_modules_debuginfo(kernelver, debuginfo, debugfiles, results["mod"])
+            except Exception as ex:
+                log_warn("Unable to cache debuginfo of modules: %s" % ex)
+
+        kernellog = results.get("log")
+        if kernellog is None:
+            # --minimal works even if crash is unable to initialize the dump
+            with open(os.devnull, "w") as null:
+                child = Popen(minimal_cmdline, stdin=PIPE, stdout=PIPE,
+                              stderr=null if use_mock else STDOUT)
+                kernellog = child.communicate("log\nquit\n")[0]
             if child.wait():
-                log_warn("crash 'foreach bt' exited with %d" % child.returncode)
-                crash_foreach_bt = None
+                log_warn("crash 'log' exited with %d" % child.returncode)
 
         task.set_backtrace(kernellog)
-        if crash_bt_a:
-            task.add_misc("bt-a", crash_bt_a)
-        if crash_kmem_f:
-            task.add_misc("kmem-f", crash_kmem_f)
-        if crash_kmem_z:
-            task.add_misc("kmem-z", crash_kmem_z)
-        if crash_sys:
-            task.add_misc("sys", crash_sys)
-        if crash_sys_c:
-            task.add_misc("sys-c", crash_sys_c)
-        if crash_foreach_bt:
-            child = Popen(["bt_filter"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            bt_filter = child.communicate(crash_foreach_bt)[0]
-            if child.wait():
-                bt_filter = "bt_filter exitted with %d\n\n%s" % (child.returncode, bt_filter)
+        for name, output in outputs.items():
+            # partial output of a failed command is not published
+            if results.get(name) is None:
+                output.discard()
+                continue
+
+            output.close()
+            if output.truncated:
+                log_warn("crash '%s' output has been truncated to %d bytes" % (name, output.written))
 
-            task.add_misc("bt-filter", bt_filter)
+        if results.get("foreach-bt") is not None:
+            btfilter.close()
+            with task.open_misc("bt-filter") as bt_filter:
+                btfilter.write_report(bt_filter)
 
         crashrc_lines = []
 
@@ -784,23 +854,29 @@ class RetraceWorker(object):
 
         self.hook_post_retrace()
 
+        self.phases.switch("stats")
         task.set_finished_time(int(time.time()))
         self.stats["duration"] = int(time.time()) - self.stats["starttime"]
         self.stats["status"] = STATUS_SUCCESS
 
         log_info(STATUS[STATUS_STATS])
 
+        statsid = None
         try:
-            save_crashstats(self.stats)
+            statsid = save_crashstats(self.stats)
         except Exception as ex:
             log_error(str(ex))
 
         # clean up temporary data
+        self.phases.switch("cleanup")
         task.set_status(STATUS_CLEANUP)
         log_info(STATUS[STATUS_CLEANUP])
 
         if not task.get_type() in [TASK_VMCORE_INTERACTIVE]:
             self.clean_task()
+        self.migrate_crashdir()
+        self._save_phases(statsid)
+        self._save_resources(statsid)
 
         if CONFIG["EmailNotify"] and task.has_notify():
             try:
@@ -865,6 +941,8 @@ class RetraceWorker(object):
             "coresize": None,
             "status": STATUS_FAIL,
         }
+        self.phases = PhaseTimer()
+        start_accounting()
         self.prerunning = len(get_active_tasks()) - 1
         try:
             task = self.task
@@ -872,11 +950,13 @@ class RetraceWorker(object):
             task.set_started_time(int(time.time()))
 
             if task.has_remote():
-                errors = task.download_remote(kernelver=kernelver)
+                self.phases.switch("download")
+                errors = task.download_remote(kernelver=kernelver, phases=self.phases)
                 if errors:
                     for error in errors:
                         log_warn(error)
 
+            self.phases.switch("prepare")
             task.set_status(STATUS_ANALYZE)
             log_info(STATUS[STATUS_ANALYZE])
 
@@ -900,8 +980,12 @@ class RetraceWorker(object):
                     self._fail()
 
             if tasktype in [TASK_RETRACE, TASK_DEBUG, TASK_RETRACE_INTERACTIVE]:
+                self.punch_holes(os.path.join(crashdir, "coredump"))
                 self.start_retrace(custom_arch=arch)
             elif tasktype in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+                # the stripped vmcore is compressed, there are no zeros
+                if not self.strip_vmcore(kernelver=kernelver):
+                    self.punch_holes(os.path.join(crashdir, "vmcore"))
                 self.start_vmcore(custom_kernelver=kernelver)
             else:
                 raise Exception("Unsupported task type")
@@ -909,6 +993,149 @@ class RetraceWorker(object):
             log_error(str(ex))
             self._fail()
 
+    def strip_vmcore(self, kernelver=None):
+        """Strips the vmcore to VmcoreDumpLevel unless it is
+        already stripped to at least the same level. Returns
+        whether the vmcore has been replaced by the stripped one."""
+        if CONFIG["VmcoreDumpLevel"] <= 0 or CONFIG["VmcoreDumpLevel"] >= 32:
+            return False
+
+        task = self.task
+        vmcore = os.path.join(task.get_savedir(), "crash", "vmcore")
+
+        dump_level = get_vmcore_dump_level(task)
+        if dump_level is None:
+            log_warn("Unable to determine vmcore dump level")
+        else:
+            log_debug("Vmcore dump level is %d" % dump_level)
+            if (dump_level & CONFIG["VmcoreDumpLevel"]) == CONFIG["VmcoreDumpLevel"]:
+                log_info("Stripping to %d would have no effect" % CONFIG["VmcoreDumpLevel"])
+                return False
+
+        task.set_status(STATUS_POSTPROCESS)
+        log_info(STATUS[STATUS_POSTPROCESS])
+
+        log_debug("Executing makedumpfile")
+        self.phases.switch("makedumpfile")
+        # sparse vmcores occupy less than their size
+        oldsize = os.stat(vmcore).st_blocks * 512
+        start = time.time()
+        crash_cmd = task.get_crash_cmd().split()
+        stripped = strip_vmcore(vmcore, kernelver, crash_cmd)
+        task.set_crash_cmd(" ".join(crash_cmd))
+        dur = int(time.time() - start)
+
+        st = os.stat(vmcore)
+        if (st.st_mode & stat.S_IRGRP) == 0:
+            # crash runs as mock in the chroot
+            try:
+                os.chmod(vmcore, st.st_mode | stat.S_IRGRP)
+            except Exception as ex:
+                log_warn("Unable to make stripped vmcore group readable: %s" % ex)
+
+        newsize = st.st_size
+        log_info("Stripped size: %s" % human_readable_size(newsize))
+        log_info("Makedumpfile took %d seconds and saved %s"
+                 % (dur, human_readable_size(max(0, oldsize - st.st_blocks * 512))))
+
+        return stripped
+
+    def punch_holes(self, path):
+        """Deallocates blocks of zeros in a core written by tools
+        not aware of sparse files."""
+        from fileops import allocated_size, punch_holes
+
+        try:
+            with open(path, "rb") as f:
+                if f.read(4) != "\x7fELF":
+                    # kdump-compressed vmcores have no runs of zeros
+                    return
+
+            if allocated_size(path) < os.path.getsize(path):
+                log_debug("'%s' is sparse already" % os.path.basename(path))
+                return
+
+            start = time.time()
+            freed = punch_holes(path)
+        except EnvironmentError as ex:
+            log_warn("Unable to punch holes into '%s': %s" % (path, ex))
+            return
+
+        if freed:
+            log_info("Deallocated %s of zeros in %d seconds"
+                     % (human_readable_size(freed), int(time.time() - start)))
+
+    def _save_phases(self, statsid):
+        """Logs how long the phases of the task took and saves it into
+        the 'phases' misc file and, if statsid is known, the stats database."""
+        self.phases.stop()
+        report = self.phases.format()
+        log_info("Time spent in phases (unpacking runs during download):\n%s" % report)
+
+        try:
+            self.task.add_misc("phases", report, overwrite=True)
+        except Exception as ex:
+            log_warn("Unable to save phases: %s" % ex)
+
+        if statsid is not None:
+            try:
+                save_crashstats_phases(statsid, self.phases.items())
+            except Exception as ex:
+                log_warn("Unable to save phases into the stats database: %s" % ex)
+
+    def _save_resources(self, statsid):
+        """Summarizes the resources used by the children of the worker
+        per command into the 'resources' misc file and the log and saves
+        every child into the stats database if statsid is known."""
+        processes = stop_accounting()
+        if not processes:
+            return
+
+        commands = {}
+        for process in processes:
+            summary = commands.setdefault(process["command"], {"count": 0, "wall": 0.0, "cpu": 0.0,
+                                                               "maxrss": 0, "read": 0, "written": 0})
+            summary["count"] += 1
+            summary["wall"] += process["wall"]
+            summary["cpu"] += process["utime"] + process["stime"]
+            summary["maxrss"] = max(summary["maxrss"], process["maxrss"])
+            summary["read"] += process["read_bytes"]
+            summary["written"] += process["write_bytes"]
+
+        lines = ["%-20s %5s %10s %10s %12s %12s %12s" % ("command", "count", "wall", "cpu",
+                                                         "peak rss", "read", "written")]
+        for command, summary in sorted(commands.items(), key=lambda (c, s): s["cpu"], reverse=True):
+            lines.append("%-20s %5d %8.1f s %8.1f s %12s %12s %12s"
+                         % (command, summary["count"], summary["wall"], summary["cpu"],
+                            human_readable_size(summary["maxrss"]),
+                            human_readable_size(summary["read"]),
+                            human_readable_size(summary["written"])))
+        report = "%s\n" % "\n".join(lines)
+
+        log_info("Children used %.1f s of CPU, peak RSS %s, read %s, written %s"
+                 % (sum(s["cpu"] for s in commands.values()),
+                    human_readable_size(max(s["maxrss"] for s in commands.values())),
+                    human_readable_size(sum(s["read"] for s in commands.values())),
+                    human_readable_size(sum(s["written"] for s in commands.values()))))
+
+        try:
+            self.task.add_misc("resources", report, overwrite=True)
+        except Exception as ex:
+            log_warn("Unable to save resources: %s" % ex)
+
+        if statsid is not None:
+            try:
+                save_crashstats_processes(statsid, processes)
+            except Exception as ex:
+                log_warn("Unable to save resources into the stats database: %s" % ex)
+
+    def migrate_crashdir(self):
+        """Moves the crash data kept by a finished task off the fast tier."""
+        try:
+            self.task.migrate_crashdir()
+        except Exception as ex:
+            log_warn("Unable to move crash data off the fast tier: %s" % ex)
+
     def clean_task(self):
         self.hook_pre_clean_task()
         ret = self.task.clean()
@@ -0,0 +1,298 @@
+import errno
+import os
+import shutil
+import sqlite3
+import stat
+from retrace import Popen, PIPE
+from config import *
+
+# RPM payload compressor -> command decompressing stdin to stdout
+DECOMPRESSORS = {
+  "gzip": [GZIP_BIN, "-dc"],
+  "bzip2": ["bzip2", "-dc"],
+  "xz": [XZ_BIN, "-dc"],
+  "lzma": [XZ_BIN, "--format=lzma", "-dc"],
+  "zstd": ["zstd", "-dc"],
+}
+
+CPIO_NEWC_MAGIC = ["070701", "070702"]
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+
+BUFSIZE = 1 << 20
+
+class PayloadError(Exception):
+    pass
+
+class _PayloadStream(object):
+    """Uncompressed cpio payload of an RPM read from a decompressor.
+    Keeps track of the position so that members can be addressed
+    by their offset in the payload."""
+
+    def __init__(self, rpmpath):
+        import rpm
+
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(-1)
+        fd = os.open(rpmpath, os.O_RDONLY)
+        try:
+            # reading the header leaves fd at the beginning of the payload
+            hdr = ts.hdrFromFdno(fd)
+            compressor = hdr[rpm.RPMTAG_PAYLOADCOMPRESSOR] or "gzip"
+            if not compressor in DECOMPRESSORS:
+                raise PayloadError, "Unsupported payload compressor '%s'" % compressor
+
+            self._null = open(os.devnull, "w")
+            self._child = Popen(DECOMPRESSORS[compressor], stdin=fd,
+                                stdout=PIPE, stderr=self._null)
+        finally:
+            os.close(fd)
+
+        self.pos = 0
+
+    def read(self, size):
+        result = self._child.stdout.read(size)
+        if len(result) != size:
+            raise PayloadError, "Unexpected end of payload"
+
+        self.pos += size
+        return result
+
+    def skip(self, size):
+        while size > 0:
+            size -= len(self.read(min(size, BUFSIZE)))
+
+    def copy(self, size, target):
+        while size > 0:
+            data = self.read(min(size, BUFSIZE))
+            target.write(data)
+            size -= len(data)
+
+    def align(self):
+        self.skip((4 - self.pos % 4) % 4)
+
+    def close(self):
+        # stopping early is fine, the rest of the payload is not needed
+        if self._child.poll() is None:
+            self._child.kill()
+        self._child.stdout.close()
+        self._child.wait()
+        self._null.close()
+
+def _read_member_header(stream):
+    """Returns (name, mode, size, nlink, ino) of the next cpio member
+    or None at the end of the archive. The stream is left at its data."""
+    header = stream.read(CPIO_HEADER_SIZE)
+    if not header[:6] in CPIO_NEWC_MAGIC:
+        raise PayloadError, "Unsupported cpio format"
+
+    fields = [int(header[6 + 8 * i:14 + 8 * i], 16) for i in xrange(13)]
+    ino, mode, nlink, size, namesize = fields[0], fields[1], fields[4], fields[6], fields[11]
+    name = stream.read(namesize).rstrip("\0")
+    stream.align()
+    if name == CPIO_TRAILER:
+        return None
+
+    # ./usr/lib/debug/... -> /usr/lib/debug/...
+    if name.startswith("./"):
+        name = name[1:]
+    elif not name.startswith("/"):
+        name = "/%s" % name
+
+    return name, mode, size, nlink, ino
+
+def _write_member(stream, basedir, name, mode, size):
+    target = os.path.join(basedir, name.lstrip("/"))
+    targetdir = os.path.dirname(target)
+    if not os.path.isdir(targetdir):
+        try:
+            os.makedirs(targetdir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    if stat.S_ISLNK(mode):
+        linkto = stream.read(size)
+        if not os.path.lexists(target):
+            os.symlink(linkto, target)
+        return target
+
+    # concurrent tasks may extract the same file, never expose a partial one
+    tmpfile = "%s.%d.tmp" % (target, os.getpid())
+    with open(tmpfile, "wb") as f:
+        stream.copy(size, f)
+    os.chmod(tmpfile, stat.S_IMODE(mode))
+    os.rename(tmpfile, target)
+    return target
+
+def _copy_member(source, basedir, name):
+    """Extracts name as a copy of the already extracted source,
+    hardlinks share the data."""
+    target = os.path.join(basedir, name.lstrip("/"))
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    shutil.copy2(source, target)
+
+class PayloadIndex(object):
+    """Persistent list of members of RPM payloads with their offsets
+    and sizes in the uncompressed cpio archive."""
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path, timeout=60)
+        self._con.text_factory = str
+        query = self._con.cursor()
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          rpms(id INTEGER PRIMARY KEY AUTOINCREMENT, path NOT NULL UNIQUE,
+               size NOT NULL, mtime NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          members(rpmid REFERENCES rpms(id), name NOT NULL,
+                  offset NOT NULL, size NOT NULL, mode NOT NULL)
+        """)
+        query.execute("CREATE INDEX IF NOT EXISTS members_rpmid_name ON members(rpmid, name)")
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+    def _rpmid(self, rpmpath):
+        """Returns the ID of an up-to-date index of the RPM or None."""
+        st = os.stat(rpmpath)
+        query = self._con.cursor()
+        query.execute("SELECT id, size, mtime FROM rpms WHERE path = ?", (rpmpath,))
+        row = query.fetchone()
+        if row is None:
+            return None
+
+        rpmid, size, mtime = row
+        if size == st.st_size and mtime == int(st.st_mtime):
+            return rpmid
+
+        # the RPM has been replaced
+        query.execute("DELETE FROM members WHERE rpmid = ?", (rpmid,))
+        query.execute("DELETE FROM rpms WHERE id = ?", (rpmid,))
+        self._con.commit()
+        return None
+
+    def list_files(self, rpmpath):
+        """Returns paths of all files in the RPM. Read from the index if
+        the RPM has been indexed, from the RPM header otherwise."""
+        rpmid = self._rpmid(rpmpath)
+        if rpmid is not None:
+            query = self._con.cursor()
+            query.execute("SELECT name FROM members WHERE rpmid = ?", (rpmid,))
+            return [row[0] for row in query.fetchall()]
+
+        import rpm
+
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(-1)
+        fd = os.open(rpmpath, os.O_RDONLY)
+        try:
+            hdr = ts.hdrFromFdno(fd)
+        finally:
+            os.close(fd)
+
+        return list(hdr[rpm.RPMTAG_FILENAMES])
+
+    def _scan(self, rpmpath, basedir, files):
+        """Reads the whole payload, extracts files into basedir
+        and records all members in the index."""
+        wanted = set(files)
+        members = []
+        # hardlinked files only carry data in the last entry
+        hardlinks = {}
+        # ino -> [(name, mode), ...] of wanted links waiting for the data
+        pending = {}
+        stream = _PayloadStream(rpmpath)
+        try:
+            while True:
+                member = _read_member_header(stream)
+                if member is None:
+                    break
+
+                name, mode, size, nlink, ino = member
+                entry = [name, stream.pos, size, mode]
+                members.append(entry)
+                if nlink > 1 and not stat.S_ISDIR(mode):
+                    links = hardlinks.setdefault(ino, [])
+                    links.append(entry)
+                    if size > 0:
+                        for link in links:
+                            link[1], link[2] = entry[1], entry[2]
+
+                targets = []
+                if nlink > 1 and size > 0:
+                    targets = pending.pop(ino, [])
+                if name in wanted and not stat.S_ISDIR(mode):
+                    if size == 0 and nlink > 1:
+                        pending.setdefault(ino, []).append((name, mode))
+                    else:
+                        targets.insert(0, (name, mode))
+
+                if targets:
+                    source = _write_member(stream, basedir, targets[0][0], targets[0][1], size)
+                    for linkname, linkmode in targets[1:]:
+                        _copy_member(source, basedir, linkname)
+                else:
+                    stream.skip(size)
+
+                stream.align()
+
+            # hardlinked empty files, no entry carries data
+            for links in pending.values():
+                for name, mode in links:
+                    _write_member(stream, basedir, name, mode, 0)
+        finally:
+            stream.close()
+
+        st = os.stat(rpmpath)
+        query = self._con.cursor()
+        query.execute("INSERT INTO rpms (path, size, mtime) VALUES (?, ?, ?)",
+                      (rpmpath, st.st_size, int(st.st_mtime)))
+        rpmid = query.lastrowid
+        query.executemany("INSERT INTO members (rpmid, name, offset, size, mode) "
+                          "VALUES (?, ?, ?, ?, ?)",
+                          [[rpmid] + entry for entry in members])
+        self._con.commit()
+
+    def extract(self, rpmpath, basedir, files):
+        """Extracts files (absolute paths as in the RPM) into basedir.
+        The first extraction reads the whole payload and indexes it, later
+        ones only decompress the payload up to the last requested file."""
+        rpmid = self._rpmid(rpmpath)
+        if rpmid is None:
+            self._scan(rpmpath, basedir, files)
+            return
+
+        query = self._con.cursor()
+        todo = []
+        for name in set(files):
+            query.execute("SELECT offset, size, mode FROM members "
+                          "WHERE rpmid = ? AND name = ?", (rpmid, name))
+            row = query.fetchone()
+            if row is None:
+                raise PayloadError, "'%s' is not in the payload" % name
+
+            offset, size, mode = row
+            if not stat.S_ISDIR(mode):
+                todo.append((offset, size, mode, name))
+
+        if not todo:
+            return
+
+        # offset -> extracted file, hardlinks share the data
+        extracted = {}
+        stream = _PayloadStream(rpmpath)
+        try:
+            for offset, size, mode, name in sorted(todo):
+                if offset in extracted:
+                    _copy_member(extracted[offset], basedir, name)
+                    continue
+
+                stream.skip(offset - stream.pos)
+                extracted[offset] = _write_member(stream, basedir, name, mode, size)
+        finally:
+            stream.close()
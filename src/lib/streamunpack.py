@@ -0,0 +1,189 @@
+import os
+import threading
+from retrace import *
+from fileops import write_at
+
+BLOCK_SIZE = 1 << 20
+
+# enough to see the tar header, "ustar" is at offset 257
+SNIFF_SIZE = 512
+TAR_MAGIC_OFFSET = 257
+
+# leading bytes -> command decompressing stdin to stdout
+DECOMPRESSORS = [
+  ("\x1f\x8b", [GZIP_BIN, "-dc"]),
+  # compress'd data, gzip handles it as well
+  ("\x1f\x9d", [GZIP_BIN, "-dc"]),
+  ("BZh", ["bzip2", "-dc"]),
+  ("\xfd7zXZ\x00", [XZ_BIN, "-dc"]),
+  ("\x89LZO\x00\r\n\x1a\n", ["lzop", "-dc"]),
+]
+
+def get_stream_decompressor(head):
+    """Returns the command decompressing data starting with head
+    or None if it is not compressed by a streamable format."""
+    for magic, cmd in DECOMPRESSORS:
+        if head.startswith(magic):
+            return cmd
+
+    return None
+
+def is_tar(head):
+    return head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 5] == "ustar"
+
+class _Output(object):
+    """Writes data into directory/filename, or extracts it into
+    directory if it is a tarball."""
+
+    def __init__(self, directory, filename):
+        self.directory = directory
+        self.filename = filename
+        # the file written, None if a tarball has been extracted
+        self.path = None
+        self._buffer = []
+        self._buffered = 0
+        self._written = 0
+        self._target = None
+        self._child = None
+
+    def _start(self):
+        head = "".join(self._buffer)
+        if is_tar(head):
+            log_debug("Extracting tarball into '%s'" % self.directory)
+            self._child = Popen([TAR_BIN, "-x", "-C", self.directory], stdin=PIPE)
+            self._target = self._child.stdin
+        else:
+            self.path = os.path.join(self.directory, self.filename)
+            self._target = open(self.path, "wb")
+
+        self._buffer = None
+        self.write(head)
+
+    def write(self, data):
+        if self._target is not None:
+            if self.path is None:
+                self._target.write(data)
+            else:
+                # zeros of sparse cores are left as holes
+                write_at(self._target, self._written, data)
+            self._written += len(data)
+            return
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= SNIFF_SIZE:
+            self._start()
+
+    def close(self):
+        if self._target is None:
+            self._start()
+
+        if self.path is not None:
+            # the length of a trailing hole
+            self._target.truncate(self._written)
+        self._target.close()
+        if self._child is not None and self._child.wait():
+            raise Exception, "tar exitted with %d" % self._child.returncode
+
+    def abort(self):
+        if self._child is not None and self._child.poll() is None:
+            self._child.kill()
+            self._child.wait()
+        if self._target is not None and not self._target.closed:
+            try:
+                self._target.close()
+            except IOError:
+                pass
+
+class StreamUnpacker(object):
+    """Consumes a file as it is being downloaded. Compressed data is piped
+    through the decompressor and written into directory/outname, a tarball
+    (possibly compressed) is extracted into directory and anything else is
+    written into directory/filename as is. The format is detected from the
+    first bytes, so the compressed file never lands on the disk and
+    decompression runs in parallel with the download."""
+
+    def __init__(self, directory, filename, outname):
+        self.directory = directory
+        self.filename = filename
+        self.outname = outname
+        self._head = ""
+        self._target = None
+        self._cmd = None
+        self._child = None
+        self._output = None
+        self._pump = None
+        self._error = None
+
+    def _pump_output(self):
+        try:
+            for data in iter(lambda: self._child.stdout.read(BLOCK_SIZE), ""):
+                self._output.write(data)
+        except Exception as ex:
+            self._error = ex
+            # let the decompressor die on a broken pipe
+            self._child.stdout.close()
+
+    def _start(self):
+        self._cmd = get_stream_decompressor(self._head)
+        if self._cmd is None:
+            self._output = _Output(self.directory, self.filename)
+            self._target = self._output
+        else:
+            log_debug("Decompressing '%s' on the fly by %s" % (self.filename, self._cmd[0]))
+            self._output = _Output(self.directory, self.outname)
+            self._child = Popen(self._cmd, stdin=PIPE, stdout=PIPE)
+            self._target = self._child.stdin
+            self._pump = threading.Thread(target=self._pump_output, name="decompress")
+            self._pump.daemon = True
+            self._pump.start()
+
+        self._target.write(self._head)
+
+    def write(self, data):
+        if self._target is not None:
+            self._target.write(data)
+            return
+
+        self._head += data
+        if len(self._head) >= SNIFF_SIZE:
+            self._start()
+
+    def close(self):
+        """Finishes unpacking. Returns the path of the resulting file. If
+        a tarball has been extracted, that is the file named outname or
+        the largest extracted file if there is no such file."""
+        if self._target is None:
+            self._start()
+
+        if self._child is not None:
+            self._child.stdin.close()
+            self._pump.join()
+            if self._child.wait():
+                raise Exception, "%s exitted with %d" % (self._cmd[0], self._child.returncode)
+            if self._error is not None:
+                raise self._error
+
+        self._output.close()
+        if self._output.path is not None:
+            return self._output.path
+
+        files = get_files_sizes(self.directory)
+        if not files:
+            raise Exception, "No files found in the tarball"
+
+        for path, size in files:
+            if os.path.basename(path) == self.outname:
+                return path
+
+        return files[0][0]
+
+    def abort(self):
+        """Stops the decompressor after a failed download."""
+        if self._child is not None:
+            if self._child.poll() is None:
+                self._child.kill()
+            self._child.wait()
+            self._pump.join()
+        if self._output is not None:
+            self._output.abort()
@@ -0,0 +1,285 @@
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+from retrace import *
+from streamunpack import SNIFF_SIZE, get_stream_decompressor, is_tar
+
+BLOCK_SIZE = 1 << 20
+
+# do not descend forever into archives of archives
+MAX_DEPTH = 8
+
+ZIP_MAGIC = "PK\x03\x04"
+SEVENZIP_MAGIC = "7z\xbc\xaf\x27\x1c"
+
+class UnsupportedArchive(Exception):
+    pass
+
+class _Peekable(object):
+    """File-like wrapper able to look at the first bytes of a stream."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._head = ""
+
+    def peek(self, size):
+        while len(self._head) < size:
+            data = self._stream.read(size - len(self._head))
+            if not data:
+                break
+            self._head += data
+
+        return self._head[:size]
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+
+        if size < 0:
+            result = self._head + self._stream.read()
+            self._head = ""
+        else:
+            # short reads are fine for all the consumers
+            result = self._head[:size]
+            self._head = self._head[size:]
+
+        return result
+
+def write_sparse(stream, path):
+    """Writes stream into path, zero blocks are left as holes."""
+    zeros = "\0" * BLOCK_SIZE
+    size = 0
+    with open(path, "wb") as target:
+        for data in iter(lambda: stream.read(BLOCK_SIZE), ""):
+            if data == zeros[:len(data)]:
+                target.seek(len(data), os.SEEK_CUR)
+            else:
+                target.write(data)
+            size += len(data)
+
+        target.truncate(size)
+
+    return size
+
+def _feed(source, pipe, errors):
+    try:
+        shutil.copyfileobj(source, pipe, BLOCK_SIZE)
+    except Exception as ex:
+        errors.append(ex)
+    finally:
+        try:
+            pipe.close()
+        except IOError:
+            pass
+
+class _Decompressed(object):
+    """Stream decompressed by an external command. A real file is passed
+    to the command directly, anything else is fed by a thread."""
+
+    def __init__(self, stream, cmd):
+        self.cmd = cmd
+        self._errors = []
+        self._feeder = None
+        if isinstance(stream, file):
+            self._child = Popen(cmd, stdin=stream, stdout=PIPE)
+        else:
+            self._child = Popen(cmd, stdin=PIPE, stdout=PIPE)
+            self._feeder = threading.Thread(target=_feed, args=(stream, self._child.stdin, self._errors),
+                                            name="unpack")
+            self._feeder.daemon = True
+            self._feeder.start()
+
+    def read(self, size=-1):
+        return self._child.stdout.read(size)
+
+    def close(self):
+        # drain, the decompressor may still be writing
+        for data in iter(lambda: self._child.stdout.read(BLOCK_SIZE), ""):
+            pass
+
+        self._child.stdout.close()
+        if self._feeder is not None:
+            self._feeder.join()
+        if self._child.wait():
+            raise Exception, "%s exitted with %d" % (self.cmd[0], self._child.returncode)
+        if self._errors:
+            raise self._errors[0]
+
+    def abort(self):
+        if self._child.poll() is None:
+            self._child.kill()
+        self._child.wait()
+        self._child.stdout.close()
+        if self._feeder is not None:
+            self._feeder.join()
+
+def _largest(members, size):
+    """Returns the member with the largest size(member), a file called
+    vmcore wins regardless of the size."""
+    result = None
+    for member in members:
+        if result is None or size(member) > size(result):
+            result = member
+
+    for member in members:
+        if os.path.basename(member.name if hasattr(member, "name") else member.filename) == "vmcore":
+            return member
+
+    return result
+
+def _unpack_stream(stream, target, depth):
+    """Unpacks a non-seekable stream into target."""
+    if depth > MAX_DEPTH:
+        raise Exception, "Too many nested archives"
+
+    if isinstance(stream, file):
+        head = stream.read(SNIFF_SIZE)
+        stream.seek(-len(head), os.SEEK_CUR)
+    else:
+        stream = _Peekable(stream)
+        head = stream.peek(SNIFF_SIZE)
+
+    cmd = get_stream_decompressor(head)
+    if cmd is not None:
+        log_debug("Decompressing by %s" % cmd[0])
+        decompressed = _Decompressed(stream, cmd)
+        try:
+            _unpack_stream(decompressed, target, depth + 1)
+        except:
+            decompressed.abort()
+            raise
+
+        decompressed.close()
+    elif is_tar(head):
+        _unpack_tar_stream(stream, target, depth)
+    elif head.startswith(ZIP_MAGIC):
+        # zip needs seeking, spool the archive
+        spool = "%s.zip" % target
+        write_sparse(stream, spool)
+        try:
+            _unpack_zip(spool, target, depth)
+        finally:
+            os.unlink(spool)
+    elif head.startswith(SEVENZIP_MAGIC):
+        raise UnsupportedArchive, "7z archives can not be unpacked as a stream"
+    else:
+        write_sparse(stream, target)
+
+def _unpack_tar_stream(stream, target, depth):
+    """The member list of a stream is not known in advance. Only members
+    larger than the best one so far are unpacked, each replacing the
+    previous one, which usually means the vmcore and maybe a small file
+    in front of it."""
+    candidate = "%s.candidate" % target
+    best = None
+    archive = tarfile.open(fileobj=stream, mode="r|")
+    for member in archive:
+        if not member.isfile():
+            continue
+
+        if best is not None and os.path.basename(best.name) == "vmcore":
+            continue
+
+        if best is not None and member.size <= best.size and os.path.basename(member.name) != "vmcore":
+            continue
+
+        log_debug("Unpacking '%s' (%d bytes)" % (member.name, member.size))
+        _unpack_stream(archive.extractfile(member), candidate, depth + 1)
+        os.rename(candidate, target)
+        best = member
+
+    archive.close()
+    if best is None:
+        raise Exception, "No files found in the tarball"
+
+def _unpack_tar(path, target, depth):
+    """Tar on the disk, the member is picked by reading the headers only."""
+    with tarfile.open(path, "r:") as archive:
+        best = _largest([m for m in archive.getmembers() if m.isfile()], lambda m: m.size)
+        if best is None:
+            raise Exception, "No files found in the tarball"
+
+        log_debug("Unpacking '%s' (%d bytes)" % (best.name, best.size))
+        _unpack_stream(archive.extractfile(best), target, depth + 1)
+
+def _unpack_zip(path, target, depth):
+    archive = zipfile.ZipFile(path)
+    try:
+        best = _largest([i for i in archive.infolist() if not i.filename.endswith("/")],
+                        lambda i: i.file_size)
+        if best is None:
+            raise Exception, "No files found in the zip archive"
+
+        log_debug("Unpacking '%s' (%d bytes)" % (best.filename, best.file_size))
+        member = archive.open(best)
+        try:
+            _unpack_stream(member, target, depth + 1)
+        finally:
+            member.close()
+    finally:
+        archive.close()
+
+def extract_vmcore(path, target):
+    """Unpacks the vmcore from path, which may be compressed by gzip, bzip2,
+    xz or lzop, packed by tar or zip, or any nesting of these, into target.
+    Of every archive, only the member called vmcore or the largest member
+    is unpacked, everything is read as a stream and nothing but the result
+    is written. path is removed on success and left untouched on failure.
+    Raises UnsupportedArchive if an unsupported format (7z) is found."""
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_SIZE)
+
+    tmptarget = "%s.unpack" % target
+    try:
+        if is_tar(head):
+            _unpack_tar(path, tmptarget, 0)
+        elif head.startswith(ZIP_MAGIC):
+            _unpack_zip(path, tmptarget, 0)
+        elif head.startswith(SEVENZIP_MAGIC):
+            raise UnsupportedArchive, "7z archives are not supported"
+        elif get_stream_decompressor(head) is None:
+            # not an archive
+            if os.path.abspath(path) != os.path.abspath(target):
+                os.rename(path, target)
+            return
+        else:
+            with open(path, "rb") as f:
+                _unpack_stream(f, tmptarget, 0)
+    except:
+        # tmptarget, tmptarget.candidate, tmptarget.zip, ...
+        directory = os.path.dirname(tmptarget) or "."
+        for leftover in os.listdir(directory):
+            if leftover.startswith(os.path.basename(tmptarget)):
+                os.unlink(os.path.join(directory, leftover))
+        raise
+
+    os.rename(tmptarget, target)
+    if os.path.abspath(path) != os.path.abspath(target):
+        os.unlink(path)
+
+def decompress_file(path, target):
+    """Decompresses path (gzip, bzip2, xz or lzop) into target, zero blocks
+    are left as holes. path is removed on success."""
+    with open(path, "rb") as f:
+        cmd = get_stream_decompressor(f.read(SNIFF_SIZE))
+        if cmd is None:
+            raise Exception, "'%s' is not compressed by a known format" % path
+
+        f.seek(0)
+        decompressed = _Decompressed(f, cmd)
+        try:
+            try:
+                write_sparse(decompressed, target)
+            except:
+                decompressed.abort()
+                raise
+
+            decompressed.close()
+        except:
+            if os.path.isfile(target):
+                os.unlink(target)
+            raise
+
+    os.unlink(path)
@@ -0,0 +1,238 @@
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+from elfcore import ELFMAG, ElfHeader, ElfCoreError, PT_NOTE, header_arch
+from retrace import KERNEL_RELEASE_PARSER, OSRELEASE_VAR_PARSER
+
+KDUMP_SIGNATURE = "KDUMP   "
+
+# struct new_utsname follows signature[8] and header_version
+KDUMP_UTSNAME_OFFSET = 12
+UTSNAME_FIELD_LENGTH = 65
+UTSNAME_FIELDS = ["sysname", "nodename", "release", "version", "machine", "domainname"]
+
+# utsname.machine -> sizeof(long) of the dumped kernel
+WORD_SIZE = {
+  "x86_64": 8,
+  "ppc64": 8,
+  "ppc64le": 8,
+  "s390x": 8,
+  "aarch64": 8,
+  "ia64": 8,
+}
+
+VMCOREINFO_NOTE = "VMCOREINFO"
+
+# never read more than this from a header, anything larger is corrupted
+MAX_HEADER_SIZE = 16 << 20
+
+# the fallback scan, see scan_kernel_release
+SCAN_CHUNK_SIZE = 64 << 20
+SCAN_OVERLAP = 4096
+MAX_SCAN_PROCESSES = 8
+
+# equivalent of `strings -n 10`
+STRINGS_PARSER = re.compile("[\t\x20-\x7e]{10,}")
+PRINTABLE = frozenset("\t" + "".join(chr(c) for c in xrange(0x20, 0x7f)))
+
+class VmcoreHeaderError(Exception):
+    pass
+
+def parse_vmcoreinfo(data):
+    """Parses KEY=value lines of VMCOREINFO into a dictionary."""
+    result = {}
+    for line in data.rstrip("\0").splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            result[key] = value
+
+    return result
+
+def _read_at(f, offset, size):
+    if size > MAX_HEADER_SIZE:
+        raise VmcoreHeaderError, "Header field too large (%d bytes)" % size
+
+    f.seek(offset)
+    result = f.read(size)
+    if len(result) != size:
+        raise VmcoreHeaderError, "Unexpected end of file"
+
+    return result
+
+def _read_kdump_header(f):
+    """Reads the header of a kdump-compressed (diskdump) vmcore
+    as written by makedumpfile -c/-l/-p."""
+    header = _read_at(f, 0, 4096)
+    for order in ["<", ">"]:
+        version = struct.unpack_from(order + "i", header, 8)[0]
+        if 0 < version < 256:
+            break
+    else:
+        raise VmcoreHeaderError, "Unknown kdump header version"
+
+    offset = KDUMP_UTSNAME_OFFSET
+    utsname = {}
+    for field in UTSNAME_FIELDS:
+        utsname[field] = header[offset:offset + UTSNAME_FIELD_LENGTH].split("\0", 1)[0]
+        offset += UTSNAME_FIELD_LENGTH
+
+    word = WORD_SIZE.get(utsname["machine"], 4)
+    # struct timeval is aligned to and made of longs
+    offset = (offset + word - 1) & ~(word - 1)
+    offset += 2 * word
+    # status, block_size
+    block_size = struct.unpack_from(order + "i", header, offset + 4)[0]
+
+    result = {
+      "format": "kdump",
+      "release": utsname["release"],
+      "machine": utsname["machine"],
+      "dump_level": None,
+      "vmcoreinfo": {},
+    }
+
+    if version < 1 or block_size <= 0:
+        return result
+
+    # struct kdump_sub_header is in the block following the header
+    sub = _read_at(f, block_size, 64)
+    ulong = order + ("Q" if word == 8 else "I")
+    result["dump_level"] = struct.unpack_from(order + "i", sub, word)[0]
+
+    if version >= 3:
+        # phys_base, dump_level, split, start_pfn, end_pfn
+        offset = 3 * word + 8
+        if word == 4:
+            # off_t is 64bit, aligned to 4 bytes on 32bit
+            offset = 20
+
+        vmcoreinfo_offset = struct.unpack_from(order + "q", sub, offset)[0]
+        vmcoreinfo_size = struct.unpack_from(ulong, sub, offset + 8)[0]
+        if vmcoreinfo_offset > 0 and vmcoreinfo_size > 0:
+            result["vmcoreinfo"] = parse_vmcoreinfo(_read_at(f, vmcoreinfo_offset, vmcoreinfo_size))
+
+    return result
+
+def _read_elf_header(f):
+    """Reads VMCOREINFO from the notes of an ELF vmcore
+    (/proc/vmcore copied as is or makedumpfile -E)."""
+    header = _read_at(f, 0, 64)
+    try:
+        elf = ElfHeader(header)
+    except (ElfCoreError, struct.error) as ex:
+        raise VmcoreHeaderError, str(ex)
+
+    phdrs = _read_at(f, 0, elf.phoff + elf.phnum * elf.phentsize)
+    vmcoreinfo = {}
+    for p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align in elf.program_headers(phdrs):
+        if p_type != PT_NOTE:
+            continue
+
+        notes = _read_at(f, p_offset, p_filesz)
+        for name, ntype, descoff, descsz in elf.notes(notes, 0, len(notes)):
+            if name == VMCOREINFO_NOTE:
+                vmcoreinfo = parse_vmcoreinfo(notes[descoff:descoff + descsz])
+                break
+
+    return {
+      "format": "elf",
+      "release": vmcoreinfo.get("OSRELEASE"),
+      "machine": header_arch(header),
+      # not recorded in ELF vmcores
+      "dump_level": None,
+      "vmcoreinfo": vmcoreinfo,
+    }
+
+def read_vmcore_header(path):
+    """Returns a dictionary with keys format ("kdump" or "elf"), release,
+    machine, dump_level (None if unknown) and vmcoreinfo (dictionary)
+    read from the vmcore header. Raises VmcoreHeaderError if the file
+    is not a vmcore in a known format."""
+    with open(path, "rb") as f:
+        signature = f.read(len(KDUMP_SIGNATURE))
+        try:
+            if signature == KDUMP_SIGNATURE:
+                result = _read_kdump_header(f)
+            elif signature.startswith(ELFMAG):
+                result = _read_elf_header(f)
+            else:
+                raise VmcoreHeaderError, "Unknown vmcore format"
+        except struct.error as ex:
+            raise VmcoreHeaderError, "Corrupted header: %s" % ex
+
+    if not result["release"]:
+        result["release"] = result["vmcoreinfo"].get("OSRELEASE")
+
+    return result
+
+def _scan_chunk(args):
+    """Returns the first kernel release found in the chunk or None."""
+    path, start, end = args
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # mmap offset must be aligned, include the byte preceding the chunk
+        mapstart = max(0, start - 1)
+        mapstart -= mapstart % mmap.ALLOCATIONGRANULARITY
+        maplen = min(size, end + SCAN_OVERLAP) - mapstart
+        if maplen <= 0:
+            return None
+
+        data = mmap.mmap(f.fileno(), maplen, mmap.MAP_PRIVATE, mmap.PROT_READ, offset=mapstart)
+        try:
+            # a string crossing the start of the chunk has been seen
+            # by the previous one
+            pos = start - mapstart
+            while pos > 0 and pos < maplen and data[pos - 1] in PRINTABLE:
+                pos += 1
+
+            for match in STRINGS_PARSER.finditer(data, pos):
+                if match.start() >= end - mapstart:
+                    break
+
+                line = match.group(0).strip()
+                osrelease = OSRELEASE_VAR_PARSER.match(line)
+                if osrelease:
+                    return osrelease.group(1)
+
+                if KERNEL_RELEASE_PARSER.match(line):
+                    return line
+        finally:
+            data.close()
+
+    return None
+
+def scan_kernel_release(path, processes=None):
+    """Searches the vmcore for OSRELEASE=... or a string looking like
+    a kernel release, the same way `strings -n 10` would find it.
+    Chunks of the file are scanned by parallel processes, the match
+    closest to the beginning wins. Returns None if nothing is found."""
+    size = os.path.getsize(path)
+    chunks = [(path, start, min(start + SCAN_CHUNK_SIZE, size))
+              for start in xrange(0, size, SCAN_CHUNK_SIZE)]
+    if not chunks:
+        return None
+
+    if processes is None:
+        processes = min(MAX_SCAN_PROCESSES, multiprocessing.cpu_count())
+
+    if processes <= 1 or len(chunks) == 1:
+        for chunk in chunks:
+            result = _scan_chunk(chunk)
+            if result is not None:
+                return result
+
+        return None
+
+    pool = multiprocessing.Pool(min(processes, len(chunks)))
+    try:
+        # results come in order, the rest is not needed after a match
+        for result in pool.imap(_scan_chunk, chunks):
+            if result is not None:
+                return result
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return None